@@ -58,6 +58,8 @@ datasources = {
             name='SILAM',
             temppath=None,
             species=['CO', 'NO2', 'NO', 'NMVOC', 'O3', 'PANS', 'PM10', 'SO2'],
+            # request all species at once
+            shared_source=True,
         )
     ),
     'EMEP': EMEPDriver(
@@ -73,6 +75,8 @@ datasources = {
             name='EMEP',
             temppath='/home2/hilboll/code/mss-chem/tmp',
             species=['NO2', 'PM25'],
+            # all species are contained in one file, download it only once
+            shared_source=True,
         )
     ),
 }
@@ -140,34 +144,30 @@ for city in EMEP_PERT_CITIES:
             species=['CO'],
             )
     )
-    driver.need_to_convert_to_nc4c = False
     driver.name = 'EMEP_' + city
     datasources['EMEP_' + city] = driver
 
 
 class CAMSTracerDriver(CAMSGlobDriver):
 
-    def fix_dataset(self, fn_out, species, fcinit):
-        from netCDF4 import Dataset, num2date, date2num
-        # read vertical coordinates
-        with Dataset(fn_out, 'a', format='NETCDF4_CLASSIC') as nc:
-            # fix time variable
-            t_obj = num2date(nc.variables['time'][:],
-                             nc.variables['time'].units)
-            t_unit = 'hours since {:%Y-%m-%dT%H:%M:%S}'.format(fcinit)
-            nc.variables['time'][:] = date2num(t_obj, t_unit)
-            nc.variables['time'].setncattr('units', t_unit)
-            nc.variables['time'].setncattr('standard_name', 'time')
-
-            nc.variables['level'].setncattr('standard_name',
-                                            'atmosphere_pressure_coordinate')
-            # convert to Pa; otherwise, vsec plotting doesn't work
-            nc.variables['level'][:] *= 100.
-            nc.variables['level'].setncattr('units', 'Pa')
+    def transform_attrs(self, name, attrs, species, fcinit):
+        attrs = super(CAMSTracerDriver, self).transform_attrs(
+                name, attrs, species, fcinit)
+        if name == 'level':
+            attrs['standard_name'] = 'atmosphere_pressure_coordinate'
+            attrs['units'] = 'Pa'
+        return attrs
 
-            self.set_standard_name(nc, species)
+    def transform_data(self, name, data, var_in, slab, species, fcinit):
+        if name == 'level':
+            # convert to Pa; otherwise, vsec plotting doesn't work
+            return data * 100.
+        return super(CAMSTracerDriver, self).transform_data(
+                name, data, var_in, slab, species, fcinit)
 
-            # TODO add history
+    def derived_variables(self, nc_in, nc_out, species, fcinit):
+        # the tracer files are on pressure levels
+        return []
 
 
 CAMS_TRACER = [('London', 'p26.212', '{fcinit:%Y%m%d}_tracer4emerge_pl.nc', (10, 101, 177), 'CO'),
@@ -1,4 +1,16 @@
+class DataNotAvailable(Exception): pass
 
 
+class DownloadFailed(Exception):
+    """Some files could not be downloaded, even after retrying
 
-class DataNotAvailable(Exception): pass
+    ``failed`` is a list of ``(filename, error)`` tuples.
+
+    """
+
+    def __init__(self, failed):
+        self.failed = failed
+        super(DownloadFailed, self).__init__(
+                'Download of {} file(s) failed: {}'.format(
+                        len(failed), ', '.join('{} ({})'.format(fn, err)
+                                               for fn, err in failed)))
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""*****************
+msschem.aggregate
+*****************
+
+This module provides read access to several source files as one dataset
+
+:class:`netCDF4.MFDataset` only aggregates files in the classic data model
+(NETCDF3 and NETCDF4_CLASSIC).  :class:`AggregatedDataset` opens each file
+with :class:`netCDF4.Dataset` instead, so the files can be in any netCDF
+format, and joins the variables along the aggregation dimension when they
+are read.  It implements the part of the :class:`netCDF4.Dataset` API which
+is used by the model drivers to read source files.
+
+This file is part of mss-chem.
+
+:copyright: Copyright 2017 Andreas Hilboll
+:copyright: Copyright 2017 by the mss-chem team, see AUTHORS.rst
+:license: APACHE-2.0, see LICENSE for details.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+"""
+
+from __future__ import division
+
+from collections import OrderedDict
+
+import numpy as np
+
+from netCDF4 import Dataset
+
+
+class AggregatedDimension(object):
+
+    def __init__(self, name, size, unlimited):
+        self.name = name
+        self.size = size
+        self._unlimited = unlimited
+
+    def __len__(self):
+        return self.size
+
+    def isunlimited(self):
+        return self._unlimited
+
+
+class AggregatedVariable(object):
+    """A variable joined from ``variables`` along its first dimension
+
+    Attributes and methods which aren't defined here (``units``,
+    ``ncattrs()``, ``chunking()``, ...) are taken from the first file.
+
+    """
+
+    def __init__(self, name, variables):
+        self.name = name
+        self._variables = variables
+        self._offsets = np.cumsum([0] + [len(v) for v in variables])
+        first = variables[0]
+        self.dimensions = first.dimensions
+        self.dtype = first.dtype
+        self.datatype = first.datatype
+        self.shape = (int(self._offsets[-1]), ) + first.shape[1:]
+        self.ndim = len(self.shape)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._variables[0], name)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def _normalize(self, key):
+        if not isinstance(key, tuple):
+            key = (key, )
+        for i, k in enumerate(key):
+            if k is Ellipsis:
+                fill = (slice(None), ) * (self.ndim - len(key) + 1)
+                key = key[:i] + fill + key[i + 1:]
+                break
+        if not key:
+            key = (slice(None), )
+        return key[0], key[1:]
+
+    def __getitem__(self, key):
+        first, rest = self._normalize(key)
+        offsets = self._offsets
+        if isinstance(first, (int, np.integer)):
+            index = first + self.shape[0] if first < 0 else first
+            if not 0 <= index < self.shape[0]:
+                raise IndexError('index {} is out of bounds for dimension '
+                                 '{} of size {}'.format(
+                                     first, self.dimensions[0],
+                                     self.shape[0]))
+            i = np.searchsorted(offsets, index, side='right') - 1
+            return self._variables[i][(index - offsets[i], ) + rest]
+
+        indices = np.arange(self.shape[0])[first]
+        if not len(indices):
+            return self._variables[0][(slice(0, 0), ) + rest]
+        # read each run of indices which falls into the same file at once
+        files = np.searchsorted(offsets, indices, side='right') - 1
+        runs = np.split(np.arange(len(indices)),
+                        np.flatnonzero(np.diff(files)) + 1)
+        parts = []
+        for run in runs:
+            i = files[run[0]]
+            local = indices[run] - offsets[i]
+            if np.all(np.diff(local) == 1):
+                local = slice(local[0], local[-1] + 1)
+            parts.append(self._variables[i][(local, ) + rest])
+        if len(parts) == 1:
+            return parts[0]
+        if any(isinstance(part, np.ma.MaskedArray) for part in parts):
+            return np.ma.concatenate(parts)
+        return np.concatenate(parts)
+
+
+class AggregatedDataset(object):
+    """Read the files ``fns`` as one dataset, joined along ``aggdim``
+
+    Dimensions, global attributes and all variables not depending on
+    ``aggdim`` are taken from the first file.  Variables whose first
+    dimension is ``aggdim`` are read from all files, in the order given.
+
+    """
+
+    def __init__(self, fns, aggdim):
+        self._datasets = []
+        try:
+            for fn in fns:
+                self._datasets.append(Dataset(fn, 'r'))
+        except Exception:
+            self.close()
+            raise
+        first = self._datasets[0]
+
+        self.dimensions = OrderedDict()
+        for name, dim in first.dimensions.items():
+            if name == aggdim:
+                dim = AggregatedDimension(
+                        name, sum(len(nc.dimensions[name])
+                                  for nc in self._datasets),
+                        dim.isunlimited())
+            self.dimensions[name] = dim
+
+        self.variables = OrderedDict()
+        for name, var in first.variables.items():
+            if var.dimensions[:1] == (aggdim, ):
+                var = AggregatedVariable(
+                        name, [nc.variables[name] for nc in self._datasets])
+            self.variables[name] = var
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._datasets[0], name)
+
+    def close(self):
+        for nc in self._datasets:
+            if nc.isopen():
+                nc.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
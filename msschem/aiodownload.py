@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""*******************
+msschem.aiodownload
+*******************
+
+This module provides an asyncio-based engine for concurrent HTTP downloads
+
+It is kept separate from :mod:`msschem.download` because it needs Python 3.5+
+and the optional ``aiohttp`` library.
+
+This file is part of mss-chem.
+
+:copyright: Copyright 2017 Andreas Hilboll
+:copyright: Copyright 2017 by the mss-chem team, see AUTHORS.rst
+:license: APACHE-2.0, see LICENSE for details.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+"""
+
+import asyncio
+import logging
+import os.path
+import threading
+
+import aiohttp
+
+from . import DataNotAvailable, DownloadFailed
+from .retry import RetryPolicy, TRANSIENT_HTTP_STATUS
+from .transfer import get_scheduler
+
+
+# errors after which a download is retried
+RETRY_ERRORS = (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError,
+                asyncio.TimeoutError)
+
+
+def is_transient(err):
+    """Return whether the aiohttp error ``err`` is worth retrying"""
+    if isinstance(err, aiohttp.ClientResponseError):
+        return err.status in TRANSIENT_HTTP_STATUS
+    return isinstance(err, RETRY_ERRORS)
+
+
+class AsyncHTTPEngine(object):
+    """Download many files over HTTP concurrently
+
+    The engine runs an event loop in a background thread.  All downloads
+    share one ``aiohttp`` session, so connections are kept alive and reused
+    between files (and between species, when the same engine is used for a
+    whole driver run).  The number of simultaneous connections is limited per
+    host and in total.  Responses are streamed to disk in chunks.
+
+    :meth:`fetch` can be called from several threads at the same time.
+
+    """
+
+    def __init__(self, limit_per_host=4, limit=16, chunk_size=1 << 20,
+                 timeout=None):
+        self.log = logging.getLogger('msschem')
+        self.limit_per_host = limit_per_host
+        self.limit = limit
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self._session = None
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def _get_session(self):
+        if self._session is None:
+            connector = aiohttp.TCPConnector(
+                    limit=self.limit, limit_per_host=self.limit_per_host)
+            self._session = aiohttp.ClientSession(
+                    connector=connector,
+                    timeout=aiohttp.ClientTimeout(total=None,
+                                                  sock_read=self.timeout))
+        return self._session
+
+    async def _fetch_one(self, url, fn, retry, n_tries, host=None,
+                         priority=0):
+        scheduler = get_scheduler()
+        state = dict(validator=None, size=None)
+        n_failed = 0
+        while True:
+            # waiting for a transfer slot blocks, so it is done in a thread.
+            # The slot is taken for each try, and free while waiting to retry
+            transfer = await self.loop.run_in_executor(None, scheduler.acquire,
+                                                       host, priority)
+            try:
+                await self._fetch_try(url, fn, state, transfer)
+                return fn
+            except Exception as err:
+                n_failed += 1
+                if not retry.should_retry(err, n_failed, n_tries,
+                                          transient=is_transient(err)):
+                    raise
+                delay = retry.get_delay(n_failed)
+                self.log.info('Retrying {} in {:.1f} s (try {} failed: {})'
+                              ''.format(url, delay, n_failed, err))
+            finally:
+                scheduler.release(transfer)
+            await asyncio.sleep(delay)
+
+    async def _fetch_try(self, url, fn, state, transfer):
+        """Download ``url`` to ``fn`` once, throttled by ``transfer``
+
+        ``state`` holds the validator and size of the file on the server
+        from the previous try; a partial file is continued, unless the file
+        has changed on the server (see If-Range).
+
+        """
+        from .download import http_total_size, http_validator
+        session = self._get_session()
+        fn_local = os.path.expanduser(fn)
+        headers = {}
+        offset = 0
+        if state['validator'] is not None and os.path.isfile(fn_local):
+            offset = os.path.getsize(fn_local)
+            headers = {'Range': 'bytes={}-'.format(offset),
+                       'If-Range': state['validator']}
+        async with session.get(url, headers=headers) as resp:
+            if resp.status == 404:
+                raise DataNotAvailable
+            resp.raise_for_status()
+            if resp.status != 206:
+                offset = 0
+            total = http_total_size(resp.headers, resp.status)
+            if offset and total != state['size']:
+                state['validator'] = None
+                raise aiohttp.ClientPayloadError(
+                        'Size of {} has changed'.format(url))
+            state['validator'] = http_validator(resp.headers)
+            state['size'] = total
+            with open(fn_local, 'ab' if offset else 'wb') as out:
+                async for chunk in resp.content.iter_chunked(
+                        self.chunk_size):
+                    out.write(chunk)
+                    delay = transfer.reserve(len(chunk))
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+        if (state['size'] is not None and
+                os.path.getsize(fn_local) != state['size']):
+            raise aiohttp.ClientPayloadError(
+                    'Download of {} incomplete'.format(url))
+
+    async def _fetch_all(self, urls, retry, n_tries, host, priority):
+        results = await asyncio.gather(
+                *[self._fetch_one(url, fn, retry, n_tries, host, priority)
+                  for url, fn in urls],
+                return_exceptions=True)
+        for result in results:
+            if isinstance(result, DataNotAvailable) or (
+                    isinstance(result, BaseException) and
+                    not isinstance(result, Exception)):
+                raise result
+        failed = [(url, result) for (url, _), result in zip(urls, results)
+                  if isinstance(result, Exception)]
+        if failed:
+            raise DownloadFailed(failed)
+        return results
+
+    def fetch(self, urls, n_tries=None, host=None, priority=0, retry=None):
+        """Download a list of ``(url, filename)`` pairs concurrently
+
+        Each download takes a transfer slot for ``host`` with ``priority``
+        from the :class:`msschem.transfer.TransferScheduler`.  Failed
+        downloads are retried according to the RetryPolicy ``retry`` (by
+        default, one with ``n_tries`` tries).  Files still failing then are
+        reported together in a :class:`msschem.DownloadFailed`.
+
+        Returns
+        -------
+        fns : list of str
+            The filenames, in the order of ``urls``
+
+        """
+        if retry is None:
+            retry = RetryPolicy(n_tries or 1)
+        future = asyncio.run_coroutine_threadsafe(
+                self._fetch_all(urls, retry, n_tries, host, priority),
+                self.loop)
+        return future.result()
+
+    async def _close_session(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def close(self):
+        """Close all connections and stop the event loop"""
+        asyncio.run_coroutine_threadsafe(self._close_session(),
+                                         self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
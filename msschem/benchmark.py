@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""*****************
+msschem.benchmark
+*****************
+
+This module provides benchmarks for tuning the output file settings
+
+This file is part of mss-chem.
+
+:copyright: Copyright 2017 Andreas Hilboll
+:copyright: Copyright 2017 by the mss-chem team, see AUTHORS.rst
+:license: APACHE-2.0, see LICENSE for details.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+"""
+
+from __future__ import division
+
+import os
+import os.path
+import shutil
+import tempfile
+import time
+
+from netCDF4 import Dataset
+import numpy as np
+
+from .compression import (CHUNK_POLICIES, PROFILES, chunk_cache_size,
+                          chunk_shape, filter_kwargs)
+from .models import classic_dtype
+
+
+def _data_variables(nc, varnames=None):
+    if varnames:
+        return [nc.variables[name] for name in varnames]
+    return [var for name, var in nc.variables.items()
+            if name not in nc.dimensions and len(var.dimensions) > 1]
+
+
+def benchmark_compression(fn, profiles=None, varnames=None, tempdir=None):
+    """Write the data variables of ``fn`` with several compression profiles
+
+    For each profile, the data variables are written to a temporary file one
+    index of the first dimension at a time.  Only the time spent writing
+    (i.e., compressing) and reading back (decompressing) is measured.
+
+    Parameters
+    ----------
+    fn : str
+        A netCDF file, e.g. a downloaded source file or an output file
+    profiles : list, optional
+        Names of the profiles to test (default: all profiles in
+        ``msschem.compression.PROFILES``)
+    varnames : list of str, optional
+        Variables to write (default: all variables with more than one
+        dimension)
+    tempdir : str, optional
+        Directory for the temporary files
+
+    Returns
+    -------
+    results : list of tuple
+        One ``(profile, write MB/s, read MB/s, compression ratio)`` tuple per
+        profile
+
+    """
+    if profiles is None:
+        profiles = sorted(PROFILES)
+    tempdir = tempfile.mkdtemp(dir=tempdir)
+    results = []
+    try:
+        with Dataset(fn, 'r') as nc_in:
+            variables = _data_variables(nc_in, varnames)
+            nbytes = sum(var.size * classic_dtype(var.dtype).itemsize
+                         for var in variables)
+            for profile in profiles:
+                fn_out = os.path.join(tempdir, '{}.nc'.format(profile))
+                t_write = 0.
+                with Dataset(fn_out, 'w', format='NETCDF4_CLASSIC') as nc_out:
+                    for var in variables:
+                        for dim in var.dimensions:
+                            if dim not in nc_out.dimensions:
+                                nc_out.createDimension(
+                                        dim, len(nc_in.dimensions[dim]))
+                        var_out = nc_out.createVariable(
+                                var.name, classic_dtype(var.dtype),
+                                var.dimensions,
+                                **filter_kwargs(profile, nc_out))
+                        for i in range(var.shape[0]):
+                            data = var[i]
+                            t0 = time.time()
+                            var_out[i] = data
+                            t_write += time.time() - t0
+                    t0 = time.time()
+                t_write += time.time() - t0  # closing flushes the data
+                t0 = time.time()
+                with Dataset(fn_out, 'r') as nc_out:
+                    for var in variables:
+                        for i in range(var.shape[0]):
+                            nc_out.variables[var.name][i]
+                t_read = time.time() - t0
+                results.append((profile,
+                                nbytes / 2**20 / max(t_write, 1e-9),
+                                nbytes / 2**20 / max(t_read, 1e-9),
+                                nbytes / os.path.getsize(fn_out)))
+                os.remove(fn_out)
+    finally:
+        shutil.rmtree(tempdir)
+    return results
+
+
+def format_compression_results(results):
+    """Format the results of :func:`benchmark_compression` as a table"""
+    width = max([len('profile')] + [len(r[0]) for r in results])
+    lines = ['{:{w}}  {:>10}  {:>10}  {:>6}'.format(
+            'profile', 'write MB/s', 'read MB/s', 'ratio', w=width)]
+    lines.append('-' * len(lines[0]))
+    for profile, write, read, ratio in results:
+        lines.append('{:{w}}  {:10.1f}  {:10.1f}  {:6.2f}'.format(
+                profile, write, read, ratio, w=width))
+    return '\n'.join(lines)
+
+
+def benchmark_chunking(fn, varname=None, policies=None, n_reads=5,
+                       profile='default', tempdir=None):
+    """Measure the read latency of MSS's access patterns per chunk layout
+
+    A 4-D (time, level, y, x) variable of ``fn`` is written once per chunking
+    policy (and once with the library's default chunking), and then read in
+    two patterns: horizontal sections (one time step and level) and vertical
+    sections (one time step, all levels, along a row and along a column of
+    the grid).  Each read uses a freshly opened file and the chunk cache size
+    recommended for the layout.
+
+    Parameters
+    ----------
+    fn : str
+        A netCDF file
+    varname : str, optional
+        Variable to use (default: the first 4-D variable)
+    policies : list, optional
+        Chunking policies to test (default: all, and the library default)
+    n_reads : int, optional
+        Number of reads per pattern; they use different time steps where
+        possible
+    profile : str or dict, optional
+        Compression profile of the test files
+    tempdir : str, optional
+        Directory for the temporary files
+
+    Returns
+    -------
+    results : list of tuple
+        One ``(policy, chunks, hsec ms, vsec ms)`` tuple per layout, with
+        the mean latency of one read
+
+    """
+    if policies is None:
+        policies = [None] + sorted(CHUNK_POLICIES)
+    tempdir = tempfile.mkdtemp(dir=tempdir)
+    results = []
+    try:
+        with Dataset(fn, 'r') as nc_in:
+            if varname is None:
+                varname = [name for name, var in nc_in.variables.items()
+                           if len(var.dimensions) == 4][0]
+            var = nc_in.variables[varname]
+            dtype = classic_dtype(var.dtype)
+            nt, nz, ny, nx = var.shape
+            for policy in policies:
+                fn_out = os.path.join(tempdir, '{}.nc'.format(policy))
+                with Dataset(fn_out, 'w', format='NETCDF4_CLASSIC') as nc_out:
+                    for dim in var.dimensions:
+                        nc_out.createDimension(dim,
+                                               len(nc_in.dimensions[dim]))
+                    kwargs = filter_kwargs(profile, nc_out)
+                    if policy is not None:
+                        kwargs['chunksizes'] = chunk_shape(
+                                policy, var.shape, dtype.itemsize)
+                    var_out = nc_out.createVariable(varname, dtype,
+                                                    var.dimensions, **kwargs)
+                    for i in range(nt):
+                        var_out[i] = var[i]
+                    chunks = var_out.chunking()
+                cache = None
+                if policy is not None:
+                    cache = chunk_cache_size(policy, var.shape, chunks,
+                                             dtype.itemsize)
+
+                def timed_read(index):
+                    with Dataset(fn_out, 'r') as nc:
+                        v = nc.variables[varname]
+                        if cache is not None:
+                            v.set_var_chunk_cache(size=cache)
+                        t0 = time.time()
+                        v[index]
+                        return time.time() - t0
+
+                t_hsec = [timed_read((i % nt, (i * 7) % nz, slice(None),
+                                      slice(None)))
+                          for i in range(n_reads)]
+                t_vsec = [timed_read((i % nt, slice(None), ny // 2,
+                                      slice(None)) if i % 2 else
+                                     (i % nt, slice(None), slice(None),
+                                      nx // 2))
+                          for i in range(n_reads)]
+                results.append((policy, chunks,
+                                1e3 * np.mean(t_hsec), 1e3 * np.mean(t_vsec)))
+                os.remove(fn_out)
+    finally:
+        shutil.rmtree(tempdir)
+    return results
+
+
+def format_chunking_results(results):
+    """Format the results of :func:`benchmark_chunking` as a table"""
+    rows = [('default' if policy is None else policy,
+             'contiguous' if chunks == 'contiguous' else
+             'x'.join(str(c) for c in chunks), hsec, vsec)
+            for policy, chunks, hsec, vsec in results]
+    width = max([len('layout')] + [len(r[0]) for r in rows])
+    cwidth = max([len('chunks')] + [len(r[1]) for r in rows])
+    lines = ['{:{w}}  {:{cw}}  {:>8}  {:>8}'.format(
+            'layout', 'chunks', 'hsec ms', 'vsec ms', w=width, cw=cwidth)]
+    lines.append('-' * len(lines[0]))
+    for policy, chunks, hsec, vsec in rows:
+        lines.append('{:{w}}  {:{cw}}  {:8.2f}  {:8.2f}'.format(
+                policy, chunks, hsec, vsec, w=width, cw=cwidth))
+    return '\n'.join(lines)
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""*******************
+msschem.compression
+*******************
+
+This module provides the compression and chunking settings for the output
+files
+
+A compression profile is a set of HDF5 filter settings, i.e. the keyword
+arguments ``compression``, ``complevel``, ``shuffle`` and ``fletcher32`` of
+:meth:`netCDF4.Dataset.createVariable`.  Profiles are referenced by name (see
+``PROFILES``) or given as a dict, which overrides the ``'default'`` profile.
+
+A chunking policy determines the chunk shape of the data variables, depending
+on how MSS will read them (see ``CHUNK_POLICIES``).
+
+This file is part of mss-chem.
+
+:copyright: Copyright 2017 Andreas Hilboll
+:copyright: Copyright 2017 by the mss-chem team, see AUTHORS.rst
+:license: APACHE-2.0, see LICENSE for details.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+"""
+
+from __future__ import division
+
+import logging
+import math
+
+import numpy as np
+
+
+PROFILES = {
+    # the settings MSS-Chem has always used
+    'default': dict(compression='zlib', complevel=6, shuffle=True,
+                    fletcher32=True),
+    'fast': dict(compression='zlib', complevel=1, shuffle=True,
+                 fletcher32=False),
+    'small': dict(compression='zlib', complevel=9, shuffle=True,
+                  fletcher32=False),
+    'zstd': dict(compression='zstd', complevel=3, shuffle=True,
+                 fletcher32=False),
+    'blosc': dict(compression='blosc_lz4', complevel=5, shuffle=True,
+                  fletcher32=False),
+    'none': dict(compression=None, complevel=0, shuffle=False,
+                 fletcher32=False),
+}
+
+# horizontal tile size of the 'vsec' policy
+VSEC_TILE = 16
+# target chunk size of the 'balanced' policy
+BALANCED_CHUNK_BYTES = 2**20
+
+CHUNK_POLICIES = {
+    # fastest for horizontal sections
+    'hsec': 'one time step and level, the whole horizontal grid',
+    # fastest for vertical sections
+    'vsec': 'one time step, all levels, VSEC_TILE x VSEC_TILE grid points',
+    # a compromise between both
+    'balanced': 'one time step, blocks of levels, horizontal tiles; about '
+                'BALANCED_CHUNK_BYTES per chunk',
+}
+
+# filters for which we have already warned that they are not available
+_WARNED = set()
+
+
+def get_profile(profile):
+    """Return the settings of ``profile`` (a name or a dict) as a dict"""
+    if isinstance(profile, dict):
+        unknown = set(profile) - set(PROFILES['default'])
+        if unknown:
+            raise ValueError('Unknown compression setting(s): {}'.format(
+                    ', '.join(sorted(unknown))))
+        settings = dict(PROFILES['default'])
+        settings.update(profile)
+        return settings
+    try:
+        return dict(PROFILES[profile])
+    except KeyError:
+        raise ValueError('Unknown compression profile `{}`; choose one of '
+                         '{}'.format(profile, ', '.join(sorted(PROFILES))))
+
+
+def has_filter(nc, compression):
+    """Check if the netCDF library provides the filter ``compression``"""
+    if compression in (None, 'zlib'):
+        return True
+    name = 'blosc' if compression.startswith('blosc') else compression
+    check = getattr(nc, 'has_{}_filter'.format(name), None)
+    return check is not None and check()
+
+
+def filter_kwargs(profile, nc, coordinate=False):
+    """Return the ``createVariable`` keyword arguments for ``profile``
+
+    Filters which are not available in the netCDF library are replaced by
+    zlib (with a warning).  Coordinate variables are never compressed, only
+    the checksum setting applies to them.
+
+    Parameters
+    ----------
+    profile : str or dict
+        The compression profile
+    nc : netCDF4.Dataset
+        The dataset the variable will be created in
+    coordinate : bool, optional
+        Whether the variable is a coordinate variable
+
+    """
+    settings = get_profile(profile)
+    if coordinate:
+        return dict(zlib=False, fletcher32=settings['fletcher32'])
+    compression = settings['compression']
+    if not has_filter(nc, compression):
+        if compression not in _WARNED:
+            _WARNED.add(compression)
+            logging.getLogger('msschem').warning(
+                    'Compression filter {} is not available, using '
+                    'zlib'.format(compression))
+        compression = 'zlib'
+    kwargs = dict(complevel=settings['complevel'],
+                  shuffle=settings['shuffle'],
+                  fletcher32=settings['fletcher32'])
+    if hasattr(nc, 'has_zstd_filter'):
+        kwargs['compression'] = compression
+    else:
+        # netCDF4 < 1.6 only knows zlib
+        kwargs['zlib'] = compression is not None
+    return kwargs
+
+
+def chunk_shape(policy, shape, itemsize=4):
+    """Return the chunk shape of a variable for chunking ``policy``
+
+    Variables are assumed to have the dimensions (time, level, y, x) or
+    (time, y, x).  Chunks always contain one time step.
+
+    Parameters
+    ----------
+    policy : str
+        One of ``CHUNK_POLICIES``
+    shape : tuple of int
+        Shape of the variable; the length of the time dimension is ignored
+    itemsize : int, optional
+        Bytes per value
+
+    Returns
+    -------
+    chunks : list of int or None
+        None for variables with less than three dimensions, which keep the
+        library's default chunking
+
+    """
+    if policy not in CHUNK_POLICIES:
+        raise ValueError('Unknown chunking policy `{}`; choose one of '
+                         '{}'.format(policy, ', '.join(sorted(CHUNK_POLICIES))))
+    if len(shape) < 3:
+        return None
+    ny, nx = [max(n, 1) for n in shape[-2:]]
+    nz = max(shape[1], 1) if len(shape) == 4 else 1
+    if policy == 'hsec':
+        cz, cy, cx = 1, ny, nx
+    elif policy == 'vsec':
+        cz, cy, cx = nz, min(ny, VSEC_TILE), min(nx, VSEC_TILE)
+    else:
+        cz = int(math.ceil(math.sqrt(nz)))
+        tile = max(1, int(math.sqrt(BALANCED_CHUNK_BYTES / (cz * itemsize))))
+        cy, cx = min(ny, tile), min(nx, tile)
+    chunks = [1] * (len(shape) - 2) + [cy, cx]
+    if len(shape) == 4:
+        chunks[1] = cz
+    return chunks
+
+
+def chunk_cache_size(policy, shape, chunks, itemsize=4):
+    """Return the chunk cache size (in bytes) for reading a variable
+
+    The cache holds all chunks touched by one read of the access pattern the
+    policy is made for: a horizontal section at one time step and level
+    (``hsec``), a vertical section along a straight line across the grid
+    (``vsec``), or the larger of both (``balanced``).
+
+    """
+    n_y = -(-max(shape[-2], 1) // chunks[-2])
+    n_x = -(-max(shape[-1], 1) // chunks[-1])
+    n_z = -(-max(shape[1], 1) // chunks[1]) if len(shape) == 4 else 1
+    n_hsec = n_y * n_x
+    n_vsec = (n_y + n_x) * n_z
+    n_chunks = {'hsec': n_hsec, 'vsec': n_vsec,
+                'balanced': max(n_hsec, n_vsec)}[policy]
+    chunk_bytes = itemsize
+    for c in chunks:
+        chunk_bytes *= c
+    return n_chunks * chunk_bytes
+
+
+def encode_data(data, dtype, attrs, fill_value):
+    """Return ``data`` as stored in a variable of type ``dtype``
+
+    Like netCDF4, data is packed if the variable has an integer type and
+    ``scale_factor`` or ``add_offset`` attributes (``attrs``).  Masked values
+    are replaced by ``fill_value``.
+
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'iu' and ('scale_factor' in attrs or
+                               'add_offset' in attrs):
+        data = np.ma.masked_invalid(data)
+        data = (data - attrs.get('add_offset', 0.)) / \
+            attrs.get('scale_factor', 1.)
+        data = np.ma.round(data)
+    if np.ma.isMaskedArray(data):
+        data = data.filled(fill_value)
+    return np.asarray(data, dtype=dtype)
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""**************
+msschem.daemon
+**************
+
+This module provides the scheduler behind ``msschem-dl --daemon``
+
+Instead of trying to download every model at fixed times, the daemon asks
+each model's download driver whether new data are there, using cheap probes
+(a directory listing, a ``HEAD`` request, or a file stat).  Only when a probe
+succeeds is the model run.  The times at which data became available are
+kept, and the daemon learns from them when to start probing.
+
+This file is part of mss-chem.
+
+:copyright: Copyright 2017 Andreas Hilboll
+:copyright: Copyright 2017 by the mss-chem team, see AUTHORS.rst
+:license: APACHE-2.0, see LICENSE for details.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+"""
+
+from __future__ import division
+
+import datetime
+import logging
+import time
+
+from .fileutils import atomic_write_json, read_json
+from .runner import run_model
+
+
+class AvailabilityHistory(object):
+    """Delays after init time at which the data of each model appeared
+
+    The last ``maxlen`` delays (in seconds) of each model are kept in the JSON
+    file ``fname``, so that they survive restarts of the daemon.  With
+    ``fname=None``, the history is only kept in memory.
+
+    """
+
+    def __init__(self, fname=None, maxlen=30):
+        self.fname = fname
+        self.maxlen = maxlen
+        self.delays = (read_json(fname) if fname else None) or {}
+
+    def record(self, name, delay):
+        """Add a ``delay`` (a timedelta) at which data of ``name`` appeared"""
+        delays = self.delays.setdefault(name, [])
+        delays.append(delay.total_seconds())
+        del delays[:-self.maxlen]
+        if self.fname:
+            atomic_write_json(self.fname, self.delays)
+
+    def window(self, name):
+        """Return the earliest and the typical (median) delay of ``name``
+
+        Returns
+        -------
+        window : tuple of datetime.timedelta, or None
+            ``None`` if there is no history for ``name`` yet
+
+        """
+        delays = sorted(self.delays.get(name, []))
+        if not delays:
+            return None
+        return (datetime.timedelta(seconds=delays[0]),
+                datetime.timedelta(seconds=delays[len(delays) // 2]))
+
+
+class ProbeSchedule(object):
+    """Decide when to probe a model next
+
+    No probes are made before the earliest delay in the history.  Until the
+    typical delay, the time to the next probe is half of the remaining time,
+    so that probing gets denser towards the time the data usually appear.
+    Afterwards, and for models without history, the interval between probes
+    starts at ``min_interval`` and is multiplied by ``backoff`` after each
+    unsuccessful probe, up to ``max_interval``.  All intervals are in
+    seconds.
+
+    """
+
+    def __init__(self, history, min_interval=120, max_interval=1800,
+                 backoff=2):
+        self.history = history
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+
+    def typical(self, name, fcinit):
+        """Return the time at which data are usually available, or None"""
+        window = self.history.window(name)
+        if window is None:
+            return None
+        return fcinit + window[1]
+
+    def next_probe(self, name, fcinit, now, n_late=0):
+        """Return the time of the next probe
+
+        Parameters
+        ----------
+        name : str
+            Name of the model
+        fcinit : datetime.datetime
+            Init time which is waited for
+        now : datetime.datetime
+            Current time
+        n_late : int
+            Number of unsuccessful probes after the typical availability time
+
+        """
+        now = max(now, fcinit)
+        window = self.history.window(name)
+        if window is not None:
+            earliest, typical = fcinit + window[0], fcinit + window[1]
+            if now < earliest:
+                return earliest
+            if now < typical:
+                wait = (typical - now).total_seconds() / 2
+                return now + datetime.timedelta(seconds=min(
+                        max(wait, self.min_interval), self.max_interval))
+        wait = min(self.min_interval * self.backoff ** n_late,
+                   self.max_interval)
+        return now + datetime.timedelta(seconds=wait)
+
+
+class Daemon(object):
+    """Process new forecasts of several models as soon as they appear
+
+    For every model, the daemon waits for one init time, starting at
+    ``fcinit``.  Whenever a model's probe (see :meth:`CTMDriver.probe`)
+    succeeds, or the download driver can't probe, the model is run with
+    :func:`msschem.runner.run_model`.  Once all its data are processed, the
+    model waits for the next day's init time.  Models are run one at a time.
+
+    Availability times are only added to the history if at least one probe
+    for this init time has failed before, since otherwise the data may have
+    been there long before the daemon looked.
+
+    """
+
+    # functions returning the current time, and sleeping; tests replace these
+    clock = staticmethod(datetime.datetime.now)
+    sleep = staticmethod(time.sleep)
+
+    def __init__(self, datasources, names, fcinit, schedule, prune=None):
+        self.log = logging.getLogger('msschem')
+        self.datasources = datasources
+        self.schedule = schedule
+        self.prune = prune
+        self.state = dict((name, dict(fcinit=fcinit,
+                                      next_probe=datetime.datetime.min,
+                                      n_failed=0, n_late=0))
+                          for name in names)
+
+    def step(self):
+        """Wait for the model which is due next, then probe and run it
+
+        Returns
+        -------
+        result : tuple
+            ``(name, fcinit, status)``; ``status`` is ``'waiting'`` if the
+            probe failed, otherwise the status returned by
+            :func:`run_model`
+
+        """
+        name = min(self.state, key=lambda n: self.state[n]['next_probe'])
+        state = self.state[name]
+        wait = (state['next_probe'] - self.clock()).total_seconds()
+        if wait > 0:
+            self.sleep(wait)
+        fcinit = state['fcinit']
+        driver = self.datasources[name]
+
+        try:
+            available = driver.probe(fcinit)
+        except Exception as err:
+            self.log.warning('Probing {}/{:%Y%m%d} failed: {}'.format(
+                    name, fcinit, err))
+            available = False
+        # the time the data were found, not including the processing time
+        probed = self.clock()
+        if available is False:
+            status = 'waiting'
+        else:
+            _, status, _ = run_model(self.datasources, name, fcinit,
+                                     self.prune)
+
+        now = self.clock()
+        if status == 'done':
+            if state['n_failed']:
+                self.schedule.history.record(name, probed - fcinit)
+            self.log.info('{}/{:%Y%m%d} done after {} probe(s)'.format(
+                    name, fcinit, state['n_failed'] + 1))
+            next_fcinit = fcinit + datetime.timedelta(days=1)
+            state.update(fcinit=next_fcinit, n_failed=0, n_late=0)
+            state['next_probe'] = self.schedule.next_probe(name, next_fcinit,
+                                                           now)
+        else:
+            typical = self.schedule.typical(name, fcinit)
+            state['n_failed'] += 1
+            if typical is None or now >= typical:
+                state['n_late'] += 1
+            state['next_probe'] = self.schedule.next_probe(
+                    name, fcinit, now, max(state['n_late'] - 1, 0))
+            self.log.debug('{}/{:%Y%m%d} {}, next probe at {:%H:%M:%S}'
+                           ''.format(name, fcinit, status,
+                                     state['next_probe']))
+        return name, fcinit, status
+
+    def run(self):
+        """Process models forever"""
+        while True:
+            self.step()
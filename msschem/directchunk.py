@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""*******************
+msschem.directchunk
+*******************
+
+This module provides parallel chunk compression for netCDF output files
+
+The netCDF library compresses chunks one after the other, holding the HDF5
+library lock.  :class:`DirectChunkWriter` instead splits the data written to
+large variables into chunks, compresses them with the same HDF5 filters
+(fletcher32, shuffle and deflate) in a process pool, and spools the
+compressed chunks to a temporary file.  Once the netCDF library has closed
+the output file, the chunks are stored with HDF5 direct chunk writes (using
+h5py).  The resulting files are ordinary netCDF-4 files.
+
+This file is part of mss-chem.
+
+:copyright: Copyright 2017 Andreas Hilboll
+:copyright: Copyright 2017 by the mss-chem team, see AUTHORS.rst
+:license: APACHE-2.0, see LICENSE for details.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+"""
+
+from __future__ import division
+
+import itertools
+import logging
+import os
+import tempfile
+import zlib
+
+import numpy as np
+
+import h5py
+from netCDF4 import default_fillvals
+
+from .compression import encode_data
+
+
+# HDF5 filter ids
+H5Z_FILTER_DEFLATE = 1
+H5Z_FILTER_SHUFFLE = 2
+H5Z_FILTER_FLETCHER32 = 3
+
+
+def fletcher32(buf):
+    """Return the checksum of ``buf`` computed by the HDF5 fletcher32 filter
+
+    The data are summed as big-endian 16 bit words (an odd last byte is
+    padded with zero), with the sums reduced modulo 65535 as in HDF5.
+
+    """
+    if len(buf) % 2:
+        buf += b'\0'
+    words = np.frombuffer(buf, '>u2').astype(np.uint64)
+    # the weights are reduced first, so the products fit into 32 bits
+    weights = np.arange(len(words), 0, -1, dtype=np.uint64) % 65535
+    sum1 = int(words.sum())
+    sum2 = int((words * weights).sum())
+    # HDF5 reduces by adding the carries, so a non-zero sum never becomes 0
+    sum1 = (sum1 - 1) % 65535 + 1 if sum1 else 0
+    sum2 = (sum2 - 1) % 65535 + 1 if sum2 else 0
+    return (sum2 << 16) | sum1
+
+
+def compress_chunk(args):
+    """Apply the filter ``pipeline`` to one chunk
+
+    Parameters
+    ----------
+    args : tuple
+        ``(offset, data, pipeline)``, where pipeline is a list of
+        ``(filter id, complevel)`` in the order of the HDF5 filter pipeline
+
+    Returns
+    -------
+    offset, buf, filter_mask
+
+    """
+    offset, data, pipeline = args
+    buf = np.ascontiguousarray(data)
+    itemsize = buf.dtype.itemsize
+    buf = buf.tobytes()
+    filter_mask = 0
+    for i, (filter_id, complevel) in enumerate(pipeline):
+        if filter_id == H5Z_FILTER_FLETCHER32:
+            buf += np.array(fletcher32(buf), '<u4').tobytes()
+        elif filter_id == H5Z_FILTER_SHUFFLE:
+            if itemsize > 1:
+                # like HDF5, trailing bytes (the checksum) are not shuffled
+                n = len(buf) - len(buf) % itemsize
+                buf = np.frombuffer(buf[:n], np.uint8).reshape(
+                        -1, itemsize).T.tobytes() + buf[n:]
+        elif filter_id == H5Z_FILTER_DEFLATE:
+            buf = zlib.compress(buf, complevel)
+        else:
+            filter_mask |= 1 << i
+    return offset, buf, filter_mask
+
+
+def expected_pipeline(zlib=False, complevel=4, shuffle=False,
+                      fletcher32=False, compression=None, **kwargs):
+    """Return the filter pipeline netCDF creates for these arguments
+
+    Returns None if the chunks can't be compressed by
+    :func:`compress_chunk`, e.g. for other filters or quantization.
+
+    """
+    if compression not in (None, 'zlib') or \
+            kwargs.get('least_significant_digit') is not None or \
+            kwargs.get('significant_digits') is not None:
+        return None
+    deflate = zlib or compression == 'zlib'
+    pipeline = []
+    if fletcher32:
+        pipeline.append((H5Z_FILTER_FLETCHER32, None))
+    if shuffle and deflate:
+        pipeline.append((H5Z_FILTER_SHUFFLE, None))
+    if deflate:
+        pipeline.append((H5Z_FILTER_DEFLATE, complevel))
+    if not pipeline:
+        return None
+    return pipeline
+
+
+def variable_pipeline(var):
+    """Return the filter pipeline of the netCDF variable ``var``
+
+    Returns None if ``var`` uses filters :func:`compress_chunk` can't apply.
+
+    """
+    filters = var.filters()
+    if any(filters.get(name) for name in ('szip', 'zstd', 'bzip2', 'blosc')):
+        return None
+    return expected_pipeline(zlib=filters['zlib'],
+                             complevel=filters['complevel'],
+                             shuffle=filters['shuffle'],
+                             fletcher32=filters['fletcher32'])
+
+
+class _Target(object):
+    """State of one variable written through the DirectChunkWriter"""
+
+    def __init__(self, var, pipeline):
+        self.name = var.name
+        self.var = var
+        self.dtype = np.dtype(var.dtype)
+        self.chunks = var.chunking()
+        self.pipeline = pipeline
+        # rows of the first dimension waiting for a complete row of chunks
+        self.buf_start = 0
+        self.buf = []
+        self.length = 0
+
+
+class DirectChunkWriter(object):
+    """Compress chunks in a process pool and store them with h5py
+
+    Parameters
+    ----------
+    n_workers : int
+        Number of compression processes
+    pool : multiprocessing.Pool, optional
+        The pool of ``n_workers`` processes.  It is owned by the caller and
+        may be shared with other writers.  Without a pool, chunks are
+        compressed in this process.
+    tempdir : str, optional
+        Directory for the spool file of compressed chunks
+
+    """
+
+    def __init__(self, n_workers, pool=None, tempdir=None):
+        self.n_workers = n_workers
+        self.pool = pool
+        self.spool = tempfile.TemporaryFile(dir=tempdir)
+        self.targets = {}
+        self.pending = []
+        # (variable, offset, position in spool, size, filter mask)
+        self.index = []
+
+    def register(self, var, kwargs):
+        """Handle ``var`` if its filters can be applied here
+
+        ``kwargs`` are the arguments ``var`` was created with.  Returns
+        whether the variable is handled.  If the filters netCDF actually
+        set up for ``var`` differ from those expected for ``kwargs``, the
+        data is left to the netCDF library.
+
+        """
+        chunks = var.chunking()
+        pipeline = expected_pipeline(**kwargs)
+        if pipeline is None or chunks == 'contiguous' or \
+                len(var.dimensions) < 3:
+            return False
+        actual = variable_pipeline(var)
+        if actual != pipeline:
+            logging.getLogger('msschem').warning(
+                    'Filters {} of {} differ from the expected {}, not '
+                    'compressing it in parallel'.format(
+                        actual, var.name, pipeline))
+            return False
+        self.targets[var.name] = _Target(var, pipeline)
+        return True
+
+    def handles(self, var):
+        return getattr(var, 'name', None) in self.targets and \
+            self.targets[var.name].var is var
+
+    def write(self, var, slab, data):
+        """Write ``data`` to ``var[slab]``; slabs must come in order"""
+        target = self.targets[var.name]
+        if slab is Ellipsis or slab == slice(None):
+            slab = slice(0, np.shape(data)[0])
+        if slab.start != target.buf_start + sum(len(b) for b in target.buf):
+            raise ValueError('Slabs of {} must be written in order'.format(
+                    var.name))
+        attrs = dict((attr, var.getncattr(attr)) for attr in var.ncattrs())
+        fill_value = attrs.get(
+                '_FillValue', default_fillvals[
+                    '{}{}'.format(target.dtype.kind, target.dtype.itemsize)])
+        target.buf.append(encode_data(data, target.dtype, attrs, fill_value))
+        target.fill_value = fill_value
+        target.length = max(target.length, slab.stop)
+        c0 = target.chunks[0]
+        n_buf = sum(len(b) for b in target.buf)
+        if n_buf >= c0:
+            block = np.concatenate(target.buf)
+            n_full = n_buf - n_buf % c0
+            self._submit(target, target.buf_start, block[:n_full])
+            target.buf = [block[n_full:]] if n_full < n_buf else []
+            target.buf_start += n_full
+
+    def _submit(self, target, start, block):
+        """Split ``block`` (whole rows of chunks) into chunks"""
+        chunks = target.chunks
+        ranges = [range(0, n, c) for n, c in zip(block.shape, chunks)]
+        for offset in itertools.product(*ranges):
+            index = tuple(slice(o, o + c) for o, c in zip(offset, chunks))
+            data = block[index]
+            if data.shape != tuple(chunks):
+                # edge chunks are stored with their full size
+                full = np.empty(chunks, dtype=target.dtype)
+                full[...] = target.fill_value
+                full[tuple(slice(0, n) for n in data.shape)] = data
+                data = full
+            offset = (start + offset[0], ) + offset[1:]
+            if self.pool is None:
+                self._store(target.name, compress_chunk(
+                        (offset, data, target.pipeline)))
+                continue
+            while len(self.pending) >= 2 * self.n_workers:
+                name, result = self.pending.pop(0)
+                self._store(name, result.get())
+            self.pending.append((target.name, self.pool.apply_async(
+                    compress_chunk, ((offset, data, target.pipeline), ))))
+
+    def _store(self, name, result):
+        offset, buf, filter_mask = result
+        self.spool.seek(0, os.SEEK_END)
+        self.index.append((name, offset, self.spool.tell(), len(buf),
+                           filter_mask))
+        self.spool.write(buf)
+
+    def flush(self):
+        """Compress all remaining data, including incomplete chunks"""
+        for target in self.targets.values():
+            if target.buf:
+                self._submit(target, target.buf_start,
+                             np.concatenate(target.buf))
+                target.buf = []
+        while self.pending:
+            name, result = self.pending.pop(0)
+            self._store(name, result.get())
+
+    def finish(self, fn_out):
+        """Store all compressed chunks in the (closed) netCDF file"""
+        self.flush()
+        with h5py.File(fn_out, 'r+') as h5:
+            for target in self.targets.values():
+                ds = h5[target.name]
+                if ds.shape[0] < target.length:
+                    ds.resize(target.length, axis=0)
+            for name, offset, pos, size, filter_mask in self.index:
+                self.spool.seek(pos)
+                h5[name].id.write_direct_chunk(offset, self.spool.read(size),
+                                               filter_mask)
+
+    def close(self):
+        # the pool is left running for other writers; results still pending
+        # after an error are discarded
+        self.pending = []
+        self.spool.close()
@@ -3,27 +3,36 @@
 from __future__ import print_function, with_statement
 
 from collections import OrderedDict
-from contextlib import closing
+from contextlib import closing, contextmanager
 import datetime
 from distutils.version import LooseVersion
 from ftplib import FTP, FTP_TLS
 from ftplib import all_errors as FTP_ALL_ERRORS
+from ftplib import error_perm as FTP_ERROR_PERM
 import logging
 import os.path
 import re
 import shutil
 from string import Formatter
+import threading
+import time
+
+try:  # Py2
+    from Queue import Queue, Empty
+except ImportError:  # Py3
+    from queue import Queue, Empty
 
 try:  # Py2
     from urllib import urlencode
-    from urllib2 import urlopen
-    from urllib2 import HTTPError
+    from urlparse import urlparse
+    from urllib2 import urlopen, Request
+    from urllib2 import HTTPError, URLError
     import httplib as http_client
     __pymsschem__ = 2
 except ImportError:  # Py3
-    from urllib.parse import urlencode
-    from urllib.request import urlopen
-    from urllib.error import HTTPError
+    from urllib.parse import urlencode, urlparse
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError, URLError
     import http.client as http_client
     __pymsschem__ = 3
 
@@ -33,7 +42,15 @@ try:
 except ImportError:
     _PARAMIKO = False
 
-from . import DataNotAvailable
+try:  # needs Py3.5+ and aiohttp
+    from .aiodownload import AsyncHTTPEngine
+    _AIOHTTP = True
+except (ImportError, SyntaxError):
+    _AIOHTTP = False
+
+from . import DataNotAvailable, DownloadFailed
+from .retry import RetryPolicy
+from .transfer import copy_stream, get_scheduler
 
 
 """****************
@@ -92,6 +109,21 @@ TODO
 
 """
 
+def http_validator(headers):
+    """Return the validator (ETag or Last-Modified) of an HTTP response"""
+    return headers.get('ETag') or headers.get('Last-Modified')
+
+
+def http_total_size(headers, status):
+    """Return the full size of the file an HTTP response belongs to"""
+    if status == 206:
+        m = re.match(r'bytes \d+-\d+/(\d+)',
+                     headers.get('Content-Range', ''))
+        return int(m.group(1)) if m else None
+    length = headers.get('Content-Length')
+    return int(length) if length is not None else None
+
+
 class DictFormatter(Formatter):
     # from https://stackoverflow.com/a/33621609/152439
     def __init__(self, default='{{{0}}}'):
@@ -104,22 +136,192 @@ class DictFormatter(Formatter):
             return Formatter.get_value(key, args, kwds)
 
 
+class ConnectionPool(object):
+    """A pool of open connections to one server
+
+    Connections are created with ``connect()`` when none is idle, checked
+    with ``check(conn)`` (which must return ``False`` for a dead connection)
+    before being handed out again, and closed with ``disconnect(conn)``.  The
+    number of simultaneously used connections can be limited with
+    ``maxsize``.  ``n_opened`` and ``n_reused`` count how many connections
+    have been opened and re-used, respectively.
+
+    """
+
+    def __init__(self, connect, check, disconnect, maxsize=None):
+        self._connect = connect
+        self._check = check
+        self._disconnect = disconnect
+        self._idle = []
+        self._lock = threading.Lock()
+        if maxsize:
+            self._slots = threading.BoundedSemaphore(maxsize)
+        else:
+            self._slots = None
+        self.n_opened = 0
+        self.n_reused = 0
+
+    def acquire(self):
+        if self._slots is not None:
+            self._slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    conn = self._idle.pop()
+                if self._check(conn):
+                    with self._lock:
+                        self.n_reused += 1
+                    return conn
+                self._disconnect(conn)
+            conn = self._connect()
+            with self._lock:
+                self.n_opened += 1
+            return conn
+        except Exception:
+            if self._slots is not None:
+                self._slots.release()
+            raise
+
+    def release(self, conn, broken=False):
+        if broken:
+            self._disconnect(conn)
+        else:
+            with self._lock:
+                self._idle.append(conn)
+        if self._slots is not None:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Context manager yielding a connection from the pool
+
+        The connection is closed instead of being returned to the pool if an
+        error other than :class:`DataNotAvailable` occurs.
+
+        """
+        conn = self.acquire()
+        try:
+            yield conn
+        except DataNotAvailable:
+            self.release(conn)
+            raise
+        except BaseException:
+            self.release(conn, broken=True)
+            raise
+        self.release(conn)
+
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._disconnect(conn)
+
+    def stats(self):
+        return dict(opened=self.n_opened, reused=self.n_reused)
+
+
+# connection pools, shared by all download drivers connecting to the same
+# server with the same credentials
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def get_pool(key, connect, check, disconnect, maxsize=None):
+    """Return the ConnectionPool for ``key``, creating it if needed"""
+    with _POOLS_LOCK:
+        if key not in _POOLS:
+            _POOLS[key] = ConnectionPool(connect, check, disconnect, maxsize)
+        return _POOLS[key]
+
+
+def close_pools():
+    """Close all idle connections of all pools"""
+    with _POOLS_LOCK:
+        pools = list(_POOLS.values())
+    for pool in pools:
+        pool.close()
+
+
 class DownloadDriver(object):
 
+    # whether ``get()`` may be called from several threads at the same time
+    thread_safe = False
+
+    # whether ``get()`` accepts a list of species, to be retrieved in one go
+    multi_species = False
+
+    # whether the driver can restrict downloads to a spatial subdomain, see
+    # CTMDriver's ``domain`` setting
+    supports_domain = False
+
+    # drivers with a higher priority are given transfer slots first, see
+    # msschem.transfer.TransferScheduler
+    priority = 0
+
+    # RetryPolicy of this driver, see retry_policy()
+    retry = None
+
     def clean_tempfiles(self, fns_temp):
         for fn in fns_temp:
             os.remove(fn)
 
+    def retry_policy(self):
+        """Return the RetryPolicy used for all transfers of this driver
+
+        Unless a policy has been passed as ``retry`` keyword argument, a
+        policy with default backoff and ``n_tries`` tries per file is used.
+
+        """
+        if self.retry is None:
+            self.retry = RetryPolicy(getattr(self, 'n_tries', 1))
+        return self.retry
+
+    def transfer(self):
+        """Context manager holding a transfer slot for this driver's host"""
+        return get_scheduler().transfer(self.hostname(), self.priority)
+
+    def close(self):
+        """Release all resources (e.g., connections) held by this driver"""
+        pass
+
+    def connection_stats(self):
+        """Return counts of connections opened and re-used, if applicable"""
+        return None
+
+    def hostname(self):
+        """Return the name of the server, or None for local files"""
+        return getattr(self, 'host', None)
+
+    def probe(self, species, fcinit, fcstart, fcend):
+        """Check cheaply whether data for ``species`` / ``fcinit`` exist
+
+        Probes don't download any data; they only list directories or ask
+        for headers.  They are used by ``msschem-dl --daemon`` to find out
+        when to start downloading.
+
+        Returns
+        -------
+        available : bool or None
+            ``None`` if the driver has no cheap way of telling
+
+        """
+        return None
+
 
 class FilesystemDownload(DownloadDriver):
 
+    thread_safe = True
+
     def clean_tempfiles(self, fns_temp):
         if not self.do_copy:
             return
         for fn in fns_temp:
             os.remove(fn)
 
-    def get(self, species, fcinit, fcstart, fcend, fn_out, n_tries=1):
+    def get(self, species, fcinit, fcstart, fcend, fn_out, n_tries=None):
         """Copy all files for a given species / init_time
 
         Parameters
@@ -174,19 +376,34 @@ class FilesystemDownload(DownloadDriver):
         if self.do_copy:
             for i, fn in enumerate(fsfiles):
                 fn_out = path + '_{:03d}'.format(i) + ext
-                i_try = 0
-                while i_try < n_tries:
-                    try:
-                        shutil.copy2(fn, fn_out)
-                        break
-                    except Exception:
-                        i_try += 1
-
+                try:
+                    self.retry_policy().call(self.copy_file, fn, fn_out,
+                                             n_tries=n_tries, describe=fn)
+                except Exception as err:
+                    raise DownloadFailed([(fn, err)])
                 outfiles.append(fn_out)
             return outfiles
         else:
             return fsfiles
 
+    def copy_file(self, fn, fn_out):
+        with self.transfer() as transfer:
+            shutil.copy2(fn, fn_out)
+            transfer.throttle(os.path.getsize(fn_out))
+
+    def probe(self, species, fcinit, fcstart, fcend):
+        if self.pre_filter_hook:
+            # the hook may create the files in the first place
+            return None
+        fullpath = self.path.format(species=species, fcinit=fcinit,
+                                    fcend=fcend)
+        try:
+            fsfiles = self.filter_files(os.listdir(fullpath), species,
+                                        fcinit, fcstart, fcend)
+        except (OSError, DataNotAvailable):
+            return False
+        return bool(fsfiles)
+
     def filter_files(self, fns, species, fcinit, fcstart, fcend):
         allfiles = {}
         pattern = self.fnpattern.format(fcinit=fcinit, species=species)
@@ -198,40 +415,93 @@ class FilesystemDownload(DownloadDriver):
         return result
 
     def __init__(self, path, fnpattern, n_tries=1, do_copy=False,
-                 pre_filter_hook=None):
+                 pre_filter_hook=None, priority=0, retry=None):
 
         self.path = path
         self.fnpattern = fnpattern
         self.n_tries = n_tries
         self.do_copy = do_copy
         self.pre_filter_hook = pre_filter_hook
+        self.priority = priority
+        self.retry = retry
+
+
+class _SFTPConnection(object):
+
+    def __init__(self, ssh, sftp):
+        self.ssh = ssh
+        self.sftp = sftp
 
 
 class SCPDownload(DownloadDriver):
 
-    def login(self):
-        # TODO: check if connection already exists
-        self._ssh.connect(self.host, self.port, self.username,
-                          self.password, key_filename=self.ssh_id,
-                          compress=True)
-        self._sshtransport = self._ssh.get_transport()
-        self.conn = paramiko.SFTPClient.from_transport(self._sshtransport)
+    thread_safe = True
 
-    def logout(self):
+    conn = None
+    _pooled = None
+
+    @property
+    def pool(self):
+        return get_pool(('sftp', self.host, self.port, self.username),
+                        self._connect, self._check, self._disconnect,
+                        self.max_connections)
+
+    def _connect(self):
+        ssh = paramiko.SSHClient()
+        ssh.load_system_host_keys()
+        if self.ssh_hostkey is not None:
+            ssh.load_host_keys(self.ssh_hostkey)
+        if self.ssh_unknown_hosts:
+            ssh.set_missing_host_key_policy(paramiko.WarningPolicy())
+        else:
+            ssh.set_missing_host_key_policy(paramiko.RejectPolicy())
+        ssh.connect(self.host, self.port, self.username,
+                    self.password, key_filename=self.ssh_id,
+                    compress=True)
+        sftp = paramiko.SFTPClient.from_transport(ssh.get_transport())
+        return _SFTPConnection(ssh, sftp)
+
+    @staticmethod
+    def _check(conn):
+        transport = conn.ssh.get_transport()
+        if transport is None or not transport.is_active():
+            return False
         try:
-            self.conn.close()
-        except:
-            pass
+            conn.sftp.stat('.')
+        except (IOError, EOFError, paramiko.SSHException):
+            return False
+        return True
+
+    @staticmethod
+    def _disconnect(conn):
         try:
-            self._sshtransport.close()
+            conn.sftp.close()
         except:
             pass
         try:
-            self._ssh.close()
+            conn.ssh.close()
         except:
             pass
 
-    def get(self, species, fcinit, fcstart, fcend, fn_out, n_tries=1):
+    def login(self):
+        if self.conn is not None:
+            return
+        self._pooled = self.pool.acquire()
+        self.conn = self._pooled.sftp
+
+    def logout(self):
+        if self._pooled is not None:
+            self.pool.release(self._pooled)
+        self._pooled = None
+        self.conn = None
+
+    def close(self):
+        self.pool.close()
+
+    def connection_stats(self):
+        return self.pool.stats()
+
+    def get(self, species, fcinit, fcstart, fcend, fn_out, n_tries=None):
         """Download all files for a given species / init_time
 
         Parameters
@@ -247,18 +517,22 @@ class SCPDownload(DownloadDriver):
             A list of all files which have been downloaded
 
         """
-        # open SFTP connection
-        self.login()
+        sftpdir = self.path.format(species=species, fcinit=fcinit,
+                                   fcend=fcend)
 
-        # change to correct directory
-        sftpdir = self.path.format(species=species, fcinit=fcinit, fcend=fcend)
-        try:
-            self.conn.chdir(sftpdir)
-        except IOError as err:
-            raise DataNotAvailable
+        # get an SFTP connection from the pool for listing the files
+        with self.pool.connection() as pooled:
+            conn = pooled.sftp
 
-        # get a list of all files to retrieve
-        sftpallfiles = self.conn.listdir()
+            # change to correct directory (relative to the login directory)
+            try:
+                conn.chdir(None)
+                conn.chdir(sftpdir)
+            except IOError as err:
+                raise DataNotAvailable
+
+            # get a list of all files to retrieve
+            sftpallfiles = conn.listdir()
         sftpfiles = self.filter_files(
                 sftpallfiles, species, fcinit, fcstart, fcend)
         if not sftpfiles:
@@ -271,21 +545,66 @@ class SCPDownload(DownloadDriver):
         outfiles = []
         for i, fn in enumerate(sftpfiles):
             fn_out = path + '_{:03d}'.format(i) + ext
-            i_try = 0
-            while i_try < n_tries:
-                try:
-                    self.conn.get(fn, fn_out)
-                    break
-                except Exception:
-                    i_try += 1
-
+            validators = {}
+
+            def retrieve():
+                # each try takes a connection from the pool; a failed one is
+                # closed, so a retry doesn't use a dead connection
+                with self.pool.connection() as pooled, \
+                        self.transfer() as transfer:
+                    conn = pooled.sftp
+                    conn.chdir(None)
+                    conn.chdir(sftpdir)
+                    self.retrieve(conn, fn, fn_out, validators, transfer)
+            try:
+                self.retry_policy().call(retrieve, n_tries=n_tries,
+                                         describe=fn)
+            except Exception as err:
+                raise DownloadFailed([(fn, err)])
             outfiles.append(fn_out)
 
-        # close SFTP connection
-        self.logout()
-
         return outfiles
 
+    @staticmethod
+    def retrieve(conn, fn, fn_out, validators, transfer=None):
+        """Retrieve ``fn`` over SFTP, continuing a partial ``fn_out``
+
+        ``validators`` maps remote filenames to their (size, mtime) from
+        the previous attempt.  A partial local file is only continued if the
+        remote file hasn't changed since.
+
+        """
+        st = conn.stat(fn)
+        current = (st.st_size, st.st_mtime)
+        offset = 0
+        if validators.get(fn) == current and os.path.isfile(fn_out):
+            offset = os.path.getsize(fn_out)
+        validators[fn] = current
+        with closing(conn.open(fn, 'rb')) as remote, \
+                open(fn_out, 'ab' if offset else 'wb') as local:
+            remote.seek(offset)
+            remote.prefetch(st.st_size)
+            copy_stream(remote, local, transfer)
+        if os.path.getsize(fn_out) != st.st_size:
+            raise IOError('Transfer of {} incomplete'.format(fn))
+
+    def probe(self, species, fcinit, fcstart, fcend):
+        sftpdir = self.path.format(species=species, fcinit=fcinit,
+                                   fcend=fcend)
+        try:
+            with self.pool.connection() as pooled:
+                conn = pooled.sftp
+                conn.chdir(None)
+                conn.chdir(sftpdir)
+                sftpallfiles = conn.listdir()
+        except IOError:
+            return False
+        try:
+            return bool(self.filter_files(sftpallfiles, species, fcinit,
+                                          fcstart, fcend))
+        except DataNotAvailable:
+            return False
+
     def filter_files(self, fns, species, fcinit, fcstart, fcend):
         allfiles = {}
         pattern = self.fnpattern.format(fcinit=fcinit, species=species)
@@ -298,7 +617,8 @@ class SCPDownload(DownloadDriver):
 
     def __init__(self, host, path, fnpattern, username=None, password=None,
                  port=22, ssh_id=None, ssh_hostkey=None,
-                 ssh_unknown_hosts=False, n_tries=1):
+                 ssh_unknown_hosts=False, n_tries=1, max_connections=None,
+                 priority=0, retry=None):
 
         self.log = logging.getLogger('msschem')
 
@@ -318,20 +638,18 @@ class SCPDownload(DownloadDriver):
             self.password = self.password.encode()
         self.port = port
         self.ssh_id = ssh_id
+        self.ssh_hostkey = ssh_hostkey
+        self.ssh_unknown_hosts = ssh_unknown_hosts
         self.n_tries = n_tries
-
-        self._ssh = paramiko.SSHClient()
-        self._ssh.load_system_host_keys()
-        if ssh_hostkey is not None:
-            self._ssh.load_host_keys(ssh_hostkey)
-        if ssh_unknown_hosts:
-            self._ssh.set_missing_host_key_policy(paramiko.WarningPolicy())
-        else:
-            self._ssh.set_missing_host_key_policy(paramiko.RejectPolicy())
+        self.max_connections = max_connections
+        self.priority = priority
+        self.retry = retry
 
 
 class FTPDownload(DownloadDriver):
 
+    thread_safe = True
+
     conn = None
 
     def filter_files(self, fns, species, fcinit, fcstart, fcend):
@@ -339,20 +657,52 @@ class FTPDownload(DownloadDriver):
         """
         raise NotImplementedError()
 
+    @property
+    def pool(self):
+        return get_pool(('ftp', self.ftpobj, self.host, self.username),
+                        self._connect, self._check, self._disconnect,
+                        self.max_connections)
+
+    def _connect(self):
+        conn = self.ftpobj(self.host)
+        conn.set_debuglevel(0)  # TODO make this configurable
+        conn.set_pasv(self.passive)
+        conn.login(self.username, self.password)
+        conn.initial_dir = conn.pwd()
+        return conn
+
+    @staticmethod
+    def _check(conn):
+        try:
+            conn.voidcmd('NOOP')
+        except FTP_ALL_ERRORS:
+            return False
+        return True
+
+    @staticmethod
+    def _disconnect(conn):
+        try:
+            conn.quit()
+        except FTP_ALL_ERRORS:
+            conn.close()
+
     def login(self):
-        if self.conn is not None:  # TODO better test for working connection
-            print('Connection already established')
+        if self.conn is not None:
             return
-        self.conn = self.ftpobj(self.host)
-        self.conn.set_debuglevel(0)  # TODO make this configurable
-        self.conn.set_pasv(self.passive)
-        self.conn.login(self.username, self.password)
+        self.conn = self.pool.acquire()
 
     def logout(self):
-        self.conn.close()
+        if self.conn is not None:
+            self.pool.release(self.conn)
         self.conn = None
 
-    def get(self, species, fcinit, fcstart, fcend, fn_out, n_tries=1):
+    def close(self):
+        self.pool.close()
+
+    def connection_stats(self):
+        return self.pool.stats()
+
+    def get(self, species, fcinit, fcstart, fcend, fn_out, n_tries=None):
         """Download all files for a given species / init_time
 
         Parameters
@@ -368,55 +718,200 @@ class FTPDownload(DownloadDriver):
             A list of all files which have been downloaded
 
         """
-        # open FTP connection
-        self.login()
-
-        # change to correct directory
         ftpdir = self.path.format(species=species, fcinit=fcinit, fcend=fcend)
-        try:
-            self.conn.cwd(ftpdir)
-        except FTP_ALL_ERRORS as err:
-            raise DataNotAvailable
 
         # get a list of all files to retrieve
-        ftpallfiles = self.conn.nlst()
+        with self.pool.connection() as conn:
+            self._chdir(conn, ftpdir)
+            ftpallfiles = conn.nlst()
         ftpfiles = self.filter_files(ftpallfiles, species, fcinit, fcstart,
                                      fcend)
 
         # prepare output filename construction
         path, ext = os.path.splitext(fn_out)
+        outfiles = [path + '_{:03d}'.format(i) + ext
+                    for i in range(len(ftpfiles))]
 
         # retrieve all files
-        outfiles = []
-        for i, fn in enumerate(ftpfiles):
-            fn_out = path + '_{:03d}'.format(i) + ext
-            i_try = 0
-            while i_try < n_tries:
-                try:
-                    with open(fn_out, 'wb') as fd:
-                        self.conn.retrbinary('RETR {}'.format(fn), fd.write)
-                    break
-                except FTP_ALL_ERRORS:
-                    i_try += 1
+        self.retrieve(ftpdir, list(zip(ftpfiles, outfiles)), n_tries)
 
-            outfiles.append(fn_out)
+        return outfiles
 
-        # close FTP connection
-        self.logout()
+    def probe(self, species, fcinit, fcstart, fcend):
+        ftpdir = self.path.format(species=species, fcinit=fcinit, fcend=fcend)
+        try:
+            with self.pool.connection() as conn:
+                self._chdir(conn, ftpdir)
+                ftpallfiles = conn.nlst()
+            return bool(self.filter_files(ftpallfiles, species, fcinit,
+                                          fcstart, fcend))
+        except DataNotAvailable:
+            return False
 
-        return outfiles
+    @staticmethod
+    def _chdir(conn, ftpdir):
+        try:
+            if not ftpdir.startswith('/'):
+                conn.cwd(conn.initial_dir)
+            conn.cwd(ftpdir)
+        except FTP_ALL_ERRORS as err:
+            raise DataNotAvailable
+
+    @staticmethod
+    def _remote_validator(conn, fn):
+        """Return (size, modification time) of a remote file
+
+        Either value is None if the server doesn't support the corresponding
+        command.
+
+        """
+        conn.voidcmd('TYPE I')
+        try:
+            size = conn.size(fn)
+        except FTP_ERROR_PERM:
+            size = None
+        try:
+            mtime = conn.sendcmd('MDTM {}'.format(fn))
+        except FTP_ERROR_PERM:
+            mtime = None
+        return size, mtime
+
+    def retrieve(self, ftpdir, files, n_tries=None):
+        """Retrieve ``(remote, local)`` filename pairs from ``ftpdir``
+
+        The files are fetched by ``n_connections`` worker threads, each using
+        its own connection from the pool.  A file whose transfer fails with a
+        transient error is put back at the end of the work queue, so that the
+        other files are not held up by it, and retried after the delay given
+        by the driver's retry policy (up to ``n_tries`` times).  Workers skip
+        files which aren't due yet, and only wait (without holding a
+        connection) when no file is due.  Retries
+        continue a partial file with ``REST`` if the remote file's size and
+        modification time are unchanged.
+
+        Raises
+        ------
+        DownloadFailed
+            If any file could not be retrieved
+
+        """
+        policy = self.retry_policy()
+        todo = Queue()
+        for fn, fn_out in files:
+            todo.put((fn, fn_out, 0, None, 0.))
+        errors = []
+        failed = []
+
+        def worker():
+            conn = None
+            # files put back because their retry isn't due yet
+            n_skipped = 0
+            min_wait = None
+            while not errors:
+                try:
+                    item = todo.get_nowait()
+                except Empty:
+                    break
+                fn, fn_out, n_failed, validator, not_before = item
+                wait = not_before - time.time()
+                if wait > 0:
+                    todo.put(item)
+                    n_skipped += 1
+                    min_wait = wait if min_wait is None else min(min_wait,
+                                                                 wait)
+                    if n_skipped < todo.qsize():
+                        continue
+                    # no file is due, don't hold the connection meanwhile
+                    if conn is not None:
+                        self.pool.release(conn)
+                        conn = None
+                    policy.sleep(min_wait)
+                    n_skipped, min_wait = 0, None
+                    continue
+                n_skipped, min_wait = 0, None
+                try:
+                    if conn is None:
+                        conn = self.pool.acquire()
+                        self._chdir(conn, ftpdir)
+                    offset = 0
+                    current = self._remote_validator(conn, fn)
+                    if (current == validator and current[0] is not None and
+                            os.path.isfile(fn_out)):
+                        offset = os.path.getsize(fn_out)
+                    validator = current
+                    with self.transfer() as transfer, \
+                            open(fn_out, 'ab' if offset else 'wb') as fd:
+                        def write(data):
+                            fd.write(data)
+                            transfer.throttle(len(data))
+                        conn.retrbinary('RETR {}'.format(fn), write,
+                                        rest=offset or None)
+                    if (validator[0] is not None and
+                            os.path.getsize(fn_out) != validator[0]):
+                        raise EOFError('Transfer of {} incomplete'.format(fn))
+                except FTP_ALL_ERRORS as err:
+                    if conn is not None:
+                        self.pool.release(conn, broken=True)
+                        conn = None
+                    n_failed += 1
+                    if policy.should_retry(err, n_failed, n_tries):
+                        delay = policy.get_delay(n_failed)
+                        self.log.info('Retrying {} in {:.1f} s (try {} '
+                                      'failed: {})'.format(fn, delay,
+                                                           n_failed, err))
+                        todo.put((fn, fn_out, n_failed, validator,
+                                  time.time() + delay))
+                    else:
+                        self.log.warning('Retrieving {} failed: {}'.format(
+                                fn, err))
+                        failed.append((fn, err))
+                except Exception as err:
+                    errors.append(err)
+            if conn is not None:
+                self.pool.release(conn, broken=bool(errors))
+
+        n_workers = max(1, min(self.n_connections, len(files)))
+        if n_workers == 1:
+            worker()
+        else:
+            threads = [threading.Thread(target=worker)
+                       for _ in range(n_workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+        if failed:
+            raise DownloadFailed(failed)
 
     def __init__(self, host, passive=True, username=None, password=None,
-                 n_tries=1):
+                 n_tries=1, max_connections=None, n_connections=1,
+                 priority=0, retry=None):
+        self.log = logging.getLogger('msschem')
         self.host = host
         self.passive = passive
         self.username = username
         self.password = password
         self.n_tries = n_tries
+        self.max_connections = max_connections
+        self.n_connections = n_connections
+        self.priority = priority
+        self.retry = retry
 
 
 class HTTPDownload(DownloadDriver):
 
+    thread_safe = True
+
+    # 'sync' downloads one URL after the other with urlopen, 'async' fetches
+    # all URLs concurrently using an AsyncHTTPEngine
+    engine = 'sync'
+    # maximum number of simultaneous connections per host ('async' only)
+    limit_per_host = 4
+
+    _engine = None
+
     def construct_urls(self, params):
         raise NotImplementedError(
                 '"construct_urls()" must be implemented for the "{}" class'
@@ -427,34 +922,131 @@ class HTTPDownload(DownloadDriver):
         self.n_tries = n_tries
         for k, v in kwargs.items():
             setattr(self, k, v)
+        if self.engine not in ('sync', 'async'):
+            raise ValueError('Unknown download engine {}'.format(self.engine))
+        if self.engine == 'async' and not _AIOHTTP:
+            raise ImportError('Cannot import aiohttp, which is needed for '
+                              'the async download engine')
+        self._engine_lock = threading.Lock()
+
+    def hostname(self):
+        urlbase = getattr(self, 'urlbase', None)
+        if urlbase is None:
+            return None
+        return urlparse(urlbase).hostname
+
+    def async_engine(self):
+        """Return the AsyncHTTPEngine shared by all downloads of this driver"""
+        with self._engine_lock:
+            if self._engine is None:
+                self._engine = AsyncHTTPEngine(
+                        limit_per_host=self.limit_per_host)
+            return self._engine
+
+    def close(self):
+        with self._engine_lock:
+            if self._engine is not None:
+                self._engine.close()
+                self._engine = None
 
     @staticmethod
-    def download_file(url, fn, n_tries=1):
+    def download_file(url, fn, n_tries=None, slot=None, retry=None):
+        """Download ``url`` to ``fn``, retrying transient errors
+
+        ``retry`` is the RetryPolicy to use; by default, one with ``n_tries``
+        tries.  Retries continue the partial file with a Range request.
+        If-Range makes the server send the complete file instead if it has
+        changed in the meantime.
+
+        ``slot`` is a callable returning a context manager which holds a
+        transfer slot (see :meth:`DownloadDriver.transfer`).  It is entered
+        for each attempt, so that the slot is free while waiting to retry.
+
+        """
         # download recipe from http://stackoverflow.com/a/7244263
-        # retry recipe from https://stackoverflow.com/a/567645
-        i = 0
-        while i < n_tries:
-            try:
-                with closing(urlopen(url)) as resp, open(os.path.expanduser(fn), 'wb') as out:
-                    shutil.copyfileobj(resp, out)
-                break
-            except http_client.IncompleteRead:
-                i += 1
+        fn = os.path.expanduser(fn)
+        state = dict(validator=None, size=None)
+
+        def attempt():
+            if slot is None:
+                return fetch(None)
+            with slot() as transfer:
+                return fetch(transfer)
+
+        def fetch(transfer):
+            req = Request(url)
+            offset = 0
+            if state['validator'] is not None and os.path.isfile(fn):
+                offset = os.path.getsize(fn)
+                req.add_header('Range', 'bytes={}-'.format(offset))
+                req.add_header('If-Range', state['validator'])
+            with closing(urlopen(req)) as resp:
+                status = resp.getcode()
+                if status != 206:
+                    offset = 0
+                total = http_total_size(resp.info(), status)
+                if offset and total != state['size']:
+                    # upstream file has changed, start from scratch
+                    state['validator'] = None
+                    raise http_client.IncompleteRead(b'')
+                state['validator'] = http_validator(resp.info())
+                state['size'] = total
+                with open(fn, 'ab' if offset else 'wb') as out:
+                    copy_stream(resp, out, transfer)
+            if (state['size'] is not None and
+                    os.path.getsize(fn) != state['size']):
+                raise http_client.IncompleteRead(b'')
+
+        if retry is None:
+            retry = RetryPolicy(n_tries or 1)
+        retry.call(attempt, n_tries=n_tries, describe=url)
 
-    def get(self, species, fcinit, fcstart, fcend, fn_out, n_tries=1):
+    @staticmethod
+    def head(url):
+        """Return the HTTP status code of a HEAD request for ``url``"""
+        req = Request(url)
+        req.get_method = lambda: 'HEAD'
+        try:
+            with closing(urlopen(req)) as resp:
+                return resp.getcode()
+        except HTTPError as err:
+            return err.code
+
+    def probe(self, species, fcinit, fcstart, fcend):
+        urls = self.construct_urls(dict(species=species, fcinit=fcinit,
+                                        fcstart=fcstart, fcend=fcend),
+                                   'probe.nc')
+        for url, _ in urls:
+            status = self.head(url)
+            if status == 404:
+                return False
+            elif not 200 <= status < 300:
+                # e.g., 405 if the server doesn't allow HEAD requests
+                return None
+        return True
+
+    def get(self, species, fcinit, fcstart, fcend, fn_out, n_tries=None):
         urls = self.construct_urls(dict(species=species, fcinit=fcinit,
                                         fcstart=fcstart, fcend=fcend),
                                    os.path.expanduser(fn_out))
+        if self.engine == 'async':
+            return self.async_engine().fetch(urls, n_tries=n_tries,
+                                             host=self.hostname(),
+                                             priority=self.priority,
+                                             retry=self.retry_policy())
         fns = []
         for url, fn in urls:
             try:
-                self.download_file(url, fn, n_tries=n_tries)
+                self.download_file(url, fn, n_tries=n_tries,
+                                   slot=self.transfer,
+                                   retry=self.retry_policy())
                 fns.append(fn)
             except HTTPError as err:
                 if err.code == 404:
                     raise DataNotAvailable
-                else:
-                    raise
+                raise DownloadFailed([(url, err)])
+            except Exception as err:
+                raise DownloadFailed([(url, err)])
         return fns
 
 
@@ -532,10 +1124,85 @@ class SilamDownload(HTTPDownload):
                  'timeStride': '1', 'vertStride': '1',
                  'addLatLon': 'true', 'accept': 'netcdf'}
 
+    # time step of the forecast data
+    fcstep = datetime.timedelta(hours=1)
+
+    # number of time segments to split each request into
+    n_segments = 1
+
+    multi_species = True
+
+    supports_domain = True
+
+    # spatial subdomain, a dict with the keys ``lat`` (south, north), ``lon``
+    # (west, east), and optionally ``stride`` and ``vert_stride``
+    domain = None
+
+    def split_time_range(self, fcstart, fcend):
+        """Split ``fcstart .. fcend`` into ``n_segments`` contiguous ranges
+
+        Returns
+        -------
+        ranges : list of tuple
+            ``(start, end)`` pairs; both ends are inclusive.
+
+        """
+        nt = int((fcend - fcstart).total_seconds() //
+                 self.fcstep.total_seconds()) + 1
+        n = max(1, min(self.n_segments, nt))
+        ranges = []
+        start = 0
+        for i in range(n):
+            length = nt // n + (1 if i < nt % n else 0)
+            ranges.append((fcstart + start * self.fcstep,
+                           fcstart + (start + length - 1) * self.fcstep))
+            start += length
+        return ranges
+
+    def domain_urlparams(self):
+        """Return the NCSS parameters restricting the request to ``domain``"""
+        if not self.domain:
+            return {}
+        south, north = self.domain['lat']
+        west, east = self.domain['lon']
+        return {'north': str(north), 'south': str(south),
+                'east': str(east), 'west': str(west),
+                'horizStride': str(self.domain.get('stride', 1)),
+                'vertStride': str(self.domain.get('vert_stride', 1))}
+
+    def encode_urlparams(self, params):
+        """Encode the query string; ``params['species']`` may be a list"""
+        urlparams = dict((k, v.format(**params))
+                         for k, v in self.urlparams.items() if k != 'var')
+        subset = self.domain_urlparams()
+        if subset:
+            urlparams.pop('disableLLSubset')
+            urlparams.update(subset)
+        urlparams = sorted(urlparams.items())
+        # NCSS accepts several 'var' parameters in one request
+        if isinstance(params['species'], (list, tuple)):
+            species = params['species']
+        else:
+            species = [params['species']]
+        urlparams += [('var', self.urlparams['var'].format(species=sp))
+                      for sp in species]
+        return urlencode(urlparams)
+
     def construct_urls(self, params, fn_out):
-        urlparams = {k: v.format(**params) for k, v in self.urlparams.items()}
         urlbase = self.urlbase.format(**params)
-        return [(urlbase + '?' + urlencode(urlparams), fn_out)]
+        if self.n_segments <= 1:
+            return [(urlbase + '?' + self.encode_urlparams(params), fn_out)]
+
+        # one request per time segment; the files are numbered in time order
+        # so that they can be aggregated along the time dimension
+        path, ext = os.path.splitext(fn_out)
+        urls = []
+        for i, (start, end) in enumerate(self.split_time_range(
+                params['fcstart'], params['fcend'])):
+            segparams = dict(params, fcstart=start, fcend=end)
+            urls.append((urlbase + '?' + self.encode_urlparams(segparams),
+                         path + '_{:03d}'.format(i) + ext))
+        return urls
 
 
 class CAMSGlobDownload(FTPDownload):
@@ -1,7 +1,92 @@
+import hashlib
+import json
 import os
+import tempfile
+
+
+# number of bytes at the start and at the end of a file which are hashed for
+# its fingerprint
+FINGERPRINT_BYTES = 1 << 16
 
 
 # from https://stackoverflow.com/a/1160227
 def touch(fname, times=None):
     with open(fname, 'a'):
         os.utime(fname, times)
+
+
+def atomic_write_json(fname, obj):
+    """Write ``obj`` as JSON to ``fname``, atomically
+
+    The data are written to a temporary file in the same directory, which is
+    then renamed to ``fname``.  Readers therefore see either the old or the
+    new file, but never a partially written one.
+
+    """
+    dirname = os.path.dirname(os.path.abspath(fname))
+    fd, fn_temp = tempfile.mkstemp(dir=dirname, prefix='.tmp_')
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(obj, fh, indent=1, sort_keys=True)
+            fh.flush()
+            os.fsync(fh.fileno())
+        # os.rename doesn't overwrite existing files on Windows
+        getattr(os, 'replace', os.rename)(fn_temp, fname)
+    except Exception:
+        if os.path.isfile(fn_temp):
+            os.remove(fn_temp)
+        raise
+
+
+def read_json(fname):
+    """Return the contents of JSON file ``fname``, or None if not readable"""
+    try:
+        with open(fname) as fh:
+            return json.load(fh)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _hash_file(sha, fname, size):
+    with open(fname, 'rb') as fh:
+        sha.update(fh.read(FINGERPRINT_BYTES))
+        if size > FINGERPRINT_BYTES:
+            fh.seek(max(FINGERPRINT_BYTES, size - FINGERPRINT_BYTES))
+            sha.update(fh.read(FINGERPRINT_BYTES))
+
+
+def fingerprint(path):
+    """Return a fingerprint of file (or directory tree) ``path``
+
+    The fingerprint is built from size and modification time, and a SHA-1
+    hash of the first and last ``FINGERPRINT_BYTES`` of the file.  This is
+    cheap even for large files, and changes whenever a file is rewritten or
+    truncated.  For a directory (like a Zarr store), all files below it are
+    included.
+
+    Returns
+    -------
+    fingerprint : dict or None
+        ``None`` if ``path`` doesn't exist
+
+    """
+    if os.path.isfile(path):
+        size = os.path.getsize(path)
+        sha = hashlib.sha1()
+        _hash_file(sha, path, size)
+        return dict(size=size, mtime=os.path.getmtime(path),
+                    sha1=sha.hexdigest())
+    elif os.path.isdir(path):
+        total = 0
+        sha = hashlib.sha1()
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for fn in sorted(filenames):
+                fn_full = os.path.join(dirpath, fn)
+                size = os.path.getsize(fn_full)
+                total += size
+                sha.update('{} {} {!r}\n'.format(
+                        os.path.relpath(fn_full, path), size,
+                        os.path.getmtime(fn_full)).encode('utf-8'))
+        return dict(size=total, sha1=sha.hexdigest())
+    return None
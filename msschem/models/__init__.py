@@ -5,28 +5,73 @@ import copy
 import datetime
 import glob
 import logging
+import multiprocessing
 import os, os.path
 import shutil
 import tempfile
+import threading
 
-from netCDF4 import Dataset, MFDataset, date2num, num2date
+try:  # Py2
+    from Queue import Queue, Empty
+except ImportError:  # Py3
+    from queue import Queue, Empty
+
+import netCDF4
+from netCDF4 import Dataset, date2num, num2date
 import numpy as np
 
+from ..aggregate import AggregatedDataset
+
+try:
+    from ..zarrstore import ZarrDataset, ZarrVariable, write_region
+    _ZARR = True
+except ImportError:
+    _ZARR = False
+
 try:
-    from nco import Nco
-    _NCO = True
+    from ..directchunk import DirectChunkWriter
+    _H5PY = True
 except ImportError:
-    _NCO = False
+    _H5PY = False
 
 # from .version import __version__
 
 from ..species import species_names
-from ..fileutils import touch
+from ..fileutils import atomic_write_json, fingerprint, read_json, touch
+from ..compression import (chunk_cache_size, chunk_shape, filter_kwargs,
+                           get_profile, CHUNK_POLICIES)
+from ..transfer import get_scheduler
 from .. import DataNotAvailable
 
 #__all__ = ['CTMDriver', 'CAMSGlobDriver']
 
 
+# netCDF-4 data types which don't exist in NETCDF4_CLASSIC files, and the
+# classic types used for them in the output files
+_CLASSIC_DTYPES = {'u1': 'i2', 'u2': 'i4', 'u4': 'f8', 'i8': 'f8', 'u8': 'f8'}
+
+# number of int16 quantisation steps used for packed output; -32768 is the
+# fill value, and one step on each side is kept as a margin for rounding
+# errors of the float32 packing attributes
+_PACKED_STEPS = 2**16 - 4
+_PACKED_FILL = np.int16(-32768)
+
+
+def classic_dtype(dtype):
+    """Return a NETCDF4_CLASSIC compatible type which can hold ``dtype``"""
+    dtype = np.dtype(dtype)
+    return np.dtype(_CLASSIC_DTYPES.get(
+            '{}{}'.format(dtype.kind, dtype.itemsize), dtype))
+
+
+def classic_attr(value):
+    """Return attribute ``value`` converted to a NETCDF4_CLASSIC type"""
+    if isinstance(value, (np.ndarray, np.generic)) and \
+            value.dtype.kind in 'iuf':
+        return np.asarray(value).astype(classic_dtype(value.dtype))
+    return value
+
+
 """**************
 msschem.models
 **************
@@ -78,7 +123,47 @@ class CTMDriver(object):
     datavar_attrs_no_copy = ['_FillValue', 'add_offset', 'scale_factor']
     dimensions_no_copy = []
 
-    need_to_convert_to_nc4c = False
+    # compression profile of the output files (see msschem.compression), and
+    # profiles for individual variables
+    compression = 'default'
+    compression_vars = {}
+
+    # chunking policy of the data variables (see msschem.compression); None
+    # keeps the netCDF library's default chunking
+    chunking = None
+
+    # store the data variable as int16 with scale_factor and add_offset
+    packing = False
+
+    # precision trimming of the data variables before compression; an int
+    # for all species, or a dict {species: int}.  significant_digits needs
+    # netCDF-C 4.9 and netCDF4 1.6
+    significant_digits = None
+    least_significant_digit = None
+    quantize_mode = 'GranularBitRound'
+
+    # source variable of the AIR_PRESSURE species from which the air pressure
+    # is derived; it is never trimmed.  None if the air pressure is copied
+    surface_pressure = None
+
+    # output format(s): 'netcdf' (NETCDF4_CLASSIC), 'zarr', or a list of both
+    output_format = 'netcdf'
+
+    # convert the time axis of the output to hours since fcinit; if False,
+    # the time values are assumed to be hours since fcinit already and only
+    # the units are set
+    rereference_time = True
+
+    # legacy hook: drivers may define a method ``fix_dataset(fn_out, species,
+    # fcinit)`` which modifies the output file after it has been written.
+    # This costs a second pass over the file; use the transform hooks
+    # (:meth:`transform_attrs`, :meth:`transform_data` and
+    # :meth:`derived_variables`) instead.
+    fix_dataset = None
+
+    # horizontal grid as {'lat': (first, step, n), 'lon': (first, step, n)},
+    # needed to restrict downloads to a subdomain
+    grid = None
 
     def __init__(self, cfg):
         self.log = logging.getLogger('msschem')
@@ -96,7 +181,69 @@ class CTMDriver(object):
         if ('AIR_PRESSURE' in self.species.keys() and
                 'AIR_PRESSURE' not in cfg.get('species', [])):
             cfg['species'] = cfg['species'] + ['AIR_PRESSURE']
+        if cfg.get('copy_buffer') is None:
+            cfg['copy_buffer'] = 256
+        if cfg.get('compression') is None:
+            cfg['compression'] = self.compression
+        compression_vars = dict(self.compression_vars)
+        compression_vars.update(cfg.get('compression_vars') or {})
+        cfg['compression_vars'] = compression_vars
+        # fail early on unknown profiles
+        for profile in [cfg['compression']] + list(compression_vars.values()):
+            get_profile(profile)
+        if cfg.get('chunking') is None:
+            cfg['chunking'] = self.chunking
+        if cfg.get('packing') is None:
+            cfg['packing'] = self.packing
+        for key in ['significant_digits', 'least_significant_digit',
+                    'quantize_mode', 'output_format']:
+            if cfg.get(key) is None:
+                cfg[key] = getattr(self, key)
+        if not isinstance(cfg['output_format'], (list, tuple)):
+            cfg['output_format'] = [cfg['output_format']]
+        for fmt in cfg['output_format']:
+            if fmt not in ['netcdf', 'zarr']:
+                raise ValueError('Unknown output format `{}`'.format(fmt))
+        if 'zarr' in cfg['output_format']:
+            if not _ZARR:
+                raise ValueError('Zarr output needs the zarr library')
+            if self.fix_dataset is not None:
+                raise ValueError('Zarr output is not supported for drivers '
+                                 'implementing fix_dataset')
+        if cfg.get('output_workers') is None:
+            cfg['output_workers'] = 1
+        if cfg.get('compression_workers') is None:
+            cfg['compression_workers'] = 1
+        if cfg['compression_workers'] > 1 and not _H5PY:
+            self.log.warning('Parallel compression needs h5py, compressing '
+                             'in one process')
+            cfg['compression_workers'] = 1
+        if (cfg['chunking'] is not None and
+                cfg['chunking'] not in CHUNK_POLICIES):
+            raise ValueError('Unknown chunking policy `{}`'.format(
+                    cfg['chunking']))
+        if cfg.get('pipeline') is True:
+            cfg['pipeline'] = {}
+        if cfg.get('pipeline') is not None:
+            cfg['pipeline'].setdefault('download', 1)
+            cfg['pipeline'].setdefault('queue', 2)
+        if cfg.get('domain'):
+            if self.grid is None or not cfg['dldriver'].supports_domain:
+                raise ValueError('Model `{}` does not support spatial '
+                                 'subsetting'.format(cfg.get('name')))
+            cfg['dldriver'].domain = cfg['domain']
         self.cfg = cfg
+        # libnetcdf / HDF5 are not thread-safe, so all netCDF file access
+        # must be serialized when running in pipelined mode
+        self._nc_lock = threading.RLock()
+        # process pool shared by all output files, see worker_pool()
+        self._pool = None
+        self._pool_warned = False
+        # process pool for writing Zarr chunks, see write_dataset()
+        self._write_pool = None
+        self._pending_writes = []
+        # parallel chunk compression for netCDF output, see write_dataset()
+        self._direct = None
 
     def check_day(self, day):
         if isinstance(day, datetime.datetime):
@@ -114,29 +261,68 @@ class CTMDriver(object):
         dimsize = copy.deepcopy(self.dims)
         return OrderedDict(dimsize)
 
-    def convert_dl_to_nc4c(self, fns):
-        self.log.debug('Converting to NETCDF4_CLASSIC ...')
-        if not _NCO:
-            self.log.error(
-                    'Cannot convert to NETCDF4_CLASSIC: nco is not installed')
-            raise ImportError('cannot import nco library')
-        nco = Nco()
-        fns_new = []
-        for fn in fns:
-            fn_new = tempfile.mktemp(suffix='.nc', dir=self.cfg['temppath'])
-            nco.ncks(input=fn, output=fn_new, options=['-O', '-7'])
-            fns_new.append(fn_new)
-            self.cfg['dldriver'].clean_tempfiles([fn])
-        self.log.debug('... done.')
-        return fns_new
+    def subset_dims(self, dimsize, nc, var):
+        """Adjust expected dimension sizes to the subdomain ``cfg['domain']``
+
+        Which grid points on the edges of the bounding box the server
+        includes, and which point a stride starts at, depends on the server.
+        So the horizontal sizes are taken from the coordinates of the
+        downloaded variable ``var`` in ``nc``, after checking them with
+        :meth:`check_domain`.
+
+        """
+        domain = self.cfg.get('domain')
+        if not domain:
+            return dimsize
+        stride = domain.get('stride', 1)
+        dims = list(dimsize)
+        for dim, key in [('y', 'lat'), ('x', 'lon')]:
+            coords = nc.variables[var.dimensions[dims.index(dim)]][:]
+            self.check_domain(key, coords, domain[key], stride)
+            dimsize[dim] = len(coords)
+        if 'z' in dimsize:
+            dimsize['z'] = -(-dimsize['z'] // domain.get('vert_stride', 1))
+        return dimsize
+
+    def check_domain(self, key, coords, bounds, stride=1):
+        """Check the downloaded coordinates ``coords`` against the subdomain
+
+        The coordinates must be points of the model's nominal ``grid``,
+        ``stride`` grid points apart, which cover the bounding box
+        ``bounds`` (clipped to the grid) up to one stride on each side, and
+        may reach one grid point beyond it.
+
+        """
+        first, step, n = self.grid[key]
+        step = abs(step)
+        spacing = step * stride
+        eps = step * 1e-2
+        grid = first + step * np.arange(n)
+        lower = max(bounds[0], grid.min())
+        upper = min(bounds[1], grid.max())
+        coords = np.sort(np.asarray(coords, dtype=np.float64))
+        index = (coords - first) / step
+        if (not len(coords) or
+                np.any(np.abs(index - np.round(index)) * step > eps) or
+                np.any(np.abs(np.diff(coords) - spacing) > eps) or
+                coords[0] < lower - step - eps or
+                coords[0] > lower + spacing + eps or
+                coords[-1] > upper + step + eps or
+                coords[-1] < upper - spacing - eps):
+            raise ValueError(
+                    'Downloaded file(s) don\'t match the domain {}={}: '
+                    '{} points from {} to {}'.format(
+                        key, tuple(bounds), len(coords),
+                        coords[0] if len(coords) else None,
+                        coords[-1] if len(coords) else None))
 
     def check_download(self, fns, species, fcinit, fcstart, fcend, nt=None):
-        dimsize = self.get_dims(species)
         nt = self.get_nt(fcinit, fcstart, fcend)
-        dimsize['t'] = nt
         varname = self.species[species]['varname']
-        with MFDataset(fns, 'r', aggdim=self.aggdim) as nc:
+        with self.open_source(fns) as nc:
             var = nc.variables[varname]
+            dimsize = self.subset_dims(self.get_dims(species), nc, var)
+            dimsize['t'] = nt
             for i, (k, v) in enumerate(dimsize.items()):
                 if var.shape[i] != v:
                     raise ValueError('Downloaded file(s) has wrong dimension'
@@ -164,25 +350,121 @@ class CTMDriver(object):
         fcstart = self.get_fctime('start', fcinit, fcstart)
         fcend = self.get_fctime('end', fcinit, fcend)
 
+        fns = self.fetch(self.species[species]['urlname'], fcinit, fcstart,
+                         fcend)
+        with self._nc_lock:
+            self.check_download(fns, species, fcinit, fcstart, fcend)
+        return fns
+
+    def fetch(self, urlname, fcinit, fcstart, fcend):
+        """Retrieve the source files for ``urlname`` with the download driver
+
+        The files are not checked.  They are read as they are, whatever
+        their netCDF format (see :meth:`open_source`).
+
+        """
         fn_temp = tempfile.mktemp(suffix='.nc', dir=self.cfg['temppath'])
-        # TODO check if we need to download force_dl = self.cfg['force'])
-        fns = self.cfg['dldriver'].get(self.species[species]['urlname'],
-                                       fcinit, fcstart, fcend, fn_temp)
-        if self.need_to_convert_to_nc4c:
-            fns = self.convert_dl_to_nc4c(fns)
+        return self.cfg['dldriver'].get(urlname, fcinit, fcstart, fcend,
+                                        fn_temp)
+
+    def checkpoint_filename(self, species, fcinit):
+        """Return the filename of the completion record of ``species``"""
+        target_dir = os.path.dirname(self.output_filename(species, fcinit))
+        return os.path.join(target_dir,
+                            'msschem.{}.done'.format(species.lower()))
+
+    def output_fingerprints(self, species, fcinit):
+        """Return the fingerprints of all output files of ``species``"""
+        return OrderedDict(
+                (os.path.basename(fn), fingerprint(fn))
+                for fn in [self.output_filename(species, fcinit, fmt)
+                           for fmt in self.cfg['output_format']])
+
+    def write_checkpoint(self, species, fcinit):
+        """Record that ``species`` has been completely processed
+
+        The record contains a fingerprint of every output file (see
+        :func:`msschem.fileutils.fingerprint`), and is written atomically, so
+        that a run which is interrupted never leaves a record behind which
+        claims an incomplete output file.
 
-        self.check_download(fns, species, fcinit, fcstart, fcend)
-        return fns
+        """
+        record = dict(species=species,
+                      fcinit='{:%Y-%m-%dT%H:%M:%S}'.format(fcinit),
+                      outputs=self.output_fingerprints(species, fcinit))
+        atomic_write_json(self.checkpoint_filename(species, fcinit), record)
+
+    def is_complete(self, species, fcinit):
+        """Check if ``species`` has already been processed for ``fcinit``
+
+        A species is complete if its completion record exists and the
+        fingerprints of its output files still match the record.  Output
+        files which have been deleted or modified since are therefore
+        re-created.
+
+        """
+        record = read_json(self.checkpoint_filename(species, fcinit))
+        if record is None:
+            return False
+        outputs = self.output_fingerprints(species, fcinit)
+        if record.get('outputs') != outputs:
+            self.log.info('{}/{:%Y%m%d}:{} output has changed since it was '
+                          'written, rebuilding'.format(self.name, fcinit,
+                                                       species))
+            return False
+        return True
+
+    def probe(self, fcinit):
+        """Check cheaply whether source data for ``fcinit`` are available
+
+        The download driver is asked about the first species which hasn't
+        been processed yet (see :meth:`DownloadDriver.probe`), so that a
+        partially processed init time is probed for its missing data.
+
+        Returns
+        -------
+        available : bool or None
+            ``None`` if the download driver can't tell without downloading
+
+        """
+        fcinit = self.check_day(fcinit)
+        pending = [species for species in self.cfg['species']
+                   if not self.is_complete(species, fcinit)]
+        if not pending:
+            return True
+        dldriver = self.cfg['dldriver']
+        if self.cfg.get('shared_source') and not dldriver.multi_species:
+            urlname = None
+        else:
+            urlname = self.species[pending[0]]['urlname']
+        return dldriver.probe(urlname, fcinit,
+                              self.get_fctime('start', fcinit, None),
+                              self.get_fctime('end', fcinit, None))
 
     def run(self, day):
-        """Download all configured data for one day"""
+        """Download all configured data for one day
+
+        After each species, a completion record is written (see
+        :meth:`write_checkpoint`), so that a run which fails or is interrupted
+        continues with the missing species the next time.  With
+        ``cfg['force']``, all species are processed again, regardless of
+        existing output.
+
+        Returns
+        -------
+        done : bool
+            ``True`` if all data for this day have been processed,
+            ``False`` if data are not available yet or if another process is
+            working on this day.
+
+        """
         self.log.info('Starting {}: init_time {:%Y-%m-%dT%H:%M:%S}'.format(
                 self.name, day))
         all_species = self.cfg['species']
 
         if not all_species:
             self.log.info('    ... no species requested')
-            return
+            return True
 
         target_dir = os.path.dirname(self.output_filename(all_species[0], day))
         lockfile = os.path.join(target_dir, 'msschem.lock')
@@ -192,39 +474,113 @@ class CTMDriver(object):
             os.makedirs(target_dir)
 
         # check if donefile exists
-        if os.path.isfile(donefile):
-            # TODO add option to re-download
+        if os.path.isfile(donefile) and not self.cfg['force']:
             self.log.info('{}/{:%Y%m%d} already downloaded.'.format(self.name,
                                                                     day))
-            return
+            return True
 
         # check if lockfile exists
         if os.path.isfile(lockfile):
             self.log.info('{}/{:%Y%m%d} lockfile exists. Aborting.'
                           ''.format(self.name, day))
-            return
+            return False
 
         # create lockfile
         touch(lockfile)
 
-        # TODO add option to download in parallel, only for http
         # start processing this model
-        for species in all_species:
-            try:
-                self.get(species, day)
-            except DataNotAvailable:
-                self.log.warning('No data available {}/{:%Y%m%d}'.format(
+        try:
+            self.cfg['dldriver'].retry_policy().reset()
+            if self.cfg['force']:
+                if os.path.isfile(donefile):
+                    os.remove(donefile)
+                todo = list(all_species)
+            else:
+                todo = [species for species in all_species
+                        if not self.is_complete(species, day)]
+                if len(todo) < len(all_species):
+                    self.log.info('{}/{:%Y%m%d} resuming, {} of {} species '
+                                  'already done'.format(
+                                          self.name, day,
+                                          len(all_species) - len(todo),
+                                          len(all_species)))
+            if not todo:
+                self.log.info('{}/{:%Y%m%d} all species already done'.format(
                         self.name, day))
-                if os.path.isfile(lockfile):
-                    os.remove(lockfile)
-                return
-
-        if os.path.isfile(lockfile):
-            os.remove(lockfile)
+            elif self.cfg.get('shared_source'):
+                self.get_shared(todo, day)
+            elif self.cfg.get('pipeline') is not None:
+                self.get_pipelined(todo, day)
+            else:
+                for species in todo:
+                    self.get(species, day)
+        except DataNotAvailable:
+            self.log.warning('No data available {}/{:%Y%m%d}'.format(
+                    self.name, day))
+            return False
+        finally:
+            self.close_connections()
+            if os.path.isfile(lockfile):
+                os.remove(lockfile)
 
         touch(donefile)
         self.log.info('Finished {}: init_time {:%Y-%m-%dT%H:%M:%S}'.format(
                 self.name, day))
+        return True
+
+    def close_connections(self):
+        """Log connection statistics and close the download driver
+
+        With ``cfg['keep_connections']``, connections are left open so that
+        they can be re-used by other models (or days) using the same server;
+        they are then closed at the end of the ``msschem-dl`` run.
+
+        """
+        dldriver = self.cfg['dldriver']
+        stats = dldriver.connection_stats()
+        if stats is not None:
+            self.log.debug('{}: {} connection(s) opened, {} re-used'.format(
+                    self.name, stats['opened'], stats['reused']))
+        stats = get_scheduler().stats(dldriver.hostname())
+        if stats is not None:
+            self.log.debug('{}: {} transfer(s) from {} so far, {:.1f} MB, '
+                           '{:.1f} s waiting for a slot, {:.1f} s '
+                           'transferring'.format(
+                                   self.name, stats['transfers'],
+                                   dldriver.hostname() or 'local disk',
+                                   stats['bytes'] / 1e6, stats['wait'],
+                                   stats['transfer']))
+        if not self.cfg.get('keep_connections'):
+            dldriver.close()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def worker_pool(self):
+        """Return the process pool for writing output, or ``None``
+
+        The pool of ``max(output_workers, compression_workers)`` processes is
+        created on first use and shared by all output files, until
+        :meth:`close_connections`.  Daemonic processes, like the workers of
+        ``msschem-dl --jobs``, can't have children; output is written
+        serially there.
+
+        """
+        if self._pool is not None:
+            return self._pool
+        n_workers = max(self.cfg['output_workers'],
+                        self.cfg['compression_workers'])
+        if n_workers <= 1:
+            return None
+        if multiprocessing.current_process().daemon:
+            if not self._pool_warned:
+                self.log.warning('{}: writing output serially in worker '
+                                 'process'.format(self.name))
+                self._pool_warned = True
+            return None
+        self._pool = multiprocessing.Pool(n_workers)
+        return self._pool
 
     def prune(self, n_days):
         """Clean up old files downloaded for this model"""
@@ -256,35 +612,161 @@ class CTMDriver(object):
                 self.name, fcinit, species))
         fns_temp = self.download(species, fcinit, fcend, fcstart)
         self.postprocess(species, fcinit, fns_temp)
+        self.write_checkpoint(species, fcinit)
         self.cfg['dldriver'].clean_tempfiles(fns_temp)
         self.log.debug('Finished {}/{:%Y%m%d}:{}'.format(
                 self.name, fcinit, species))
 
-    def output_filename(self, species, fcinit):
+    def get_shared(self, all_species, fcinit, fcend=None, fcstart=None):
+        """Process several species from one shared set of source files
+
+        This is used when ``cfg['shared_source']`` is set.  The source is
+        retrieved (and converted) only once per init time, and every species
+        is extracted from this one local copy.
+
+        If the download driver can retrieve several species at once (like
+        SILAM's NetCDF Subset Service), it is asked for all species in one
+        request.  Otherwise, the driver must deliver the same file(s),
+        containing all species, regardless of the requested species (like
+        for EMEP); it is then called with ``species=None``.
+
+        """
+        fcinit = self.check_day(fcinit)
+        fcstart = self.get_fctime('start', fcinit, fcstart)
+        fcend = self.get_fctime('end', fcinit, fcend)
+        self.log.debug('Starting {}/{:%Y%m%d}:{} (shared source)'.format(
+                self.name, fcinit, ','.join(all_species)))
+        if self.cfg['dldriver'].multi_species:
+            urlname = [self.species[sp]['urlname'] for sp in all_species]
+        else:
+            urlname = None
+        fns_temp = self.fetch(urlname, fcinit, fcstart, fcend)
+        try:
+            for species in all_species:
+                with self._nc_lock:
+                    self.check_download(fns_temp, species, fcinit, fcstart,
+                                        fcend)
+                    self.postprocess(species, fcinit, fns_temp)
+                    self.write_checkpoint(species, fcinit)
+        finally:
+            self.cfg['dldriver'].clean_tempfiles(fns_temp)
+        self.log.debug('Finished {}/{:%Y%m%d}:{} (shared source)'.format(
+                self.name, fcinit, ','.join(all_species)))
+
+    def get_pipelined(self, all_species, fcinit):
+        """Download and postprocess several species in overlapping stages
+
+        Downloads are done by ``cfg['pipeline']['download']`` worker threads,
+        which hand the downloaded files to a postprocessing thread through a
+        queue holding at most ``cfg['pipeline']['queue']`` species.  This
+        way, the next species is downloaded while the previous one is being
+        compressed.  There is only one postprocessing thread because
+        libnetcdf is not thread-safe.
+
+        If any species fails, no new work is started and the first error is
+        re-raised after all threads have finished.
+
+        """
+        opts = self.cfg['pipeline']
+        dldriver = self.cfg['dldriver']
+        n_download = opts['download']
+        if n_download > 1 and not dldriver.thread_safe:
+            self.log.warning('{} does not support concurrent downloads, '
+                             'using one download thread'.format(
+                                     dldriver.__class__.__name__))
+            n_download = 1
+
+        todo = Queue()
+        for species in all_species:
+            todo.put(species)
+        downloaded = Queue(maxsize=opts['queue'])
+        abort = threading.Event()
+        errors = []
+
+        def download_worker():
+            while not abort.is_set():
+                try:
+                    species = todo.get_nowait()
+                except Empty:
+                    return
+                self.log.debug('Downloading {}/{:%Y%m%d}:{}'.format(
+                        self.name, fcinit, species))
+                try:
+                    fns_temp = self.download(species, fcinit)
+                except Exception as err:
+                    errors.append(err)
+                    abort.set()
+                    return
+                downloaded.put((species, fns_temp))
+
+        def postprocess_worker():
+            while True:
+                item = downloaded.get()
+                if item is None:
+                    return
+                species, fns_temp = item
+                try:
+                    if not abort.is_set():
+                        self.log.debug('Postprocessing {}/{:%Y%m%d}:{}'.format(
+                                self.name, fcinit, species))
+                        with self._nc_lock:
+                            self.postprocess(species, fcinit, fns_temp)
+                            self.write_checkpoint(species, fcinit)
+                except Exception as err:
+                    errors.append(err)
+                    abort.set()
+                finally:
+                    dldriver.clean_tempfiles(fns_temp)
+
+        downloaders = [threading.Thread(target=download_worker)
+                       for _ in range(min(n_download, len(all_species)))]
+        postprocessor = threading.Thread(target=postprocess_worker)
+        for thread in downloaders + [postprocessor]:
+            thread.daemon = True
+            thread.start()
+        for thread in downloaders:
+            thread.join()
+        downloaded.put(None)
+        postprocessor.join()
+
+        if errors:
+            raise errors[0]
+
+    def output_filename(self, species, fcinit, output_format=None):
+        """Return the output filename; by default for the first format"""
+        if output_format is None:
+            output_format = self.cfg['output_format'][0]
         outdir = os.path.join(self.cfg['basepath'], self.cfg['name'],
                               '{:%Y-%m-%d_%H}'.format(fcinit))
-        outname = '{name}_{fcinit:%Y-%m-%d_%H}_{layer}_{species}.nc'.format(
+        outname = '{name}_{fcinit:%Y-%m-%d_%H}_{layer}_{species}.{ext}'.format(
                 name=self.cfg['name'], species=species.lower(),
-                layer=self.layer_type, fcinit=fcinit)
+                layer=self.layer_type, fcinit=fcinit,
+                ext='zarr' if output_format == 'zarr' else 'nc')
         return os.path.join(outdir, outname)
 
     def postprocess(self, species, fcinit, fns):
-        fn_out = self.output_filename(species, fcinit)
-        dirname = os.path.dirname(fn_out)
-        if not os.path.isdir(dirname):
-            os.makedirs(dirname)
-        self.write_dataset(self.species[species]['varname'], fns, fn_out)
-        self.fix_dataset(fn_out, species, fcinit)
-
-    def set_standard_name(self, nc, species):
+        for output_format in self.cfg['output_format']:
+            fn_out = self.output_filename(species, fcinit, output_format)
+            dirname = os.path.dirname(fn_out)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            self.write_dataset(self.species[species]['varname'], fns, fn_out,
+                               species=species, fcinit=fcinit,
+                               output_format=output_format)
+            if self.fix_dataset is not None:
+                self.fix_dataset(fn_out, species, fcinit)
+
+    def standard_name(self, species):
         if species == 'AIR_PRESSURE':
-            stdname = 'air_pressure'
+            return 'air_pressure'
         elif species == 'AIR_TEMPERATURE':
-            stdname = 'air_temperature'
-        else:
-            stdname = '{}_{}_of_{}_in_air'.format(
-                    self.concentration_type, self.quantity_type,
-                    species_names[species])
+            return 'air_temperature'
+        return '{}_{}_of_{}_in_air'.format(
+                self.concentration_type, self.quantity_type,
+                species_names[species])
+
+    def set_standard_name(self, nc, species):
+        stdname = self.standard_name(species)
         try:
             nc.variables[self.species[species]['varname']].setncattr(
                     'standard_name', stdname)
@@ -294,10 +776,87 @@ class CTMDriver(object):
             else:
                 raise
 
-    def fix_dataset(self, fn_out, species, fcinit):
-        raise NotImplementedError(
-                'The method `fix_dataset` must be implemented in the '
-                'model implementation.')
+    @staticmethod
+    def time_units(fcinit):
+        return 'hours since {:%Y-%m-%dT%H:%M:%S}'.format(fcinit)
+
+    def transform_attrs(self, name, attrs, species, fcinit):
+        """Return the attributes of output variable ``name``
+
+        Called once per copied variable, before any data is written.  The
+        default sets the time units and the standard names of the time axis
+        and the data variable.  Model drivers extend this to add their own
+        metadata fixes.
+
+        Parameters
+        ----------
+        name : str
+            Name of the variable
+        attrs : OrderedDict
+            Attributes copied from the source variable
+        species : str
+            The species being processed
+        fcinit : datetime.datetime
+            Forecast initialization time
+
+        Returns
+        -------
+        attrs : OrderedDict
+
+        """
+        if name == 'time':
+            attrs['units'] = self.time_units(fcinit)
+            attrs['standard_name'] = 'time'
+        elif name == self.species[species]['varname']:
+            attrs['standard_name'] = self.standard_name(species)
+        return attrs
+
+    def transform_data(self, name, data, var_in, slab, species, fcinit):
+        """Return the output data of variable ``name`` for one slab
+
+        Called for every slab while the data is copied (see
+        :meth:`copy_data`).  The default converts the time axis to hours since
+        ``fcinit``.
+
+        Parameters
+        ----------
+        name : str
+            Name of the variable
+        data : numpy.ndarray
+            Source data of the slab
+        var_in : netCDF4.Variable
+            Source variable
+        slab : slice
+            Position of ``data`` along the first axis of ``var_in``
+        species : str
+            The species being processed
+        fcinit : datetime.datetime
+            Forecast initialization time
+
+        Returns
+        -------
+        data : numpy.ndarray
+
+        """
+        if name == 'time' and self.rereference_time:
+            data = date2num(num2date(data, var_in.units),
+                            self.time_units(fcinit))
+        return data
+
+    def derived_variables(self, nc_in, nc_out, species, fcinit):
+        """Define additional output variables
+
+        Called after all copied variables have been defined.  Dimensions and
+        variables, including their attributes, must be created here;
+        their data is written by the returned callables, which are invoked
+        once the copied data has been written.
+
+        Returns
+        -------
+        writers : list of callable
+
+        """
+        return []
 
     def copy_dimensions(self, nc_in, nc_out):
         for name, dim in nc_in.dimensions.items():
@@ -308,9 +867,23 @@ class CTMDriver(object):
     @staticmethod
     def copy_global_attrs(nc_in, nc_out):
         for name in nc_in.ncattrs():
-            nc_out.setncattr(name, nc_in.__dict__[name])
+            nc_out.setncattr(name, classic_attr(nc_in.getncattr(name)))
+
+    def copy_vars(self, nc_in, nc_out, varname_species, species=None,
+                  fcinit=None):
+        """Copy the needed variables from ``nc_in`` to ``nc_out``
+
+        If ``species`` and ``fcinit`` are given, the transform hooks
+        (:meth:`transform_attrs`, :meth:`transform_data` and
+        :meth:`derived_variables`) are applied on the way, so the output file
+        is written in a single pass.  All variables and attributes are
+        defined before any data is written.
+
+        If ``packing`` is enabled, the data variable is stored as int16 (see
+        :meth:`packing_params`).
 
-    def copy_vars(self, nc_in, nc_out, varname_species):
+        """
+        copied = []
         for name, var in nc_in.variables.items():
             if name not in self.needed_vars + [varname_species]:
                 continue
@@ -318,33 +891,333 @@ class CTMDriver(object):
                 dtype = var.datatype
             except AttributeError:
                 dtype = np.float32
+            if isinstance(dtype, np.dtype):
+                dtype = classic_dtype(dtype)
             try:
                 endian = var.endian()
             except AttributeError:
                 endian = 'native'
-            nc_out.createVariable(
-                    name, dtype, var.dimensions,
-                    zlib=(name not in nc_out.dimensions.keys()),
-                    complevel=6, shuffle=True, fletcher32=True,
-                    endian=endian)
-            nc_out.variables[name][:] = var[:]
+
+            transform = None
+            if species is not None:
+                def transform(data, slab, name=name, var=var):
+                    return self.transform_data(name, data, var, slab,
+                                               species, fcinit)
+
+            packing = None
+            if (self.cfg['packing'] and name == varname_species and
+                    np.dtype(dtype).kind == 'f'):
+                packing = self.packing_params(var, transform)
+            if packing is None:
+                kwargs = {}
+                # the surface pressure is needed in full precision to
+                # reconstruct the air pressure
+                if (species is not None and name == varname_species and
+                        not (species == 'AIR_PRESSURE' and
+                             name == self.surface_pressure)):
+                    kwargs = self.precision_kwargs(species, dtype)
+                self.create_variable(nc_out, name, dtype, var.dimensions,
+                                     endian=endian, **kwargs)
+            else:
+                self.create_variable(nc_out, name, np.int16, var.dimensions,
+                                     endian=endian, fill_value=_PACKED_FILL)
 
             # copy variable attributes
-            for attr in var.ncattrs():
-                if attr in self.datavar_attrs_no_copy:
-                    continue
-                nc_out.variables[name].setncattr(attr, var.__dict__[attr])
+            attrs = OrderedDict((attr, var.getncattr(attr))
+                                for attr in var.ncattrs()
+                                if attr not in self.datavar_attrs_no_copy)
+            if species is not None:
+                attrs = self.transform_attrs(name, attrs, species, fcinit)
+            if packing is not None:
+                # the type of the packing attributes is the unpacked type
+                add_offset, scale_factor = np.array(packing, dtype=dtype)
+                attrs['scale_factor'] = scale_factor
+                attrs['add_offset'] = add_offset
+                attrs['packing_max_error'] = scale_factor / 2
+            for attr, value in attrs.items():
+                nc_out.variables[name].setncattr(attr, classic_attr(value))
+            copied.append((name, var, transform))
+
+        writers = []
+        if species is not None:
+            writers = self.derived_variables(nc_in, nc_out, species, fcinit)
+
+        for name, var, transform in copied:
+            # packed variables are packed by netCDF4 (auto-scaling)
+            self.copy_data(var, nc_out.variables[name], transform)
+        for writer in writers:
+            writer()
+
+    def packing_params(self, var_in, transform=None):
+        """Return ``(add_offset, scale_factor)`` for packing into int16
+
+        The data range of ``var_in`` is determined in a streaming pre-pass
+        over slabs (see :meth:`iter_slabs`), applying ``transform`` like
+        :meth:`copy_data`.  Masked and NaN values are ignored.  The maximum
+        quantisation error is half of ``scale_factor``.
+
+        """
+        vmin, vmax = np.inf, -np.inf
+        for slab in self.iter_slabs(var_in.shape,
+                                    np.dtype(var_in.dtype).itemsize):
+            data = var_in[slab]
+            if transform is not None:
+                data = transform(data, slab)
+            data = np.ma.masked_invalid(data)
+            if data.count():
+                vmin = min(vmin, float(data.min()))
+                vmax = max(vmax, float(data.max()))
+        if vmin > vmax:  # no valid data
+            return 0., 1.
+        if vmax == vmin:
+            return vmin, 1.
+        return (vmin + vmax) / 2., (vmax - vmin) / _PACKED_STEPS
+
+    def precision_kwargs(self, species, dtype=np.float32):
+        """Return the precision trimming arguments for a data variable
+
+        The values are rounded by the netCDF library before compression, and
+        the setting is recorded in the variable attributes
+        (``least_significant_digit``, or ``_QuantizeGranularBitRound...``).
+        A setting for all species doesn't apply to the air pressure, which is
+        only trimmed when configured for ``AIR_PRESSURE`` explicitly.
+
+        """
+        if np.dtype(dtype).kind != 'f':
+            return {}
+        kwargs = {}
+        for key in ['significant_digits', 'least_significant_digit']:
+            value = self.cfg[key]
+            if isinstance(value, dict):
+                value = value.get(species)
+            elif species == 'AIR_PRESSURE':
+                value = None
+            if value is not None:
+                kwargs[key] = value
+        if 'significant_digits' in kwargs:
+            if getattr(netCDF4, '__has_quantization_support__', False):
+                kwargs['quantize_mode'] = self.cfg['quantize_mode']
+            else:
+                self.log.warning('significant_digits needs netCDF-C 4.9 and '
+                                 'netCDF4 1.6, storing full precision')
+                del kwargs['significant_digits']
+        return kwargs
+
+    def filter_kwargs(self, name, nc_out):
+        """Return the compression arguments for output variable ``name``
+
+        The profile is taken from ``compression_vars`` if it has an entry for
+        ``name``, and from ``compression`` otherwise.
+
+        """
+        profile = self.cfg['compression_vars'].get(name,
+                                                   self.cfg['compression'])
+        return filter_kwargs(profile, nc_out,
+                             coordinate=name in nc_out.dimensions)
+
+    def create_variable(self, nc_out, name, dtype, dimensions, **kwargs):
+        """Create output variable ``name`` with compression and chunking
+
+        Compression follows :meth:`filter_kwargs`.  If a chunking policy is
+        configured, the data variables are chunked accordingly, and the chunk
+        cache size needed for reading them efficiently is stored in the
+        ``chunk_cache_size`` attribute (in bytes), since HDF5 doesn't store
+        cache settings in the file.
+
+        """
+        kwargs.update(self.filter_kwargs(name, nc_out))
+        policy = self.cfg['chunking']
+        chunks = None
+        if policy is not None and name not in nc_out.dimensions:
+            shape = [len(nc_out.dimensions[dim]) for dim in dimensions]
+            itemsize = np.dtype(dtype).itemsize
+            chunks = chunk_shape(policy, shape, itemsize)
+        if chunks is not None:
+            kwargs['chunksizes'] = chunks
+        var = nc_out.createVariable(name, dtype, dimensions, **kwargs)
+        if chunks is not None:
+            cache = chunk_cache_size(policy, shape, chunks, itemsize)
+            var.setncattr('chunk_cache_size', np.int32(min(cache, 2**31 - 1)))
+        if self._direct is not None and name not in nc_out.dimensions:
+            self._direct.register(var, kwargs)
+        return var
+
+    def iter_slabs(self, shape, itemsize, chunks=None):
+        """Yield slices along the first axis of at most ``copy_buffer`` MB
+
+        If the output is chunked along the first axis, slabs are aligned to
+        the chunk boundaries.  A slab always contains at least one index.
+
+        """
+        if not shape:
+            yield Ellipsis
+            return
+        size_index = int(np.prod(shape[1:], dtype=np.int64)) * itemsize
+        n = max(1, int(self.cfg['copy_buffer'] * 2**20 // max(size_index, 1)))
+        if chunks and n >= chunks[0]:
+            n -= n % chunks[0]
+        for start in range(0, shape[0], n):
+            yield slice(start, min(start + n, shape[0]))
+
+    def copy_data(self, var_in, var_out, transform=None):
+        """Copy data from ``var_in`` to ``var_out`` slab by slab
+
+        This bounds memory usage to one slab (see :meth:`iter_slabs`)
+        instead of the whole, possibly aggregated, variable.  If given,
+        ``transform(data, slab)`` is applied to each slab before writing.
+
+        """
+        chunks = var_out.chunking()
+        if chunks == 'contiguous':
+            chunks = None
+        itemsize = max(np.dtype(var_in.dtype).itemsize,
+                       np.dtype(var_out.dtype).itemsize)
+        packed = (np.dtype(var_out.dtype).kind == 'i' and
+                  np.dtype(var_in.dtype).kind == 'f')
+        for slab in self.iter_slabs(var_in.shape, itemsize, chunks):
+            data = var_in[slab]
+            if transform is not None:
+                data = transform(data, slab)
+            if packed:
+                # NaN can't be packed, store it as missing value; the masked
+                # values are replaced so that they are cast without warning
+                data = np.ma.fix_invalid(
+                        data, fill_value=getattr(var_out, 'add_offset', 0))
+            self.write_slab(var_out, slab, data)
+
+    def write_slab(self, var_out, slab, data):
+        """Write ``data`` to ``var_out[slab]``
+
+        When writing Zarr output with ``output_workers > 1``, slabs covering
+        whole chunks are compressed and written in the process pool.  The
+        number of slabs in flight is limited to twice the number of workers,
+        which bounds memory usage.  With ``compression_workers > 1``, data of
+        large netCDF variables is handed to the
+        :class:`~msschem.directchunk.DirectChunkWriter`.
+
+        """
+        if self._direct is not None and self._direct.handles(var_out):
+            self._direct.write(var_out, slab, data)
+            return
+        if self._write_pool is None or not isinstance(var_out, ZarrVariable):
+            var_out[slab] = data
+            return
+        chunk = var_out.chunking()[0]
+        var_out.extend(slab, data)
+        if not (isinstance(slab, slice) and slab.start % chunk == 0 and
+                (slab.stop % chunk == 0 or slab.stop >= var_out.shape[0])):
+            # slabs sharing a chunk can't be written concurrently
+            self.wait_for_writes()
+            var_out[slab] = data
+            return
+        while len(self._pending_writes) >= 2 * self.cfg['output_workers']:
+            self._pending_writes.pop(0).get()
+        self._pending_writes.append(self._write_pool.apply_async(
+                write_region, (var_out.path, slab, var_out.encode(data))))
+
+    def wait_for_writes(self):
+        """Wait until all slabs given to the process pool are written"""
+        while self._pending_writes:
+            self._pending_writes.pop(0).get()
+
+    def write_hybrid_pressure(self, v_p, hyam, hybm, v_ps, surface=None,
+                              scale=1.):
+        """Write air pressure on hybrid levels to ``v_p``
+
+        ``p = (hyam + hybm * surface(ps)) * scale`` is evaluated in float32,
+        slab by slab along the time axis (see :meth:`iter_slabs`), so that
+        memory usage doesn't grow with the length of the forecast.
 
-    def write_dataset(self, varname_species, fns_in, fn_out):
-        with Dataset(fn_out, 'w', format='NETCDF4_CLASSIC') as nc_out, MFDataset(fns_in, 'r', aggdim=self.aggdim) as nc_in:
-            # copy dimensions
-            self.copy_dimensions(nc_in, nc_out)
+        Parameters
+        ----------
+        v_p : netCDF4.Variable
+            Output variable with dimensions (time, level, y, x)
+        hyam, hybm : array_like
+            Hybrid coefficients, one value per level
+        v_ps : netCDF4.Variable
+            Surface pressure (or a quantity derived from it, see
+            ``surface``) with dimensions (time, y, x)
+        surface : callable, optional
+            Function converting ``v_ps`` data to surface pressure, e.g.
+            ``np.exp`` for ln(surface pressure)
+        scale : float, optional
+            Factor to apply to the result, e.g. for unit conversion
 
-            # copy global attributes
-            self.copy_global_attrs(nc_in, nc_out)
+        """
+        a_ = np.asarray(hyam, dtype=np.float32)[np.newaxis, :, np.newaxis,
+                                                np.newaxis]
+        b_ = np.asarray(hybm, dtype=np.float32)[np.newaxis, :, np.newaxis,
+                                                np.newaxis]
+        chunks = v_p.chunking()
+        if chunks == 'contiguous':
+            chunks = None
+        for slab in self.iter_slabs(v_p.shape, 4, chunks):
+            ps_ = np.asarray(v_ps[slab], dtype=np.float32)
+            if surface is not None:
+                ps_ = surface(ps_)
+            p_ = b_ * ps_[:, np.newaxis, :, :]
+            p_ += a_
+            if scale != 1.:
+                p_ *= np.float32(scale)
+            self.write_slab(v_p, slab, p_)
+
+    def open_source(self, fns_in):
+        """Open the source file(s) for reading
+
+        The files may be in any netCDF format; the conversion to
+        NETCDF4_CLASSIC happens while writing the output.  Several files are
+        aggregated along ``aggdim``.
 
-            # copy variables
-            self.copy_vars(nc_in, nc_out, varname_species)
+        """
+        if len(fns_in) == 1:
+            return Dataset(fns_in[0], 'r')
+        return AggregatedDataset(fns_in, self.aggdim)
+
+    def open_output(self, fn_out, output_format='netcdf'):
+        if output_format == 'zarr':
+            return ZarrDataset(fn_out, 'w')
+        return Dataset(fn_out, 'w', format='NETCDF4_CLASSIC')
+
+    def write_dataset(self, varname_species, fns_in, fn_out, species=None,
+                      fcinit=None, output_format='netcdf'):
+        if output_format == 'zarr' and self.cfg['output_workers'] > 1:
+            self._write_pool = self.worker_pool()
+        if output_format == 'netcdf' and self.cfg['compression_workers'] > 1:
+            pool = self.worker_pool()
+            # without a pool, the netCDF library compresses the chunks
+            if pool is not None:
+                self._direct = DirectChunkWriter(
+                        self.cfg['compression_workers'], pool=pool,
+                        tempdir=self.cfg['temppath'])
+        try:
+            with self.open_output(fn_out, output_format) as nc_out, \
+                    self.open_source(fns_in) as nc_in:
+                # copy dimensions
+                self.copy_dimensions(nc_in, nc_out)
+
+                # copy global attributes
+                self.copy_global_attrs(nc_in, nc_out)
+
+                # copy variables
+                self.copy_vars(nc_in, nc_out, varname_species, species,
+                               fcinit)
+
+                self.wait_for_writes()
+                if self._direct is not None:
+                    self._direct.flush()
+            if self._direct is not None:
+                # the chunks can only be stored once netCDF closed the file
+                self._direct.finish(fn_out)
+        finally:
+            if self._write_pool is not None:
+                # after an error, don't leave writes to this output running
+                for result in self._pending_writes:
+                    result.wait()
+                self._pending_writes = []
+                self._write_pool = None
+            if self._direct is not None:
+                self._direct.close()
+                self._direct = None
 
     def get_fctime(self, start_or_end, fcinit, fctime):
         if start_or_end.lower() == 'start':
@@ -412,6 +1285,9 @@ class CAMSRegDriver(CTMDriver):
     aggdim = 'time'
     name = 'CAMS_regional'
 
+    # time values are hours since fcinit already
+    rereference_time = False
+
     def get_nt(self, fcinit, fcstart, fcend):
         # CAMS Regional files have 25 steps for the first forecast day
         # (including step 0), and 24 steps for later days.
@@ -428,16 +1304,14 @@ class CAMSRegDriver(CTMDriver):
             nt += 24
         return nt
 
-    def fix_dataset(self, fn_out, species, fcinit):
-        with Dataset(fn_out, 'a', format='NETCDF4_CLASSIC') as nc:
-            nc.variables['time'].setncattr(
-                'units', 'hours since {:%Y-%m-%dT%H:%M:%S}'.format(fcinit))
-            nc.variables['time'].setncattr('standard_name', 'time')
-            nc.variables['latitude'].setncattr('standard_name', 'latitude')
-            nc.variables['longitude'].setncattr('standard_name', 'longitude')
-            nc.variables['level'].setncattr('standard_name',
-                                            'atmosphere_altitude_coordinate')
-            self.set_standard_name(nc, species)
+    def transform_attrs(self, name, attrs, species, fcinit):
+        attrs = super(CAMSRegDriver, self).transform_attrs(
+                name, attrs, species, fcinit)
+        if name in ['latitude', 'longitude']:
+            attrs['standard_name'] = name
+        elif name == 'level':
+            attrs['standard_name'] = 'atmosphere_altitude_coordinate'
+        return attrs
 
 
 class SilamDriver(CTMDriver):
@@ -453,6 +1327,9 @@ class SilamDriver(CTMDriver):
     # dimensions
     dims = [('t', None), ('z', 10), ('y', 420), ('x', 700)]
 
+    # 0.1 degree regular lat/lon grid of the SILAM Europe domain
+    grid = {'lat': (30., 0.1, 420), 'lon': (-25., 0.1, 700)}
+
     species = {'CO': dict(varname='cnc_CO_gas',
                           urlname='cnc_CO_gas'),
                'NO': dict(varname='cnc_NO_gas',
@@ -483,19 +1360,12 @@ class SilamDriver(CTMDriver):
     aggdim = 'time'
     name = 'SILAM'
 
-    def fix_dataset(self, fn_out, species, fcinit):
-        with Dataset(fn_out, 'a', format='NETCDF4_CLASSIC') as nc:
-            # convert time to hours since fcinit
-            t_obj = num2date(nc.variables['time'][:],
-                             nc.variables['time'].units)
-            t_unit = 'hours since {:%Y-%m-%dT%H:%M:%S}'.format(fcinit)
-            nc.variables['time'][:] = date2num(t_obj, t_unit)
-            nc.variables['time'].setncattr('units', t_unit)
-            nc.variables['time'].setncattr('standard_name', 'time')
-            nc.variables['height'].setncattr('standard_name',
-                                             'atmosphere_altitude_coordinate')
-            # set standard name of data variable
-            self.set_standard_name(nc, species)
+    def transform_attrs(self, name, attrs, species, fcinit):
+        attrs = super(SilamDriver, self).transform_attrs(
+                name, attrs, species, fcinit)
+        if name == 'height':
+            attrs['standard_name'] = 'atmosphere_altitude_coordinate'
+        return attrs
 
 
 class EMEPDriver(CTMDriver):
@@ -533,7 +1403,8 @@ class EMEPDriver(CTMDriver):
     layer_type = 'ml'
 
     name = 'EMEP'
-    need_to_convert_to_nc4c = True
+
+    surface_pressure = 'PS'
 
     dimensions_no_copy = ['ilev']
 
@@ -544,56 +1415,35 @@ class EMEPDriver(CTMDriver):
         dimsize = OrderedDict(dimsize)
         return dimsize
 
-    def fix_dataset(self, fn_out, species, fcinit):
-        with Dataset(fn_out, 'a', format='NETCDF4_CLASSIC') as nc:
-            # convert time to hours since fcinit
-            t_obj = num2date(nc.variables['time'][:],
-                             nc.variables['time'].units)
-            t_unit = 'hours since {:%Y-%m-%dT%H:%M:%S}'.format(fcinit)
-            nc.variables['time'][:] = date2num(t_obj, t_unit)
-            nc.variables['time'].setncattr('units', t_unit)
-            nc.variables['time'].setncattr('standard_name', 'time')
+    def transform_attrs(self, name, attrs, species, fcinit):
+        attrs = super(EMEPDriver, self).transform_attrs(
+                name, attrs, species, fcinit)
+        if species == 'AIR_PRESSURE' and name == 'PS':
+            attrs['standard_name'] = 'surface_air_pressure'
+        return attrs
 
+    def transform_data(self, name, data, var_in, slab, species, fcinit):
+        if name == 'lev':
             # MSS doesn't like it when the vertical coordinate dimension,
             # after being cast to int, isn't unique. EMEP has values 0..1,
             # so we just overwrite these values with 1..20 here
-            v_lev = nc.variables['lev']
-            v_lev[:] = np.arange(v_lev[:].size) + 1
-
-            # set standard name of data variable
-            self.set_standard_name(nc, species)
-            # TODO can we make a generic function for this?
-            # calculate air pressure
-            if species == 'AIR_PRESSURE':
-                a_ = nc.variables['hyam'][:]
-                b_ = nc.variables['hybm'][:]
-                ps_ = nc.variables['PS'][:]
-                nc.variables['PS'].setncattr('standard_name',
-                                             'surface_air_pressure')
-                # calculate air_pressure
-                p_ = (a_[np.newaxis, :, np.newaxis, np.newaxis] +
-                      b_[np.newaxis, :, np.newaxis, np.newaxis] *
-                      ps_[:, np.newaxis, :, :]) * 100.
-                # write air_pressure to file
-                nc.createVariable(
-                    'P', p_.dtype, ('time', 'lev', 'lat', 'lon'),
-                    zlib=True,
-                    complevel=6, shuffle=True, fletcher32=True)
-                nc.variables['P'][:] = p_
-                # set air_pressure attributes
-                nc.variables['P'].setncattr('standard_name', 'air_pressure')
-                nc.variables['P'].setncattr('units', 'Pa')
-                # delete surface pressure variable
-                del nc.variables['PS']
-
-    def write_dataset(self, varname_species, fns_in, fn_out):
-        # TODO make generic method more generic, to make special case obsolete
-        with Dataset(fn_out, 'w', format='NETCDF4_CLASSIC') as nc_out, Dataset(fns_in[0], 'r') as nc_in:
-            # copy dimensions
-            self.copy_dimensions(nc_in, nc_out)
-
-            # copy global attributes
-            self.copy_global_attrs(nc_in, nc_out)
-
-            # copy variables
-            self.copy_vars(nc_in, nc_out, varname_species)
+            return np.arange(var_in.shape[0])[slab] + 1
+        return super(EMEPDriver, self).transform_data(
+                name, data, var_in, slab, species, fcinit)
+
+    def derived_variables(self, nc_in, nc_out, species, fcinit):
+        # TODO can we make a generic function for this?
+        if species != 'AIR_PRESSURE':
+            return []
+        # calculate air_pressure (hPa -> Pa) from surface pressure
+        v_p = self.create_variable(nc_out, 'P', np.float32,
+                                   ('time', 'lev', 'lat', 'lon'),
+                                   **self.precision_kwargs(species))
+        v_p.setncattr('standard_name', 'air_pressure')
+        v_p.setncattr('units', 'Pa')
+
+        def write_pressure():
+            self.write_hybrid_pressure(
+                    v_p, nc_in.variables['hyam'][:], nc_in.variables['hybm'][:],
+                    nc_in.variables['PS'], scale=100.)
+        return [write_pressure]
@@ -9,7 +9,6 @@ try:
 except ImportError:
     from io import BytesIO as StringIO
 
-from netCDF4 import Dataset, num2date, date2num
 import numpy as np
 
 from ..models import CTMDriver
@@ -125,6 +124,8 @@ class CAMSGlobDriver(CTMDriver):
     aggdim = 'time'
     name = 'CAMS_global'
 
+    surface_pressure = 'lnsp'
+
     # TODO How to handle two init times per day?
 
     def get_dims(self, species):
@@ -134,67 +135,64 @@ class CAMSGlobDriver(CTMDriver):
         dimsize = OrderedDict(dimsize)
         return dimsize
 
-    def fix_dataset(self, fn_out, species, fcinit):
+    def transform_attrs(self, name, attrs, species, fcinit):
+        attrs = super(CAMSGlobDriver, self).transform_attrs(
+                name, attrs, species, fcinit)
+        if name in ['time', 'latitude', 'longitude']:
+            attrs['standard_name'] = name
+        elif name == 'level':
+            attrs['standard_name'] = 'model_level_number'
+        return attrs
+
+    def derived_variables(self, nc_in, nc_out, species, fcinit):
         # read vertical coordinates
         hyn, hyam, hybm = load_vert_coord(CAMS_LEVELDEV_STR)
-        with Dataset(fn_out, 'a', format='NETCDF4_CLASSIC') as nc:
-            t_obj = num2date(nc.variables['time'][:],
-                             nc.variables['time'].units)
-            t_unit = 'hours since {:%Y-%m-%dT%H:%M:%S}'.format(fcinit)
-            nc.variables['time'][:] = date2num(t_obj, t_unit)
-            nc.variables['time'].setncattr('units', t_unit)
-            nc.variables['time'].setncattr('standard_name', 'time')
-
-            nc.variables['latitude'].setncattr('standard_name', 'latitude')
-            nc.variables['longitude'].setncattr('standard_name', 'longitude')
-
-            if species == 'AIR_PRESSURE':
-                ps_ = nc.variables['lnsp'][:]  # TODO use species definition
-                # calculate air_pressure
-                p_ = (hyam[np.newaxis, :, np.newaxis, np.newaxis] +
-                      hybm[np.newaxis, :, np.newaxis, np.newaxis] *
-                      np.exp(ps_[:, np.newaxis, :, :]))
-                # create 'level' variable
-                nc.createDimension('level', hyn.size)
-                v_lev = nc.createVariable('level', np.int32, ('level', ))
+        writers = []
+
+        if species == 'AIR_PRESSURE':
+            # create 'level' variable
+            nc_out.createDimension('level', hyn.size)
+            v_lev = nc_out.createVariable('level', np.int32, ('level', ))
+            v_lev.setncattr('standard_name', 'model_level_number')
+            # air_pressure
+            v_p = self.create_variable(
+                nc_out, 'P', np.float32,
+                ('time', 'level', 'latitude', 'longitude'),
+                **self.precision_kwargs(species))
+            v_p.setncattr('standard_name', 'air_pressure')
+            v_p.setncattr('units', 'Pa')
+
+            def write_pressure():
                 v_lev[:] = np.arange(1, 61, 1, dtype='int32')
-                # write air_pressure to file
-                nc.createVariable(
-                    'P', np.float32,
-                    ('time', 'level', 'latitude', 'longitude'),
-                    zlib=True, complevel=6, shuffle=True, fletcher32=True)
-                nc.variables['P'][:] = p_.astype('float32')
-                # set air_pressure attributes
-                nc.variables['P'].setncattr('standard_name', 'air_pressure')
-                nc.variables['P'].setncattr('units', 'Pa')
-
-            self.set_standard_name(nc, species)
-
-            v_hy = nc.createVariable('hybrid', np.float32, ('level', ))
+                # TODO use species definition
+                self.write_hybrid_pressure(v_p, hyam, hybm,
+                                           nc_in.variables['lnsp'],
+                                           surface=np.exp)
+            writers.append(write_pressure)
+
+        v_hy = nc_out.createVariable('hybrid', np.float32, ('level', ))
+        v_hy.setncattr('standard_name',
+                       'atmosphere_hybrid_sigma_pressure_coordinate')
+        v_hy.setncattr('units', 'sigma')
+        v_hy.setncattr('positive', 'down')
+        v_hy.setncattr('formula', 'p(time, level, lat, lon) = '
+                       'ap(level) + b(level) * exp(lnsp(time, lat, lon))')
+        v_hy.setncattr('formula_terms', 'ap: hyam b: hybm lnsp:lnsp')
+
+        v_am = nc_out.createVariable('hyam', np.float32, ('level', ))
+        v_am.setncattr('units', 'Pa')
+        v_am.setncattr('standard_name', 'atmosphere_pressure_coordinate')
+
+        v_bm = nc_out.createVariable('hybm', np.float32, ('level', ))
+        v_bm.setncattr('units', '1')
+        v_bm.setncattr('standard_name',
+                       'atmosphere_hybrid_height_coordinate')
+
+        def write_coordinates():
             v_hy[:] = hyn
-            v_hy.setncattr('standard_name',
-                           'atmosphere_hybrid_sigma_pressure_coordinate')
-            v_hy.setncattr('units', 'sigma')
-            v_hy.setncattr('positive', 'down')
-            v_hy.setncattr('formula', 'p(time, level, lat, lon) = '
-                           'ap(level) + b(level) * exp(lnsp(time, lat, lon))')
-            v_hy.setncattr('formula_terms', 'ap: hyam b: hybm lnsp:lnsp')
-
-            v_am = nc.createVariable('hyam', np.float32, ('level', ))
             v_am[:] = hyam
-            v_am.setncattr('units', 'Pa')
-            v_am.setncattr('standard_name', 'atmosphere_pressure_coordinate')
-
-            v_bm = nc.createVariable('hybm', np.float32, ('level', ))
             v_bm[:] = hybm
-            v_bm.setncattr('units', '1')
-            v_bm.setncattr('standard_name',
-                           'atmosphere_hybrid_height_coordinate')
-
-            nc.variables['level'].setncattr('standard_name',
-                                            'model_level_number')
-
-            for var in ['time', 'latitude', 'longitude']:
-                nc.variables[var].setncattr('standard_name', var)
+        writers.append(write_coordinates)
 
-            # TODO add history
+        # TODO add history
+        return writers
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""*************
+msschem.retry
+*************
+
+This module provides the retry policy shared by all download drivers
+
+Errors are classified as transient (a dropped connection, a server which is
+overloaded or temporarily down) or permanent (a missing file, wrong
+credentials).  Only transient errors are retried, after a delay which grows
+exponentially with each try, randomised by some jitter so that several
+clients don't retry in lockstep.  A retry budget limits the total number of
+retries per run, so that an outage doesn't keep a run busy for hours.
+
+This file is part of mss-chem.
+
+:copyright: Copyright 2017 Andreas Hilboll
+:copyright: Copyright 2017 by the mss-chem team, see AUTHORS.rst
+:license: APACHE-2.0, see LICENSE for details.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+"""
+
+from __future__ import division
+
+import errno
+import ftplib
+import logging
+import random
+import socket
+import threading
+import time
+
+try:  # Py2
+    from urllib2 import HTTPError, URLError
+    import httplib as http_client
+except ImportError:  # Py3
+    from urllib.error import HTTPError, URLError
+    import http.client as http_client
+
+try:
+    import paramiko
+    _PARAMIKO = True
+except ImportError:
+    _PARAMIKO = False
+
+from . import DataNotAvailable
+
+
+# HTTP status codes which indicate a temporary problem
+TRANSIENT_HTTP_STATUS = (408, 429, 500, 502, 503, 504)
+
+# errno values of local and SFTP errors which won't go away by retrying
+PERMANENT_ERRNO = (errno.ENOENT, errno.EACCES, errno.EPERM, errno.EISDIR,
+                   errno.ENOTDIR, errno.ENOSPC)
+
+
+def is_transient(err):
+    """Return whether ``err`` may go away when the operation is retried
+
+    HTTP errors are transient for the status codes in
+    ``TRANSIENT_HTTP_STATUS``; FTP errors for 4xx replies (``error_temp``),
+    but not for 5xx replies (``error_perm``, e.g., a missing file).  Broken
+    connections, timeouts and incomplete transfers are always transient,
+    missing data (:class:`DataNotAvailable`) and local or SFTP errors with an
+    errno from ``PERMANENT_ERRNO`` never.
+
+    """
+    if isinstance(err, DataNotAvailable):
+        return False
+    if isinstance(err, HTTPError):
+        return err.code in TRANSIENT_HTTP_STATUS
+    if isinstance(err, URLError):
+        # connection refused, name resolution failure, ...
+        return True
+    if isinstance(err, ftplib.error_perm):
+        return False
+    if isinstance(err, (ftplib.error_temp, ftplib.error_reply,
+                        ftplib.error_proto)):
+        return True
+    if isinstance(err, (http_client.IncompleteRead, EOFError,
+                        socket.timeout)):
+        return True
+    if _PARAMIKO and isinstance(err, paramiko.SSHException):
+        return True
+    if isinstance(err, (IOError, OSError)):
+        # includes socket.error
+        return getattr(err, 'errno', None) not in PERMANENT_ERRNO
+    return False
+
+
+class RetryPolicy(object):
+    """Decide whether and when to retry a failed operation
+
+    Parameters
+    ----------
+    n_tries : int
+        Maximum number of tries of one operation
+    delay : float
+        Delay before the first retry in seconds
+    backoff : float
+        Factor by which the delay grows with each retry
+    max_delay : float
+        Upper limit of the delay in seconds
+    jitter : float
+        Fraction of the delay which is randomised; with ``jitter=0.5``, the
+        actual delay is between 50 and 100 % of the nominal one
+    budget : int, optional
+        Maximum number of retries per run (see :meth:`reset`), of all
+        operations using this policy together
+
+    """
+
+    # tests replace this
+    sleep = staticmethod(time.sleep)
+
+    def __init__(self, n_tries=1, delay=1., backoff=2., max_delay=300.,
+                 jitter=0.5, budget=None):
+        self.log = logging.getLogger('msschem')
+        self.n_tries = n_tries
+        self.delay = delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.budget = budget
+        self._lock = threading.Lock()
+        self.n_retries = 0
+
+    def reset(self):
+        """Start a new run, with the full retry budget"""
+        with self._lock:
+            self.n_retries = 0
+
+    def get_delay(self, n_failed):
+        """Return the delay in seconds after the ``n_failed``-th failure"""
+        delay = min(self.delay * self.backoff ** (n_failed - 1),
+                    self.max_delay)
+        return delay * (1. - self.jitter * random.random())
+
+    def should_retry(self, err, n_failed, n_tries=None, transient=None):
+        """Return whether to retry after the ``n_failed``-th failure ``err``
+
+        ``n_tries`` overrides the maximum number of tries of this policy,
+        ``transient`` the classification of ``err`` by :func:`is_transient`.
+        A retry uses up one unit of the retry budget.
+
+        """
+        if n_failed >= (n_tries or self.n_tries):
+            return False
+        if not (is_transient(err) if transient is None else transient):
+            return False
+        with self._lock:
+            if self.budget is not None and self.n_retries >= self.budget:
+                if self.n_retries == self.budget:
+                    self.log.warning('Retry budget of {} exhausted, giving '
+                                     'up on further failures'.format(
+                                             self.budget))
+                    self.n_retries += 1
+                return False
+            self.n_retries += 1
+        return True
+
+    def call(self, func, *args, **kwargs):
+        """Call ``func(*args, **kwargs)``, retrying transient errors
+
+        The keyword arguments ``n_tries`` (overriding the maximum number of
+        tries) and ``describe`` (used in log messages) are not passed on to
+        ``func``.  The last error is re-raised if ``func`` doesn't succeed.
+
+        """
+        n_tries = kwargs.pop('n_tries', None)
+        describe = kwargs.pop('describe', getattr(func, '__name__', func))
+        n_failed = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as err:
+                n_failed += 1
+                if not self.should_retry(err, n_failed, n_tries):
+                    raise
+                delay = self.get_delay(n_failed)
+                self.log.info('Retrying {} in {:.1f} s (try {} failed: {})'
+                              ''.format(describe, delay, n_failed, err))
+                self.sleep(delay)
@@ -3,19 +3,45 @@
 from __future__ import print_function
 
 import argparse
+from collections import Counter
 import datetime
 import logging
+import multiprocessing
 import os.path
 import runpy
 import sys
+import time
+
+try:  # Py2
+    from Queue import Queue
+except ImportError:  # Py3
+    from queue import Queue
+
+from msschem.download import close_pools
+from msschem.transfer import share_scheduler, use_shared_scheduler
 
 VERBOSE = True
 QUIET = False
 
-# TODO allow parallel download of different models
 # TODO allow parallel download of species (??)
 
 
+class _ModelFilter(logging.Filter):
+    """Add the name of the model currently being processed to log records"""
+
+    model = '-'
+
+    def filter(self, record):
+        record.model = self.model
+        return True
+
+
+_MODEL_FILTER = _ModelFilter()
+
+# datasources of a worker process, see _init_worker()
+_DATASOURCES = None
+
+
 def _valid_date(s):
     try:
         return datetime.datetime.strptime(s, "%Y-%m-%d").date()
@@ -27,10 +53,15 @@ def _valid_date(s):
 def _setup_logging(level):
     log = logging.getLogger('msschem')
     log.setLevel(level)
+    if log.handlers:
+        # forked worker processes inherit the handler of the main process
+        return
     ch = logging.StreamHandler()
     ch.setLevel(logging.DEBUG)
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    formatter = logging.Formatter(
+            '%(asctime)s - %(levelname)s - %(model)s - %(message)s')
     ch.setFormatter(formatter)
+    ch.addFilter(_MODEL_FILTER)
     log.addHandler(ch)
 
 
@@ -42,17 +73,44 @@ def _setup_argparse():
                            help='Model to download')
     datagroup.add_argument('-a', '--all', action='store_true',
                            help='Download data from all configured models')
+    datagroup.add_argument('--benchmark', type=str, metavar='FILE',
+                           help='Compare the compression profiles and '
+                                'chunk layouts on the data of a netCDF file')
 
     parser.add_argument('-d', '--date', type=_valid_date,
                         default=datetime.date.today(),
                         help='Date to download data for (YYYY-MM-DD)')
 
+    parser.add_argument('--start', type=_valid_date, metavar='DATE',
+                        help='First date of a range of dates to download '
+                             '(YYYY-MM-DD)')
+
+    parser.add_argument('--end', type=_valid_date, metavar='DATE',
+                        help='Last date of a range of dates to download '
+                             '(YYYY-MM-DD, default: today)')
+
     parser.add_argument('-p', '--prune', type=int,
                         help='Delete data older than PRUNE days')
 
     parser.add_argument('-c', '--config', type=str, default='',
                         help='MSS-Chem configuration file')
 
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep running, and process new data as soon as '
+                             'they are available, starting with DATE')
+
+    parser.add_argument('--history', type=str, metavar='FILE',
+                        default='~/.msschem_history.json',
+                        help='File keeping the times at which data became '
+                             'available (with --daemon)')
+
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of models to process in parallel')
+
+    parser.add_argument('--jobs-per-host', type=int, metavar='N',
+                        help='Maximum number of models processed in parallel '
+                             'which download from the same server')
+
     loggroup = parser.add_mutually_exclusive_group()
     loggroup.add_argument('-q', '--quiet', action='store_true',
                           help='No output except for errors')
@@ -80,7 +138,200 @@ def read_config(configfile):
     return cfg
 
 
-if __name__ == '__main__':
+def run_model(datasources, name, fcinit, prune=None):
+    """Run one model and return a ``(name, status, duration)`` tuple
+
+    ``status`` is one of ``'done'`` (all data are available), ``'incomplete'``
+    (data not yet available, or another process holds the lock), or
+    ``'failed'`` (an exception has been raised and logged).
+
+    """
+    log = logging.getLogger('msschem')
+    _MODEL_FILTER.model = name
+    t0 = time.time()
+    try:
+        driver = datasources[name]
+        status = 'done' if driver.run(fcinit) else 'incomplete'
+        if prune:
+            driver.prune(prune)
+    except Exception:
+        log.exception('Processing {} failed'.format(name))
+        status = 'failed'
+    finally:
+        _MODEL_FILTER.model = '-'
+    return name, status, time.time() - t0
+
+
+def model_host(driver):
+    """Return the name of the server ``driver`` downloads from, or None"""
+    try:
+        return driver.cfg['dldriver'].hostname()
+    except (AttributeError, KeyError):
+        return None
+
+
+def keep_connections(datasources):
+    """Keep the connections of all drivers open between runs"""
+    for driver in datasources.values():
+        cfg = getattr(driver, 'cfg', None)
+        if cfg is not None:
+            cfg['keep_connections'] = True
+
+
+def close_connections(datasources):
+    """Close the connections of all drivers"""
+    for driver in datasources.values():
+        try:
+            driver.cfg['dldriver'].close()
+        except (AttributeError, KeyError):
+            pass
+    close_pools()
+
+
+def _init_worker(configfile, loglevel, keep=False, scheduler=None):
+    global _DATASOURCES
+    _setup_logging(loglevel)
+    try:
+        _DATASOURCES = read_config(configfile)
+    except Exception:
+        # a failing initializer would be restarted by the pool forever; the
+        # tasks of this worker fail instead (see run_model)
+        logging.getLogger('msschem').exception(
+                'Reading the configuration in worker process failed')
+        _DATASOURCES = {}
+    if keep:
+        keep_connections(_DATASOURCES)
+    if scheduler is not None:
+        # replaces the scheduler set up by the configuration file
+        use_shared_scheduler(scheduler)
+
+
+def _run_model_worker(args):
+    name = args[0]
+    t0 = time.time()
+    try:
+        return run_model(_DATASOURCES, *args)
+    except BaseException:
+        # e.g. SystemExit, which would end the worker without a result
+        logging.getLogger('msschem').exception(
+                'Processing {} failed'.format(name))
+        return name, 'failed', time.time() - t0
+
+
+def run_tasks(datasources, tasks, prune=None, jobs=1, jobs_per_host=None,
+              configfile='', loglevel=logging.WARN):
+    """Run ``(name, fcinit)`` tasks, optionally in a pool of ``jobs`` processes
+
+    Tasks are started in the given order, but a task is held back while
+    ``jobs_per_host`` tasks downloading from the same server (see
+    :meth:`DownloadDriver.hostname`) are running, and later tasks for other
+    servers are started first.  When there are several tasks, the drivers
+    keep their connections open between tasks, so that models (or days)
+    using the same server share them; they are closed at the end.
+
+    In parallel mode, each worker process reads the configuration itself, so
+    that the (unpicklable) drivers never have to be transferred between
+    processes.  The workers share one transfer scheduler (see
+    :func:`msschem.transfer.share_scheduler`), so that the transfer limits
+    apply to all of them together.
+
+    Returns
+    -------
+    results : list of tuple
+        One ``(name, fcinit, status, duration)`` tuple per task, in the order
+        of ``tasks``.
+
+    """
+    keep = len(tasks) > 1
+    if jobs <= 1 or len(tasks) <= 1:
+        if keep:
+            keep_connections(datasources)
+        results = [(name, fcinit) + run_model(datasources, name, fcinit,
+                                              prune)[1:]
+                   for name, fcinit in tasks]
+        close_connections(datasources)
+        return results
+
+    hosts = dict((name, model_host(datasources[name]))
+                 for name in set(name for name, _ in tasks))
+    pending = list(enumerate(tasks))
+    n_running = Counter()
+    finished = Queue()
+    results = [None] * len(tasks)
+    manager, scheduler = share_scheduler()
+    pool = multiprocessing.Pool(min(jobs, len(tasks)), _init_worker,
+                                (configfile, loglevel, keep, scheduler))
+    try:
+        while pending or sum(n_running.values()):
+            for item in list(pending):
+                if sum(n_running.values()) >= jobs:
+                    break
+                i, (name, fcinit) = item
+                host = hosts[name]
+                if (host is not None and jobs_per_host and
+                        n_running[host] >= jobs_per_host):
+                    continue
+                pending.remove(item)
+                n_running[host] += 1
+                pool.apply_async(
+                        _run_model_worker, ((name, fcinit, prune), ),
+                        callback=lambda result, i=i: finished.put(
+                                (i, result)),
+                        error_callback=lambda err, i=i, name=name: (
+                                finished.put((i, (name, 'failed', 0.)))))
+            i, (name, status, duration) = finished.get()
+            n_running[hosts[name]] -= 1
+            results[i] = (name, tasks[i][1], status, duration)
+    finally:
+        pool.close()
+        pool.join()
+        manager.shutdown()
+    return results
+
+
+def run_models(datasources, names, fcinit, prune=None, jobs=1,
+               jobs_per_host=None, configfile='', loglevel=logging.WARN):
+    """Run several models for one init time, see :func:`run_tasks`
+
+    Returns
+    -------
+    results : list of tuple
+        One ``(name, status, duration)`` tuple per model, in the order of
+        ``names``.
+
+    """
+    results = run_tasks(datasources, [(name, fcinit) for name in names],
+                        prune=prune, jobs=jobs, jobs_per_host=jobs_per_host,
+                        configfile=configfile, loglevel=loglevel)
+    return [(name, status, duration)
+            for name, _, status, duration in results]
+
+
+def backfill_tasks(names, start, end):
+    """Return the tasks for all days from ``start`` to ``end``, newest first"""
+    tasks = []
+    day = end
+    while day >= start:
+        fcinit = datetime.datetime(day.year, day.month, day.day)
+        tasks.extend((name, fcinit) for name in names)
+        day -= datetime.timedelta(days=1)
+    return tasks
+
+
+def format_summary(results):
+    """Format the results of :func:`run_models` as a table"""
+    width = max([len('model')] + [len(name) for name, _, _ in results])
+    lines = ['{:{w}}  {:10}  {:>10}'.format('model', 'status', 'duration',
+                                             w=width)]
+    lines.append('-' * len(lines[0]))
+    for name, status, duration in results:
+        lines.append('{:{w}}  {:10}  {:>10}'.format(
+                name, status, str(datetime.timedelta(seconds=int(duration))),
+                w=width))
+    return '\n'.join(lines)
+
+
+def main():
     parser = _setup_argparse()
     args = parser.parse_args()
 
@@ -94,25 +345,57 @@ if __name__ == '__main__':
         loglevel = logging.ERROR
     _setup_logging(loglevel)
 
+    if args.benchmark:
+        from msschem import benchmark
+        print(benchmark.format_compression_results(
+                benchmark.benchmark_compression(args.benchmark)))
+        print()
+        print(benchmark.format_chunking_results(
+                benchmark.benchmark_chunking(args.benchmark)))
+        sys.exit(0)
+
     fcinit = datetime.datetime(args.date.year, args.date.month, args.date.day)
 
     datasources = read_config(args.config)
 
     if args.model:
-        datasources[args.model].run(fcinit)
-        if args.prune:
-            try:
-                datasources[args.model].prune(args.prune)
-            except:
-                raise
-        sys.exit(0)
+        names = [args.model]
+    else:
+        names = list(datasources.keys())
 
+    if args.daemon:
+        from msschem.daemon import AvailabilityHistory, Daemon, ProbeSchedule
+        history = AvailabilityHistory(os.path.expanduser(args.history))
+        Daemon(datasources, names, fcinit, ProbeSchedule(history),
+               prune=args.prune).run()
+
+    if args.start is not None:
+        end = args.end or datetime.date.today()
+        if args.start > end:
+            parser.error('--start must not be after --end')
+        tasks = backfill_tasks(names, args.start, end)
+        # prune once at the end, not to delete days which have just been
+        # downloaded
+        results = run_tasks(datasources, tasks, jobs=args.jobs,
+                            jobs_per_host=args.jobs_per_host,
+                            configfile=args.config, loglevel=loglevel)
+        if args.prune:
+            for name in names:
+                datasources[name].prune(args.prune)
+        results = [('{} {:%Y-%m-%d}'.format(name, fcinit), status, duration)
+                   for name, fcinit, status, duration in results]
     else:
-        for driver in datasources.values():
-            driver.run(fcinit)
-            if args.prune:
-                try:
-                    driver.prune(args.prune)
-                except:
-                    raise
-        sys.exit(0)
+        results = run_models(datasources, names, fcinit, prune=args.prune,
+                             jobs=args.jobs, jobs_per_host=args.jobs_per_host,
+                             configfile=args.config, loglevel=loglevel)
+
+    if (args.all or args.start is not None) and not args.quiet:
+        print(format_summary(results))
+
+    if any(status == 'failed' for _, status, _ in results):
+        sys.exit(1)
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""****************
+msschem.transfer
+****************
+
+This module coordinates the file transfers of all download drivers
+
+Every transfer of a file (or of one part of it) is done in a slot handed
+out by the :class:`TransferScheduler`.  The scheduler limits the number of
+simultaneous transfers per host, paces the transfers to optional bandwidth
+caps per host and in total, lets drivers with a higher ``priority`` go first,
+and records how long transfers waited for a slot separately from how long
+they took.  With ``msschem-dl --jobs``, the worker processes share one
+scheduler, which runs in a manager process (see :func:`share_scheduler`).
+
+This file is part of mss-chem.
+
+:copyright: Copyright 2017 Andreas Hilboll
+:copyright: Copyright 2017 by the mss-chem team, see AUTHORS.rst
+:license: APACHE-2.0, see LICENSE for details.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+"""
+
+from __future__ import division
+
+from collections import defaultdict
+from contextlib import contextmanager
+import itertools
+import logging
+from multiprocessing.managers import BaseManager
+import threading
+import time
+
+
+class RateLimiter(object):
+    """Pace a stream of data to ``rate`` bytes per second"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._next = 0.
+        self._lock = threading.Lock()
+
+    def reserve(self, nbytes):
+        """Account for ``nbytes`` and return how long to wait before the next
+        chunk of data may be transferred"""
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + nbytes / self.rate
+            return self._next - now
+
+
+class Transfer(object):
+    """One slot of the :class:`TransferScheduler`
+
+    Drivers call :meth:`throttle` after each chunk of data they receive.
+
+    """
+
+    def __init__(self, scheduler, host, wait):
+        self.scheduler = scheduler
+        self.host = host
+        self.wait = wait
+        self.nbytes = 0
+        self.t0 = time.time()
+
+    def reserve(self, nbytes):
+        """Account for ``nbytes`` and return the time to pause in seconds"""
+        self.nbytes += nbytes
+        return self.scheduler.reserve(self.host, nbytes)
+
+    def throttle(self, nbytes):
+        """Account for ``nbytes``, and pause as needed by the rate limits"""
+        delay = self.reserve(nbytes)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class TransferScheduler(object):
+    """Hand out transfer slots, respecting the limits of each host
+
+    Parameters
+    ----------
+    rate : float, optional
+        Maximum total bandwidth of all transfers in bytes per second
+    max_connections : int, optional
+        Default maximum number of simultaneous transfers per host
+    hosts : dict, optional
+        Limits of single hosts, as dicts with the keys ``connections``
+        and/or ``rate`` (bytes per second)
+
+    Transfers waiting for the same host are started in order of decreasing
+    priority, and in the order of their requests for equal priority.  Local
+    transfers (``host=None``) are only subject to the total bandwidth.
+
+    """
+
+    def __init__(self, rate=None, max_connections=None, hosts=None):
+        self.log = logging.getLogger('msschem')
+        self.rate = rate
+        self.max_connections = max_connections
+        self.hosts = dict(hosts or {})
+        self._cond = threading.Condition()
+        self._counter = itertools.count()
+        self._waiting = []
+        self._active = defaultdict(int)
+        self._limiters = {}
+        if rate:
+            self._limiters[None] = RateLimiter(rate)
+        for host, limits in self.hosts.items():
+            if limits.get('rate'):
+                self._limiters[host] = RateLimiter(limits['rate'])
+        self._stats = {}
+
+    def connection_limit(self, host):
+        """Return the maximum number of transfers for ``host``, or None"""
+        if host is None:
+            return None
+        return self.hosts.get(host, {}).get('connections',
+                                            self.max_connections)
+
+    def limiters(self, host):
+        """Return the rate limiters applying to transfers from ``host``"""
+        keys = [None] if host is None else [None, host]
+        return [self._limiters[key] for key in keys if key in self._limiters]
+
+    def _may_start(self, entry):
+        _, _, host = entry
+        limit = self.connection_limit(host)
+        if limit is not None and self._active[host] >= limit:
+            return False
+        # nobody with a higher priority is waiting for this host
+        return min(e for e in self._waiting if e[2] == host) == entry
+
+    def reserve(self, host, nbytes):
+        """Account for ``nbytes`` from ``host`` in the rate limits and return
+        the time to pause in seconds"""
+        return max([0.] + [limiter.reserve(nbytes)
+                           for limiter in self.limiters(host)])
+
+    def wait_for_slot(self, host, priority=0):
+        """Wait for a free slot for ``host`` and return the waiting time"""
+        entry = (-priority, next(self._counter), host)
+        t0 = time.time()
+        with self._cond:
+            self._waiting.append(entry)
+            while not self._may_start(entry):
+                self._cond.wait()
+            self._waiting.remove(entry)
+            self._active[host] += 1
+            # the next one waiting for this host may be allowed to start, too
+            self._cond.notify_all()
+        return time.time() - t0
+
+    def release_slot(self, host, nbytes, wait, duration):
+        """Return a slot for ``host`` and record the transfer's statistics"""
+        with self._cond:
+            self._active[host] -= 1
+            stats = self._stats.setdefault(
+                    host, dict(transfers=0, bytes=0, wait=0., transfer=0.))
+            stats['transfers'] += 1
+            stats['bytes'] += nbytes
+            stats['wait'] += wait
+            stats['transfer'] += duration
+            self._cond.notify_all()
+
+    def acquire(self, host, priority=0):
+        """Wait for a free slot for ``host`` and return a :class:`Transfer`"""
+        return Transfer(self, host, self.wait_for_slot(host, priority))
+
+    def release(self, transfer):
+        """Return the slot of ``transfer`` and record its statistics"""
+        duration = time.time() - transfer.t0
+        self.release_slot(transfer.host, transfer.nbytes, transfer.wait,
+                          duration)
+        self.log.debug('Transfer from {}: {} bytes, waited {:.1f} s, '
+                       'transferred in {:.1f} s'.format(
+                               transfer.host or 'local disk',
+                               transfer.nbytes, transfer.wait, duration))
+
+    @contextmanager
+    def transfer(self, host, priority=0):
+        """Context manager holding a transfer slot for ``host``"""
+        transfer = self.acquire(host, priority)
+        try:
+            yield transfer
+        finally:
+            self.release(transfer)
+
+    def stats(self, host=None):
+        """Return the statistics of all transfers from ``host``
+
+        Returns
+        -------
+        stats : dict or None
+            Number of ``transfers``, total ``bytes``, and the total time
+            spent waiting for a slot (``wait``) and transferring data
+            (``transfer``) in seconds.  ``None`` if there weren't any
+            transfers from ``host``.
+
+        """
+        with self._cond:
+            stats = self._stats.get(host)
+            return dict(stats) if stats is not None else None
+
+
+class SharedTransferScheduler(TransferScheduler):
+    """Client of a TransferScheduler shared by several processes
+
+    The slots, rate limits and statistics are kept by the scheduler behind
+    ``proxy``, which runs in a manager process (see :func:`share_scheduler`).
+    Waiting for a slot blocks in the manager, so the limits apply to the
+    transfers of all processes together.
+
+    """
+
+    def __init__(self, proxy):
+        self.log = logging.getLogger('msschem')
+        self.proxy = proxy
+
+    def reserve(self, host, nbytes):
+        return self.proxy.reserve(host, nbytes)
+
+    def wait_for_slot(self, host, priority=0):
+        return self.proxy.wait_for_slot(host, priority)
+
+    def release_slot(self, host, nbytes, wait, duration):
+        self.proxy.release_slot(host, nbytes, wait, duration)
+
+    def stats(self, host=None):
+        return self.proxy.stats(host)
+
+
+class _SchedulerManager(BaseManager):
+    pass
+
+
+_SchedulerManager.register(
+        'TransferScheduler', TransferScheduler,
+        exposed=['reserve', 'wait_for_slot', 'release_slot', 'stats'])
+
+
+def copy_stream(src, dst, transfer=None, chunk_size=1 << 20):
+    """Copy file object ``src`` to ``dst``, throttled by ``transfer``"""
+    while True:
+        chunk = src.read(chunk_size)
+        if not chunk:
+            break
+        dst.write(chunk)
+        if transfer is not None:
+            transfer.throttle(len(chunk))
+
+
+_SCHEDULER = TransferScheduler()
+
+
+def get_scheduler():
+    """Return the TransferScheduler used by all download drivers"""
+    return _SCHEDULER
+
+
+def configure_transfers(rate=None, max_connections=None, hosts=None):
+    """Replace the TransferScheduler used by all download drivers
+
+    Call this in the configuration file to set global limits, e.g.::
+
+       configure_transfers(rate=50e6, hosts={
+               'silam.fmi.fi': dict(connections=2, rate=10e6)})
+
+    See :class:`TransferScheduler` for the parameters.
+
+    """
+    global _SCHEDULER
+    _SCHEDULER = TransferScheduler(rate, max_connections, hosts)
+    return _SCHEDULER
+
+
+def share_scheduler():
+    """Serve the limits of the current TransferScheduler to other processes
+
+    A manager process is started, holding a TransferScheduler with the
+    limits set by :func:`configure_transfers`.  Child processes install the
+    returned proxy with :func:`use_shared_scheduler`.
+
+    Returns
+    -------
+    manager, proxy
+        The manager must be shut down when the child processes are done.
+
+    """
+    scheduler = get_scheduler()
+    manager = _SchedulerManager()
+    manager.start()
+    proxy = manager.TransferScheduler(scheduler.rate,
+                                      scheduler.max_connections,
+                                      scheduler.hosts)
+    return manager, proxy
+
+
+def use_shared_scheduler(proxy):
+    """Use the scheduler behind ``proxy`` (see :func:`share_scheduler`)"""
+    global _SCHEDULER
+    _SCHEDULER = SharedTransferScheduler(proxy)
+    return _SCHEDULER
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""*****************
+msschem.zarrstore
+*****************
+
+This module provides the Zarr output backend
+
+:class:`ZarrDataset` implements the part of the :class:`netCDF4.Dataset` API
+which is used by the model drivers to write output files, so that the same
+code (including all transform hooks) can write either format.  Dimension
+names are stored in the ``_ARRAY_DIMENSIONS`` attribute of each array, as
+expected by xarray.
+
+Each chunk of a Zarr store is a separate object, so chunks can be compressed
+and written by several processes at the same time (see
+:func:`write_region`).
+
+This file is part of mss-chem.
+
+:copyright: Copyright 2017 Andreas Hilboll
+:copyright: Copyright 2017 by the mss-chem team, see AUTHORS.rst
+:license: APACHE-2.0, see LICENSE for details.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+"""
+
+from __future__ import division
+
+import math
+import shutil
+import os.path
+
+import numpy as np
+
+import numcodecs
+import zarr
+from netCDF4 import default_fillvals
+
+from .compression import chunk_shape, encode_data
+
+
+def _fill_value(dtype):
+    dtype = np.dtype(dtype)
+    return default_fillvals['{}{}'.format(dtype.kind, dtype.itemsize)]
+
+
+def write_region(path, slab, data):
+    """Write ``data`` to region ``slab`` of the Zarr array at ``path``
+
+    Compression happens here, so this function can be run in a process
+    pool.  Regions written at the same time must not share chunks.
+
+    """
+    zarr.open_array(path, mode='r+')[slab] = data
+
+
+class ZarrDimension(object):
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = 0 if size is None else size
+        self._unlimited = size is None
+
+    def __len__(self):
+        return self.size
+
+    def isunlimited(self):
+        return self._unlimited
+
+
+class ZarrVariable(object):
+    """A Zarr array with the netCDF4.Variable methods used for writing"""
+
+    def __init__(self, dataset, name, array, dimensions):
+        self.dataset = dataset
+        self.name = name
+        self.array = array
+        self.dimensions = tuple(dimensions)
+        self.path = os.path.join(dataset.path, name)
+
+    @property
+    def dtype(self):
+        return self.array.dtype
+
+    @property
+    def shape(self):
+        return tuple(len(self.dataset.dimensions[dim])
+                     for dim in self.dimensions)
+
+    def chunking(self):
+        return list(self.array.chunks)
+
+    def ncattrs(self):
+        return [attr for attr in self.array.attrs
+                if attr != '_ARRAY_DIMENSIONS']
+
+    def getncattr(self, name):
+        return self.array.attrs[name]
+
+    def setncattr(self, name, value):
+        if isinstance(value, (np.ndarray, np.generic)):
+            value = value.tolist()
+        self.array.attrs[name] = value
+
+    def set_var_chunk_cache(self, *args, **kwargs):
+        pass
+
+    def encode(self, data):
+        """Return ``data`` as stored: packed, and with missing values filled"""
+        return encode_data(data, self.dtype, self.array.attrs,
+                           self.array.fill_value)
+
+    def extend(self, key, data):
+        """Grow the unlimited dimension so that ``key`` fits"""
+        if not self.dimensions:
+            return
+        dim = self.dataset.dimensions[self.dimensions[0]]
+        if not dim.isunlimited():
+            return
+        if isinstance(key, tuple):
+            key = key[0] if key else Ellipsis
+        ndim = np.ndim(data)
+        if key is Ellipsis or (isinstance(key, slice) and
+                               key.start is None and key.stop is None):
+            stop = np.shape(data)[0] if ndim == len(self.dimensions) else 0
+        elif isinstance(key, slice):
+            start = key.start or 0
+            stop = key.stop if key.stop is not None else \
+                start + np.shape(data)[0]
+        else:
+            stop = int(key) + 1
+        dim.size = max(dim.size, stop)
+        if self.array.shape[0] < dim.size:
+            self.array.resize((dim.size, ) + self.array.shape[1:])
+
+    def __setitem__(self, key, data):
+        self.extend(key, data)
+        self.array[key] = self.encode(data)
+
+    def __getitem__(self, key):
+        return self.array[key]
+
+
+class ZarrDataset(object):
+    """Write a Zarr store with (a subset of) the netCDF4.Dataset API
+
+    Variables of more than two dimensions are chunked like the ``balanced``
+    chunking policy, unless chunk sizes are given; other variables are
+    stored in one chunk.  Unlimited dimensions must be the first dimension
+    of a variable.
+
+    """
+
+    data_model = 'ZARR'
+
+    def __init__(self, path, mode='w'):
+        if mode != 'w':
+            raise ValueError('ZarrDataset can only be used for writing')
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        self.path = path
+        self.group = zarr.open_group(path, mode='w')
+        self.dimensions = {}
+        self.variables = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def createDimension(self, name, size=None):
+        self.dimensions[name] = ZarrDimension(name, size)
+        return self.dimensions[name]
+
+    def ncattrs(self):
+        return list(self.group.attrs)
+
+    def setncattr(self, name, value):
+        if isinstance(value, (np.ndarray, np.generic)):
+            value = value.tolist()
+        self.group.attrs[name] = value
+
+    @staticmethod
+    def has_zstd_filter():
+        return hasattr(numcodecs, 'Zstd')
+
+    @staticmethod
+    def has_blosc_filter():
+        return hasattr(numcodecs, 'Blosc')
+
+    @staticmethod
+    def has_bzip2_filter():
+        return hasattr(numcodecs, 'BZ2')
+
+    @staticmethod
+    def has_szip_filter():
+        return False
+
+    @staticmethod
+    def _codecs(dtype, compression=None, zlib=False, complevel=4,
+                shuffle=True, least_significant_digit=None,
+                significant_digits=None):
+        filters = []
+        if least_significant_digit is not None:
+            filters.append(numcodecs.Quantize(least_significant_digit, dtype))
+        if significant_digits is not None:
+            # keep enough mantissa bits for the requested decimal digits
+            filters.append(numcodecs.BitRound(
+                    int(math.ceil(significant_digits * math.log(10, 2)))))
+        if zlib and compression is None:
+            compression = 'zlib'
+        if compression is None:
+            return None, filters or None
+        if compression.startswith('blosc'):
+            cname = compression.split('_', 1)[1] if '_' in compression \
+                else 'lz4'
+            return numcodecs.Blosc(
+                    cname=cname, clevel=complevel,
+                    shuffle=numcodecs.Blosc.SHUFFLE if shuffle
+                    else numcodecs.Blosc.NOSHUFFLE), filters or None
+        if shuffle:
+            filters.append(numcodecs.Shuffle(elementsize=dtype.itemsize))
+        compressor = {'zlib': lambda: numcodecs.Zlib(level=complevel),
+                      'zstd': lambda: numcodecs.Zstd(level=complevel),
+                      'bzip2': lambda: numcodecs.BZ2(
+                          level=max(complevel, 1)),
+                      }[compression]()
+        return compressor, filters or None
+
+    def createVariable(self, name, datatype, dimensions=(), compression=None,
+                       zlib=False, complevel=4, shuffle=True,
+                       fletcher32=False, chunksizes=None, endian='native',
+                       fill_value=None, least_significant_digit=None,
+                       significant_digits=None, quantize_mode=None):
+        """Create a Zarr array; the arguments are those of netCDF4
+
+        ``fletcher32`` and ``endian`` are ignored.  ``significant_digits``
+        is implemented by bit rounding, whatever the ``quantize_mode``.
+
+        """
+        dtype = np.dtype(datatype)
+        dimensions = tuple(dimensions)
+        shape = [len(self.dimensions[dim]) for dim in dimensions]
+        if chunksizes is None:
+            if len(shape) > 2:
+                chunksizes = chunk_shape('balanced', shape, dtype.itemsize)
+            else:
+                chunksizes = [max(n, 1) for n in shape]
+                if dimensions and self.dimensions[dimensions[0]].isunlimited():
+                    chunksizes[0] = 1024 if len(shape) == 1 else 1
+        compressor, filters = self._codecs(
+                dtype, compression, zlib, complevel, shuffle,
+                least_significant_digit, significant_digits)
+        if fill_value is None and dtype.kind in 'iuf':
+            fill_value = _fill_value(dtype)
+        array = self.group.create_dataset(
+                name, shape=shape, chunks=chunksizes or True, dtype=dtype,
+                compressor=compressor, filters=filters,
+                fill_value=fill_value)
+        array.attrs['_ARRAY_DIMENSIONS'] = list(dimensions)
+        var = ZarrVariable(self, name, array, dimensions)
+        if least_significant_digit is not None:
+            var.setncattr('least_significant_digit', least_significant_digit)
+        if significant_digits is not None:
+            var.setncattr('significant_digits', significant_digits)
+        self.variables[name] = var
+        return var
+
+    def close(self):
+        # make all variables sharing an unlimited dimension equally long
+        for var in self.variables.values():
+            if var.dimensions and var.array.shape[0] < var.shape[0]:
+                var.array.resize(var.shape[:1] + var.array.shape[1:])
+        zarr.consolidate_metadata(self.group.store)
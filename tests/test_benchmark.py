@@ -0,0 +1,43 @@
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from msschem.benchmark import (benchmark_chunking, benchmark_compression,
+                               format_chunking_results,
+                               format_compression_results)
+
+from .test_model import make_source
+
+
+class TestCompressionBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.tempdir, 'src.nc')
+        make_source(self.fn, 0, 4)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_benchmark(self):
+        results = benchmark_compression(self.fn, ['none', 'fast'],
+                                        tempdir=self.tempdir)
+        self.assertEqual([r[0] for r in results], ['none', 'fast'])
+        for profile, write, read, ratio in results:
+            self.assertGreater(write, 0)
+            self.assertGreater(read, 0)
+        # only the temporary directory of the benchmark is removed
+        self.assertEqual(os.listdir(self.tempdir), ['src.nc'])
+        table = format_compression_results(results).splitlines()
+        self.assertEqual(len(table), 4)
+        self.assertTrue(table[2].startswith('none'))
+
+    def test_chunking_benchmark(self):
+        results = benchmark_chunking(self.fn, n_reads=2, tempdir=self.tempdir)
+        self.assertEqual([r[0] for r in results],
+                         [None, 'balanced', 'hsec', 'vsec'])
+        self.assertEqual(results[2][1], [1, 1, 4, 5])
+        self.assertEqual(os.listdir(self.tempdir), ['src.nc'])
+        table = format_chunking_results(results).splitlines()
+        self.assertTrue(table[2].startswith('default'))
@@ -0,0 +1,109 @@
+import datetime
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from msschem.daemon import AvailabilityHistory, Daemon, ProbeSchedule
+
+from .test_model import FakeDownload, FakeDriver
+
+
+class ProbedDownload(FakeDownload):
+
+    available = False
+
+    def probe(self, species, fcinit, fcstart, fcend):
+        self.probes.append(species)
+        return self.available
+
+
+class TestProbeSchedule(unittest.TestCase):
+
+    fcinit = datetime.datetime(2017, 7, 1)
+
+    def test_backoff(self):
+        schedule = ProbeSchedule(AvailabilityHistory())
+        now = self.fcinit + datetime.timedelta(hours=10)
+        waits = [(schedule.next_probe('FAKE', self.fcinit, now, n) -
+                  now).total_seconds() for n in range(6)]
+        self.assertEqual(waits, [120, 240, 480, 960, 1800, 1800])
+
+    def test_learned_window(self):
+        history = AvailabilityHistory()
+        for hours in [9, 10, 12, 11, 10]:
+            history.record('FAKE', datetime.timedelta(hours=hours))
+        schedule = ProbeSchedule(history)
+        hour = datetime.timedelta(hours=1)
+        # no probes before the earliest time data have been seen
+        self.assertEqual(schedule.next_probe('FAKE', self.fcinit,
+                                             self.fcinit + 2 * hour),
+                         self.fcinit + 9 * hour)
+        # denser probes towards the typical time
+        self.assertEqual(schedule.next_probe('FAKE', self.fcinit,
+                                             self.fcinit + 9 * hour),
+                         self.fcinit + 9.5 * hour)
+        self.assertEqual(schedule.typical('FAKE', self.fcinit),
+                         self.fcinit + 10 * hour)
+
+    def test_persistence(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            fn = os.path.join(tempdir, 'history.json')
+            history = AvailabilityHistory(fn, maxlen=2)
+            for hours in [1, 2, 3]:
+                history.record('FAKE', datetime.timedelta(hours=hours))
+            window = AvailabilityHistory(fn).window('FAKE')
+            self.assertEqual(window, (datetime.timedelta(hours=2),
+                                      datetime.timedelta(hours=3)))
+        finally:
+            shutil.rmtree(tempdir)
+
+
+class TestDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.fcinit = datetime.datetime(2017, 7, 1)
+        self.now = self.fcinit + datetime.timedelta(hours=8)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def sleep(self, seconds):
+        self.now += datetime.timedelta(seconds=seconds)
+
+    def test_wait_and_run(self):
+        dldriver = ProbedDownload()
+        dldriver.probes = []
+        driver = FakeDriver(dict(dldriver=dldriver, basepath=self.tempdir,
+                                 name='FAKE', species=['CO', 'NO2']))
+        driver.processed = []
+        postprocess = driver.postprocess
+
+        def slow_postprocess(*args):
+            self.sleep(600)
+            postprocess(*args)
+        driver.postprocess = slow_postprocess
+        history = AvailabilityHistory()
+        daemon = Daemon({'FAKE': driver}, ['FAKE'], self.fcinit,
+                        ProbeSchedule(history))
+        daemon.clock = lambda: self.now
+        daemon.sleep = self.sleep
+
+        for _ in range(3):
+            self.assertEqual(daemon.step(), ('FAKE', self.fcinit, 'waiting'))
+        self.assertEqual(driver.processed, [])
+        # 8:00, 8:02, 8:06, and the data appear before 8:14
+        dldriver.available = True
+        self.assertEqual(daemon.step(), ('FAKE', self.fcinit, 'done'))
+        self.assertEqual(len(driver.processed), 2)
+        self.assertEqual(dldriver.probes, ['co'] * 4)
+        # processing both species took 20 minutes, which doesn't count
+        # towards the time the data became available
+        self.assertEqual(self.now, self.fcinit + datetime.timedelta(
+                hours=8, minutes=34))
+        delay = datetime.timedelta(hours=8, minutes=14)
+        self.assertEqual(history.window('FAKE'), (delay, delay))
+        self.assertEqual(daemon.state['FAKE']['fcinit'],
+                         self.fcinit + datetime.timedelta(days=1))
@@ -1,12 +1,539 @@
 import datetime
+import ftplib
+import os.path
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 import urllib
 
-from msschem.download import CAMSRegDownload, SilamDownload
+try:  # Py2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:  # Py3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+from msschem import DataNotAvailable, DownloadFailed
+from msschem.download import CAMSRegDownload, HTTPDownload, SilamDownload
+from msschem.download import ConnectionPool, FilesystemDownload, FTPDownload
+from msschem.download import SCPDownload, _SFTPConnection
+from msschem.download import _AIOHTTP, _PARAMIKO
+from msschem.retry import RetryPolicy
+from msschem.transfer import get_scheduler
 
 import msschem_settings
 
 
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    """Serve files from ``server.srcdir``, with support for Range requests
+
+    The first response for each file in ``server.truncate_once`` is cut off
+    after half of the data, and files in ``server.forbidden`` are refused.
+    All requests are recorded in ``server.requests``.
+
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        name = self.path.lstrip('/').split('?')[0]
+        fn = os.path.join(self.server.srcdir, name)
+        self.server.requests.append((name, self.headers.get('Range')))
+        if not os.path.isfile(fn):
+            self.send_error(404)
+            return
+        if name in self.server.forbidden:
+            self.send_error(403)
+            return
+        with open(fn, 'rb') as fd:
+            data = fd.read()
+        etag = '"{}-{}"'.format(len(data), os.path.getmtime(fn))
+        start = 0
+        rng = self.headers.get('Range')
+        if rng and self.headers.get('If-Range') in (None, etag):
+            start = int(rng.split('=')[1].split('-')[0])
+        self.send_response(206 if start else 200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(data) - start))
+        if start:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                    start, len(data) - 1, len(data)))
+        self.end_headers()
+        if name in self.server.truncate_once:
+            self.server.truncate_once.remove(name)
+            self.wfile.write(data[start:len(data) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(data[start:])
+
+    def do_HEAD(self):
+        name = self.path.lstrip('/').split('?')[0]
+        fn = os.path.join(self.server.srcdir, name)
+        self.server.requests.append((name, 'HEAD'))
+        if not os.path.isfile(fn):
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(os.path.getsize(fn)))
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalHTTPServerTestCase(unittest.TestCase):
+    """Serve the files in ``self.srcdir`` at ``self.urlbase``"""
+
+    def setUp(self):
+        self.srcdir = tempfile.mkdtemp()
+        self.outdir = tempfile.mkdtemp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FileHandler)
+        self.server.srcdir = self.srcdir
+        self.server.truncate_once = set()
+        self.server.forbidden = set()
+        self.server.requests = []
+        self.urlbase = 'http://127.0.0.1:{}/'.format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.srcdir)
+        shutil.rmtree(self.outdir)
+
+    def make_file(self, name, size):
+        data = os.urandom(size)
+        with open(os.path.join(self.srcdir, name), 'wb') as fd:
+            fd.write(data)
+        return data
+
+
+class FakeFTP(object):
+    """Minimal stand-in for ftplib.FTP, serving ``FakeFTP.files``"""
+
+    files = {}
+    fail_once = set()
+    fail_always = set()
+    rests = []
+    n_instances = 0
+
+    def __init__(self, host):
+        FakeFTP.n_instances += 1
+        self.closed = False
+        self.dir = '/'
+
+    def set_debuglevel(self, level):
+        pass
+
+    def set_pasv(self, passive):
+        pass
+
+    def login(self, username, password):
+        pass
+
+    def pwd(self):
+        return self.dir
+
+    def cwd(self, path):
+        self.dir = path
+
+    def nlst(self):
+        return sorted(self.files)
+
+    def voidcmd(self, cmd):
+        if self.closed:
+            raise EOFError()
+
+    def size(self, fn):
+        return len(self.files[fn])
+
+    def sendcmd(self, cmd):
+        return '213 20170701000000'
+
+    def retrbinary(self, cmd, callback, blocksize=8192, rest=None):
+        fn = cmd.split(' ', 1)[1]
+        data = self.files[fn][rest or 0:]
+        self.rests.append((fn, rest))
+        if fn in self.fail_always:
+            raise ftplib.error_temp('421 Service not available')
+        if fn in self.fail_once:
+            self.fail_once.remove(fn)
+            callback(data[:len(data) // 2])
+            raise ftplib.error_temp('426 Transfer aborted')
+        callback(data)
+
+    def quit(self):
+        self.closed = True
+
+
+class PlainFTPDownload(FTPDownload):
+    ftpobj = FakeFTP
+    path = '/data/{fcinit:%Y%m%d}'
+
+    def filter_files(self, fns, species, fcinit, fcstart, fcend):
+        return [fn for fn in fns if species in fn]
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def test_reuse(self):
+        opened = []
+        pool = ConnectionPool(lambda: opened.append(1) or len(opened),
+                              lambda conn: conn != 1, lambda conn: None)
+        conn = pool.acquire()
+        pool.release(conn)
+        conn = pool.acquire()
+        # connection 1 fails the health check and is replaced
+        self.assertEqual(conn, 2)
+        pool.release(conn)
+        self.assertEqual(pool.acquire(), 2)
+        self.assertEqual(pool.stats(), dict(opened=2, reused=1))
+
+
+class FakeSFTP(object):
+    """Minimal stand-in for paramiko.SFTPClient, serving ``FakeSFTP.files``
+
+    The connection breaks while transferring a file in ``fail_once``.
+
+    """
+
+    files = {}
+    fail_once = set()
+    instances = []
+    seeks = []
+
+    def __init__(self):
+        self.closed = False
+        FakeSFTP.instances.append(self)
+
+    def chdir(self, path):
+        if self.closed:
+            raise EOFError()
+
+    def listdir(self):
+        return sorted(self.files)
+
+    def stat(self, fn):
+        if self.closed:
+            raise EOFError()
+        return os.stat_result((0, 0, 0, 0, 0, 0, len(self.files[fn]),
+                               0, 0, 0))
+
+    def open(self, fn, mode):
+        sftp = self
+        data = self.files[fn]
+
+        class Remote(object):
+            pos = 0
+
+            def seek(self, offset):
+                FakeSFTP.seeks.append((fn, offset))
+                self.pos = offset
+
+            def prefetch(self, size):
+                pass
+
+            def read(self, size):
+                if fn in sftp.fail_once and self.pos >= len(data) // 2:
+                    sftp.fail_once.remove(fn)
+                    sftp.closed = True
+                    raise EOFError()
+                end = len(data) // 2 if fn in sftp.fail_once else len(data)
+                chunk = data[self.pos:min(end, self.pos + size)]
+                self.pos += len(chunk)
+                return chunk
+
+            def close(self):
+                pass
+        return Remote()
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSCPDownload(SCPDownload):
+
+    def _connect(self):
+        return _SFTPConnection(None, FakeSFTP())
+
+    @staticmethod
+    def _check(conn):
+        return not conn.sftp.closed
+
+    @staticmethod
+    def _disconnect(conn):
+        conn.sftp.close()
+
+
+@unittest.skipUnless(_PARAMIKO, 'paramiko is not available')
+class TestSCPDownload(unittest.TestCase):
+
+    def test_login_logout(self):
+        dl = FakeSCPDownload('scp.example.com', '/data', '.*',
+                             username='login', password='secret')
+        for _ in range(3):
+            dl.login()
+            dl.login()
+            self.assertIsNotNone(dl.conn)
+            dl.logout()
+            self.assertIsNone(dl.conn)
+        # the connection is returned to the pool on logout
+        self.assertEqual(dl.connection_stats(), dict(opened=1, reused=2))
+        dl.close()
+
+    def test_retry_new_connection(self):
+        FakeSFTP.files = {'a_co.nc': b'co data', 'b_co.nc': b'co data'}
+        FakeSFTP.fail_once = set(['a_co.nc'])
+        FakeSFTP.seeks = []
+        outdir = tempfile.mkdtemp()
+        dl = FakeSCPDownload('scp.example.com', '/data', '.*_co.nc',
+                             username='retry', password='secret',
+                             retry=RetryPolicy(2, delay=0.))
+        try:
+            fcinit = datetime.datetime(2017, 7, 1)
+            fns = dl.get('co', fcinit, fcinit, fcinit,
+                         os.path.join(outdir, 'co.nc'))
+            for fn in fns:
+                with open(fn, 'rb') as fd:
+                    self.assertEqual(fd.read(), b'co data')
+        finally:
+            dl.close()
+            shutil.rmtree(outdir)
+        # the broken connection is replaced, and the partial file continued
+        self.assertEqual(dl.connection_stats(), dict(opened=2, reused=2))
+        self.assertEqual(FakeSFTP.seeks, [('a_co.nc', 0), ('a_co.nc', 3),
+                                          ('b_co.nc', 0)])
+
+
+    def test_backoff_without_connection(self):
+        FakeSFTP.files = {'a_co.nc': b'co data'}
+        FakeSFTP.fail_once = set(['a_co.nc'])
+        FakeSFTP.instances = []
+        retry = RetryPolicy(2, delay=0.)
+        waiting = []
+        # connections in use and transfer slots taken during the backoff
+        retry.sleep = lambda seconds: waiting.append((
+                [not sftp.closed for sftp in FakeSFTP.instances],
+                get_scheduler().stats('backoff.example.com')['transfers']))
+        outdir = tempfile.mkdtemp()
+        dl = FakeSCPDownload('backoff.example.com', '/data', '.*_co.nc',
+                             username='backoff', password='secret',
+                             retry=retry)
+        try:
+            fcinit = datetime.datetime(2017, 7, 1)
+            dl.get('co', fcinit, fcinit, fcinit,
+                   os.path.join(outdir, 'co.nc'))
+        finally:
+            dl.close()
+            shutil.rmtree(outdir)
+        # the failed connection is closed and its slot returned
+        self.assertEqual(waiting, [([False], 1)])
+
+
+class TestFTPDownload(unittest.TestCase):
+
+    def setUp(self):
+        self.outdir = tempfile.mkdtemp()
+        FakeFTP.files = {'a_co.nc': b'co data', 'a_no2.nc': b'no2 data'}
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir)
+
+    def test_connection_reuse(self):
+        dl = PlainFTPDownload('ftp.example.com', username='reuse')
+        fcinit = datetime.datetime(2017, 7, 1)
+        for species in ['co', 'no2', 'co']:
+            fns = dl.get(species, fcinit, fcinit, fcinit,
+                         os.path.join(self.outdir, species + '.nc'))
+            with open(fns[0], 'rb') as fd:
+                self.assertEqual(fd.read(), FakeFTP.files['a_{}.nc'.format(
+                        species)])
+        # one connection for listing and retrieving files of all species
+        self.assertEqual(dl.connection_stats(), dict(opened=1, reused=5))
+        dl.close()
+
+    def test_parallel_retrieval(self):
+        FakeFTP.files = dict(('z_{:03d}_co.nc'.format(i), str(i).encode() * 10)
+                             for i in range(0, 120, 3))
+        FakeFTP.fail_once = set(['z_003_co.nc', 'z_042_co.nc'])
+        dl = PlainFTPDownload('ftp.example.com', username='parallel',
+                              n_connections=4, n_tries=2)
+        fcinit = datetime.datetime(2017, 7, 1)
+        fns = dl.get('co', fcinit, fcinit, fcinit,
+                     os.path.join(self.outdir, 'co.nc'), n_tries=2)
+        self.assertEqual(len(fns), 40)
+        for i, fn in enumerate(fns):
+            self.assertTrue(fn.endswith('co_{:03d}.nc'.format(i)))
+            with open(fn, 'rb') as fd:
+                self.assertEqual(fd.read(), str(3 * i).encode() * 10)
+        self.assertLessEqual(dl.connection_stats()['opened'], 6)
+        # failed transfers are continued, not restarted
+        self.assertIn(('z_003_co.nc', 5), FakeFTP.rests)
+        dl.close()
+
+    def test_retry_not_due(self):
+        FakeFTP.files = {'a_co.nc': b'co data', 'b_co.nc': b'co data'}
+        FakeFTP.fail_once = set(['a_co.nc'])
+        FakeFTP.rests = []
+        retry = RetryPolicy(2, delay=0.2, jitter=0.)
+        dl = PlainFTPDownload('ftp.example.com', username='not_due',
+                              retry=retry)
+        waiting = []
+
+        def sleep(seconds):
+            waiting.append(dl.connection_stats())
+            time.sleep(seconds)
+        retry.sleep = sleep
+        # a file waiting for its retry doesn't hold up the others
+        dl.retrieve('/data/20170701',
+                    [(fn, os.path.join(self.outdir, fn))
+                     for fn in sorted(FakeFTP.files)])
+        self.assertEqual([fn for fn, _ in FakeFTP.rests],
+                         ['a_co.nc', 'b_co.nc', 'a_co.nc'])
+        # the connection is returned to the pool while waiting
+        self.assertEqual(waiting, [dict(opened=2, reused=0)])
+        self.assertEqual(dl.connection_stats(), dict(opened=2, reused=1))
+        dl.close()
+
+    def test_failed_file(self):
+        FakeFTP.files = {'a_co.nc': b'co data', 'b_co.nc': b'co data'}
+        FakeFTP.fail_always = set(['b_co.nc'])
+        FakeFTP.rests = []
+        dl = PlainFTPDownload('ftp.example.com', username='failing',
+                              n_tries=3, retry=RetryPolicy(3, delay=0.))
+        fcinit = datetime.datetime(2017, 7, 1)
+        try:
+            with self.assertRaises(DownloadFailed) as cm:
+                dl.get('co', fcinit, fcinit, fcinit,
+                       os.path.join(self.outdir, 'co.nc'))
+        finally:
+            FakeFTP.fail_always = set()
+        self.assertEqual([fn for fn, _ in cm.exception.failed], ['b_co.nc'])
+        self.assertEqual([r for r in FakeFTP.rests if r[0] == 'b_co.nc'],
+                         [('b_co.nc', None)] * 3)
+        dl.close()
+
+
+class StaticDownload(HTTPDownload):
+
+    def construct_urls(self, params, fn_out):
+        path, ext = os.path.splitext(fn_out)
+        return [(self.urlbase + name, path + '_{:03d}'.format(i) + ext)
+                for i, name in enumerate(self.names)]
+
+
+@unittest.skipUnless(_AIOHTTP, 'aiohttp is not available')
+class TestAsyncHTTPEngine(LocalHTTPServerTestCase):
+
+    def get(self, names):
+        dl = StaticDownload(engine='async', urlbase=self.urlbase,
+                            names=names, limit_per_host=2)
+        try:
+            return dl.get('CO', None, None, None,
+                          os.path.join(self.outdir, 'co.nc'))
+        finally:
+            dl.close()
+
+    def test_fetch(self):
+        data = [self.make_file('f{}'.format(i), 100000 * i) for i in range(5)]
+        fns = self.get(['f{}'.format(i) for i in range(5)])
+        self.assertEqual(len(fns), 5)
+        for fn, expected in zip(fns, data):
+            with open(fn, 'rb') as fd:
+                self.assertEqual(fd.read(), expected)
+
+    def test_not_available(self):
+        self.make_file('f0', 10)
+        self.assertRaises(DataNotAvailable, self.get, ['f0', 'missing'])
+
+    def test_failed(self):
+        self.make_file('f0', 10)
+        self.make_file('f1', 10)
+        self.server.forbidden.add('f1')
+        with self.assertRaises(DownloadFailed) as cm:
+            self.get(['f0', 'f1'])
+        self.assertEqual([url for url, _ in cm.exception.failed],
+                         [self.urlbase + 'f1'])
+
+    def test_resume(self):
+        data = self.make_file('f0', 100000)
+        self.server.truncate_once.add('f0')
+        dl = StaticDownload(engine='async', urlbase=self.urlbase,
+                            names=['f0'])
+        fns = dl.get('CO', None, None, None,
+                     os.path.join(self.outdir, 'co.nc'), n_tries=2)
+        dl.close()
+        with open(fns[0], 'rb') as fd:
+            self.assertEqual(fd.read(), data)
+        self.assertEqual(self.server.requests,
+                         [('f0', None), ('f0', 'bytes=50000-')])
+
+
+class TestHTTPDownloadResume(LocalHTTPServerTestCase):
+
+    def test_failed(self):
+        self.make_file('f0', 10)
+        self.server.forbidden.add('f0')
+        dl = StaticDownload(urlbase=self.urlbase, names=['f0'])
+        with self.assertRaises(DownloadFailed) as cm:
+            dl.get('co', None, None, None, os.path.join(self.outdir, 'co.nc'))
+        self.assertEqual([url for url, _ in cm.exception.failed],
+                         [self.urlbase + 'f0'])
+
+    def test_resume(self):
+        data = self.make_file('f0', 100000)
+        self.server.truncate_once.add('f0')
+        fn = os.path.join(self.outdir, 'f0')
+        HTTPDownload.download_file(self.urlbase + 'f0', fn, n_tries=2)
+        with open(fn, 'rb') as fd:
+            self.assertEqual(fd.read(), data)
+        self.assertEqual(self.server.requests,
+                         [('f0', None), ('f0', 'bytes=50000-')])
+
+
+class TestProbes(LocalHTTPServerTestCase):
+
+    fcinit = datetime.datetime(2017, 7, 1)
+
+    def probe(self, dl, species='co'):
+        return dl.probe(species, self.fcinit, self.fcinit, self.fcinit)
+
+    def test_http(self):
+        dl = StaticDownload(urlbase=self.urlbase, names=['f0', 'f1'])
+        self.make_file('f0', 10)
+        self.assertFalse(self.probe(dl))
+        self.make_file('f1', 10)
+        self.assertTrue(self.probe(dl))
+        # nothing but HEAD requests
+        self.assertEqual(set(r[1] for r in self.server.requests),
+                         set(['HEAD']))
+
+    def test_ftp(self):
+        FakeFTP.files = {'a_co.nc': b'co data'}
+        dl = PlainFTPDownload('ftp.example.com', username='probe')
+        self.assertTrue(self.probe(dl))
+        self.assertFalse(self.probe(dl, 'no2'))
+        dl.close()
+
+    def test_filesystem(self):
+        dl = FilesystemDownload(os.path.join(self.srcdir, '{fcinit:%Y%m%d}'),
+                                r'co_{fcinit:%Y%m%d}_\d+\.nc')
+        self.assertFalse(self.probe(dl))
+        os.mkdir(os.path.join(self.srcdir, '20170701'))
+        self.assertFalse(self.probe(dl))
+        open(os.path.join(self.srcdir, '20170701', 'co_20170701_00.nc'),
+             'w').close()
+        self.assertTrue(self.probe(dl))
+
+
 class TestCAMSRegDownload(unittest.TestCase):
 
     def test_construct_urls_single(self):
@@ -84,6 +611,57 @@ class TestSilamDownload(unittest.TestCase):
             self.assertEqual(act_params, req_params)
 
 
+class TestSilamSegments(unittest.TestCase):
+
+    def test_construct_urls_segments(self):
+        dl = SilamDownload(n_segments=3)
+        params = {'fcinit': datetime.datetime(2017, 2, 15),
+                  'fcstart': datetime.datetime(2017, 2, 15, 1),
+                  'fcend': datetime.datetime(2017, 2, 20),
+                  'species': 'cnc_HCHO_gas'}
+        actual = dl.construct_urls(params, 'test.nc')
+        self.assertEqual([fn for _, fn in actual],
+                         ['test_000.nc', 'test_001.nc', 'test_002.nc'])
+        ranges = []
+        for url, _ in actual:
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+            ranges.append((query['time_start'][0], query['time_end'][0]))
+        self.assertEqual(ranges,
+                         [('2017-02-15T01:00:00Z', '2017-02-16T16:00:00Z'),
+                          ('2017-02-16T17:00:00Z', '2017-02-18T08:00:00Z'),
+                          ('2017-02-18T09:00:00Z', '2017-02-20T00:00:00Z')])
+
+
+class TestSilamMultiSpecies(unittest.TestCase):
+
+    def test_construct_urls_multi_species(self):
+        dl = SilamDownload()
+        params = {'fcinit': datetime.datetime(2017, 2, 15),
+                  'fcstart': datetime.datetime(2017, 2, 15, 1),
+                  'fcend': datetime.datetime(2017, 2, 20),
+                  'species': ['cnc_HCHO_gas', 'cnc_NO2_gas', 'pressure']}
+        (url, fn), = dl.construct_urls(params, 'test.nc')
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+        self.assertEqual(fn, 'test.nc')
+        self.assertEqual(query['var'],
+                         ['cnc_HCHO_gas', 'cnc_NO2_gas', 'pressure'])
+        self.assertEqual(query['time_end'], ['2017-02-20T00:00:00Z'])
+
+    def test_construct_urls_domain(self):
+        dl = SilamDownload()
+        dl.domain = dict(lat=(45., 55.), lon=(0., 15.), stride=2)
+        params = {'fcinit': datetime.datetime(2017, 2, 15),
+                  'fcstart': datetime.datetime(2017, 2, 15, 1),
+                  'fcend': datetime.datetime(2017, 2, 20),
+                  'species': 'cnc_NO2_gas'}
+        (url, fn), = dl.construct_urls(params, 'test.nc')
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+        self.assertNotIn('disableLLSubset', query)
+        self.assertEqual((query['south'], query['north'], query['west'],
+                          query['east'], query['horizStride']),
+                         (['45.0'], ['55.0'], ['0.0'], ['15.0'], ['2']))
+
+
 def test_camsreg_download():
     dl = msschem_settings.register_datasources['CAMSReg_ENSEMBLE'].cfg['dldriver']
     dl.get('CO', datetime.datetime(2017, 2, 15),
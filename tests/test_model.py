@@ -1,8 +1,31 @@
 import datetime
+import multiprocessing
+import os.path
+import shutil
+import tempfile
 import unittest
 import urllib
+import warnings
 
-from msschem.models import CAMSRegDriver
+import netCDF4
+from netCDF4 import Dataset
+import numpy as np
+try:
+    import zarr
+except ImportError:
+    zarr = None
+try:
+    import h5py
+    from msschem.directchunk import DirectChunkWriter, compress_chunk
+except ImportError:
+    h5py = None
+
+from msschem import DataNotAvailable
+from msschem.download import DownloadDriver, SilamDownload
+from msschem.compression import chunk_shape
+from msschem.models import CAMSRegDriver, CTMDriver, SilamDriver
+from msschem.models.cams_global import (CAMSGlobDriver, CAMS_LEVELDEV_STR,
+                                        load_vert_coord)
 
 import msschem_settings
 
@@ -83,5 +106,804 @@ class TestEMEPDriver(unittest.TestCase):
                        datetime.datetime(2017, 3, 31),
                        ['/home2/hilboll/tmp/msschem/emep/CWF_12FCe-20170313_hourInst.nc'])
 
+class FakeDownload(DownloadDriver):
+
+    thread_safe = True
+
+    def clean_tempfiles(self, fns_temp):
+        pass
+
+
+class FakeDriver(CTMDriver):
+
+    species = {'CO': dict(varname='co', urlname='co'),
+               'NO2': dict(varname='no2', urlname='no2'),
+               'O3': dict(varname='o3', urlname='o3')}
+    layer_type = 'ml'
+    name = 'FAKE'
+    fcstep = datetime.timedelta(hours=1)
+    fcstart_offset = datetime.timedelta(hours=1)
+    fcend_offset = datetime.timedelta(hours=48)
+    missing = ()
+
+    def download(self, species, fcinit, fcend=None, fcstart=None):
+        if species in self.missing:
+            raise DataNotAvailable
+        return [species]
+
+    def fetch(self, urlname, fcinit, fcstart, fcend):
+        self.fetched.append(urlname)
+        return ['shared']
+
+    def check_download(self, fns, species, fcinit, fcstart, fcend, nt=None):
+        pass
+
+    def postprocess(self, species, fcinit, fns):
+        self.processed.append((species, fns))
+        with open(self.output_filename(species, fcinit), 'w') as fh:
+            fh.write(species)
+
+
+class RunTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.fcinit = datetime.datetime(2017, 7, 1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def make_driver(self, **cfg):
+        driver = FakeDriver(dict(dldriver=FakeDownload(),
+                                 basepath=self.tempdir, name='FAKE',
+                                 species=['CO', 'NO2', 'O3'], **cfg))
+        driver.processed = []
+        driver.fetched = []
+        return driver
+
+
+class TestPipelinedRun(RunTestCase):
+
+    def test_pipelined(self):
+        driver = self.make_driver(pipeline=dict(download=2, queue=1))
+        self.assertTrue(driver.run(self.fcinit))
+        self.assertEqual(sorted(driver.processed),
+                         [('CO', ['CO']), ('NO2', ['NO2']), ('O3', ['O3'])])
+
+    def test_pipelined_not_available(self):
+        driver = self.make_driver(pipeline=True)
+        driver.missing = ('NO2', )
+        self.assertFalse(driver.run(self.fcinit))
+        self.assertNotIn(('O3', ['O3']), driver.processed)
+        target_dir = os.path.dirname(driver.output_filename('CO',
+                                                            self.fcinit))
+        self.assertFalse(os.path.isfile(os.path.join(target_dir,
+                                                     'msschem.lock')))
+
+    def test_shared_source(self):
+        driver = self.make_driver(shared_source=True)
+        self.assertTrue(driver.run(self.fcinit))
+        self.assertEqual(driver.fetched, [None])
+        self.assertEqual(driver.processed, [('CO', ['shared']),
+                                            ('NO2', ['shared']),
+                                            ('O3', ['shared'])])
+
+    def test_shared_source_multi_species(self):
+        driver = self.make_driver(shared_source=True)
+        driver.cfg['dldriver'].multi_species = True
+        self.assertTrue(driver.run(self.fcinit))
+        self.assertEqual(driver.fetched, [['co', 'no2', 'o3']])
+        self.assertEqual(len(driver.processed), 3)
+
+
+class TestCheckpoints(RunTestCase):
+
+    def target_file(self, fn):
+        driver = self.make_driver()
+        return os.path.join(os.path.dirname(driver.output_filename(
+                'CO', self.fcinit)), fn)
+
+    def test_resume(self):
+        driver = self.make_driver()
+        driver.missing = ('NO2', )
+        self.assertFalse(driver.run(self.fcinit))
+        self.assertEqual(driver.processed, [('CO', ['CO'])])
+        self.assertTrue(os.path.isfile(self.target_file('msschem.co.done')))
+        self.assertFalse(os.path.isfile(self.target_file('msschem.lock')))
+
+        driver = self.make_driver()
+        self.assertTrue(driver.run(self.fcinit))
+        self.assertEqual(driver.processed, [('NO2', ['NO2']),
+                                            ('O3', ['O3'])])
+
+    def test_modified_output(self):
+        self.assertTrue(self.make_driver().run(self.fcinit))
+        os.remove(self.target_file('msschem.done'))
+        with open(self.make_driver().output_filename('O3', self.fcinit),
+                  'a') as fh:
+            fh.write('truncated')
+        driver = self.make_driver(pipeline=True)
+        self.assertTrue(driver.run(self.fcinit))
+        self.assertEqual(driver.processed, [('O3', ['O3'])])
+
+    def test_force(self):
+        self.assertTrue(self.make_driver().run(self.fcinit))
+        driver = self.make_driver()
+        self.assertTrue(driver.run(self.fcinit))
+        self.assertEqual(driver.processed, [])
+        driver = self.make_driver(force=True)
+        self.assertTrue(driver.run(self.fcinit))
+        self.assertEqual(len(driver.processed), 3)
+
+    def test_lock_removed_on_error(self):
+        driver = self.make_driver(shared_source=True)
+
+        def fail(*args):
+            raise RuntimeError
+        driver.check_download = fail
+        self.assertRaises(RuntimeError, driver.run, self.fcinit)
+        self.assertFalse(os.path.isfile(self.target_file('msschem.lock')))
+
+
+def make_source(fn, t0, nt, nz=3, ny=4, nx=5, varname='co'):
+    """Write a small CAMS-like source file with ``nt`` time steps
+
+    If ``nz`` is None, the file only contains surface fields.
+
+    """
+    with Dataset(fn, 'w', format='NETCDF4_CLASSIC') as nc:
+        nc.createDimension('time', None)
+        if nz is not None:
+            nc.createDimension('level', nz)
+        nc.createDimension('latitude', ny)
+        nc.createDimension('longitude', nx)
+        nc.setncattr('title', 'test data')
+        v = nc.createVariable('time', np.float64, ('time', ))
+        v.units = 'hours since 2017-07-01 00:00:00'
+        v[:] = np.arange(t0, t0 + nt) * 3.
+        nc.createVariable('latitude', np.float32, ('latitude', ))[:] = \
+            np.linspace(50., 53., ny)
+        nc.createVariable('longitude', np.float32, ('longitude', ))[:] = \
+            np.linspace(5., 9., nx)
+        if nz is not None:
+            nc.createVariable('level', np.int32, ('level', ))[:] = \
+                np.arange(1, nz + 1)
+            v = nc.createVariable(varname, np.float32,
+                                  ('time', 'level', 'latitude', 'longitude'))
+            v.units = 'kg kg**-1'
+            v[:] = np.random.RandomState(t0).rand(nt, nz, ny, nx) * 1e-7
+        lnsp = nc.createVariable('lnsp', np.float32,
+                                 ('time', 'latitude', 'longitude'))
+        lnsp[:] = np.log(1e5 + 1e3 * np.random.RandomState(t0 + 1).rand(
+                nt, ny, nx))
+
+
+class NCDriver(CTMDriver):
+    """Driver writing real netCDF files from ``make_source`` data"""
+
+    species = {'CO': dict(varname='co', urlname='co')}
+    needed_vars = ['longitude', 'latitude', 'level', 'time']
+    concentration_type = 'mass'
+    quantity_type = 'fraction'
+    layer_type = 'ml'
+    aggdim = 'time'
+    name = 'NC'
+
+
+class NCTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.fns = [os.path.join(self.tempdir, 'src_{}.nc'.format(i))
+                    for i in range(3)]
+        for i, fn in enumerate(self.fns):
+            make_source(fn, 4 * i, 4)
+        self.fn_out = os.path.join(self.tempdir, 'out.nc')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def make_driver(self, cls=NCDriver, **cfg):
+        driver = cls(dict(dldriver=FakeDownload(), basepath=self.tempdir,
+                          name=cls.name, species=list(cls.species), **cfg))
+        # shuts down the process pool used for writing
+        self.addCleanup(driver.close_connections)
+        return driver
+
+    def source_data(self, varname):
+        return np.concatenate([Dataset(fn).variables[varname][:]
+                               for fn in self.fns])
+
+
+class TestCopyVars(NCTestCase):
+
+    def test_slabs(self):
+        driver = self.make_driver(copy_buffer=1)
+        # 1 MB buffer, 0.25 MB per time step, chunks of 3 time steps
+        slabs = list(driver.iter_slabs((10, 256, 256), 4, chunks=(3, 1, 1)))
+        self.assertEqual(slabs, [slice(0, 3), slice(3, 6), slice(6, 9),
+                                 slice(9, 10)])
+
+    def test_chunked_copy(self):
+        # a buffer of 100 bytes forces one time step per slab
+        driver = self.make_driver(copy_buffer=1e-4)
+        driver.write_dataset('co', self.fns, self.fn_out)
+        with Dataset(self.fn_out) as nc:
+            np.testing.assert_array_equal(nc.variables['co'][:],
+                                          self.source_data('co'))
+            np.testing.assert_array_equal(nc.variables['time'][:],
+                                          np.arange(12) * 3.)
+            self.assertEqual(nc.variables['co'].units, 'kg kg**-1')
+            self.assertEqual(nc.title, 'test data')
+
+
+class TestHybridPressure(NCTestCase):
+
+    def test_blocked_pressure(self):
+        # a buffer of 100 bytes forces one time step per slab
+        driver = self.make_driver(copy_buffer=1e-4)
+        driver.write_dataset('lnsp', self.fns, self.fn_out)
+        hyam = np.array([0., 500., 2000.])
+        hybm = np.array([1., 0.9, 0.7])
+        with Dataset(self.fn_out, 'a') as nc:
+            nc.createVariable('P', np.float32,
+                              ('time', 'level', 'latitude', 'longitude'),
+                              zlib=True)
+            driver.write_hybrid_pressure(nc.variables['P'], hyam, hybm,
+                                         nc.variables['lnsp'],
+                                         surface=np.exp)
+        ps = np.exp(self.source_data('lnsp').astype(np.float64))
+        expected = (hyam[np.newaxis, :, np.newaxis, np.newaxis] +
+                    hybm[np.newaxis, :, np.newaxis, np.newaxis] *
+                    ps[:, np.newaxis, :, :])
+        with Dataset(self.fn_out) as nc:
+            self.assertEqual(nc.variables['P'].dtype, np.float32)
+            np.testing.assert_allclose(nc.variables['P'][:], expected,
+                                       rtol=1e-6)
+
+
+class TestSinglePassWriter(NCTestCase):
+
+    def test_transforms(self):
+        driver = self.make_driver()
+        fcinit = datetime.datetime(2017, 7, 1, 3)
+        driver.postprocess('CO', fcinit, self.fns)
+        with Dataset(driver.output_filename('CO', fcinit)) as nc:
+            v_t = nc.variables['time']
+            self.assertEqual(v_t.units, 'hours since 2017-07-01T03:00:00')
+            self.assertEqual(v_t.standard_name, 'time')
+            np.testing.assert_array_equal(v_t[:], np.arange(12) * 3. - 3.)
+            self.assertEqual(nc.variables['co'].standard_name,
+                             'mass_fraction_of_carbon_monoxide_in_air')
+            np.testing.assert_array_equal(nc.variables['co'][:],
+                                          self.source_data('co'))
+
+    def test_cams_global_pressure(self):
+        for i, fn in enumerate(self.fns):
+            make_source(fn, 4 * i, 4, nz=None)
+        driver = self.make_driver(cls=CAMSGlobDriver, copy_buffer=1e-3)
+        fcinit = datetime.datetime(2017, 7, 1)
+        driver.postprocess('AIR_PRESSURE', fcinit, self.fns)
+        hyn, hyam, hybm = load_vert_coord(CAMS_LEVELDEV_STR)
+        ps = np.exp(self.source_data('lnsp').astype(np.float64))
+        expected = (hyam[np.newaxis, :, np.newaxis, np.newaxis] +
+                    hybm[np.newaxis, :, np.newaxis, np.newaxis] *
+                    ps[:, np.newaxis, :, :])
+        with Dataset(driver.output_filename('AIR_PRESSURE', fcinit)) as nc:
+            np.testing.assert_allclose(nc.variables['P'][:], expected,
+                                       rtol=1e-5)
+            self.assertEqual(nc.variables['P'].units, 'Pa')
+            np.testing.assert_array_equal(nc.variables['level'][:],
+                                          np.arange(1, 61))
+            self.assertEqual(nc.variables['level'].standard_name,
+                             'model_level_number')
+            np.testing.assert_allclose(nc.variables['hyam'][:], hyam,
+                                       rtol=1e-6)
+
+
+class TestNetCDF4Source(NCTestCase):
+
+    def setUp(self):
+        super(TestNetCDF4Source, self).setUp()
+        # a single source file using types which don't exist in the classic
+        # data model
+        self.fn_in = os.path.join(self.tempdir, 'src_nc4.nc')
+        with Dataset(self.fn_in, 'w', format='NETCDF4') as nc:
+            nc.createDimension('time', None)
+            nc.createDimension('level', 2)
+            nc.setncattr('n_members', np.uint16(7))
+            v = nc.createVariable('time', np.int64, ('time', ))
+            v.units = 'hours since 2017-07-01 00:00:00'
+            v[:] = np.arange(3, dtype=np.int64)
+            nc.createVariable('level', np.uint8, ('level', ))[:] = [250, 251]
+            v = nc.createVariable('co', np.float32, ('time', 'level'))
+            v.valid_max = np.uint32(4000000000)
+            v[:] = np.arange(6.).reshape(3, 2)
+
+    def test_convert_on_write(self):
+        driver = self.make_driver()
+        driver.write_dataset('co', [self.fn_in], self.fn_out)
+        with Dataset(self.fn_out) as nc:
+            self.assertEqual(nc.data_model, 'NETCDF4_CLASSIC')
+            self.assertNotEqual(nc.variables['time'].dtype, np.int16)
+            self.assertEqual(nc.variables['level'].dtype, np.int16)
+            np.testing.assert_array_equal(nc.variables['time'][:], [0, 1, 2])
+            np.testing.assert_array_equal(nc.variables['level'][:],
+                                          [250, 251])
+            self.assertEqual(nc.n_members, 7)
+            self.assertEqual(nc.variables['co'].valid_max, 4000000000)
+
+    def make_sources(self):
+        """Write the source data to several NETCDF4 files"""
+        fns = []
+        with Dataset(self.fn_in) as nc_in:
+            for i in range(2):
+                fn = os.path.join(self.tempdir, 'src_nc4_{}.nc'.format(i))
+                with Dataset(fn, 'w', format='NETCDF4') as nc:
+                    nc.createDimension('time', None)
+                    nc.createDimension('level', 2)
+                    nc.setncattr('n_members', np.uint16(7))
+                    for name, var in nc_in.variables.items():
+                        v = nc.createVariable(name, var.dtype, var.dimensions)
+                        v.setncatts(var.__dict__)
+                        v[:] = var[:]
+                fns.append(fn)
+        return fns
+
+    def test_fetch_multiple_files(self):
+        fns = self.make_sources()
+        driver = self.make_driver()
+        driver.cfg['dldriver'].get = lambda *args: fns
+        fcinit = datetime.datetime(2017, 7, 1)
+        # the files are used as they are
+        self.assertEqual(driver.fetch('co', fcinit, fcinit, fcinit), fns)
+
+    def test_aggregate(self):
+        fns = self.make_sources()
+        driver = self.make_driver()
+        driver.write_dataset('co', fns, self.fn_out)
+        with Dataset(self.fn_out) as nc:
+            self.assertEqual(nc.data_model, 'NETCDF4_CLASSIC')
+            self.assertEqual(len(nc.dimensions['time']), 6)
+            np.testing.assert_array_equal(nc.variables['time'][:],
+                                          [0, 1, 2, 0, 1, 2])
+            np.testing.assert_array_equal(nc.variables['level'][:],
+                                          [250, 251])
+            np.testing.assert_array_equal(
+                    nc.variables['co'][:],
+                    np.tile(np.arange(6.).reshape(3, 2), (2, 1)))
+            self.assertEqual(nc.n_members, 7)
+            self.assertEqual(nc.variables['co'].valid_max, 4000000000)
+
+    def test_aggregated_indexing(self):
+        fns = self.make_sources()
+        with self.make_driver().open_source(fns) as nc:
+            self.assertEqual(len(nc.dimensions['time']), 6)
+            self.assertTrue(nc.dimensions['time'].isunlimited())
+            self.assertEqual(nc.variables['time'].units,
+                             'hours since 2017-07-01 00:00:00')
+            co = nc.variables['co']
+            data = np.tile(np.arange(6.).reshape(3, 2), (2, 1))
+            self.assertEqual(co.shape, (6, 2))
+            self.assertEqual(co.valid_max, 4000000000)
+            np.testing.assert_array_equal(co[4], data[4])
+            np.testing.assert_array_equal(co[-1, 0], data[-1, 0])
+            np.testing.assert_array_equal(co[1:5], data[1:5])
+            np.testing.assert_array_equal(co[::-2, 1], data[::-2, 1])
+            np.testing.assert_array_equal(co[..., 0], data[..., 0])
+            np.testing.assert_array_equal(co[[0, 3, 4]], data[[0, 3, 4]])
+            self.assertEqual(co[6:].shape, (0, 2))
+            self.assertRaises(IndexError, co.__getitem__, 6)
+
+
+class TestCompression(NCTestCase):
+
+    def test_profiles(self):
+        driver = self.make_driver(compression='fast',
+                                  compression_vars={'time': 'none'})
+        driver.write_dataset('co', self.fns, self.fn_out)
+        with Dataset(self.fn_out) as nc:
+            filters = nc.variables['co'].filters()
+            self.assertTrue(filters['zlib'])
+            self.assertEqual(filters['complevel'], 1)
+            self.assertFalse(filters['fletcher32'])
+            # coordinates are not compressed
+            self.assertFalse(nc.variables['time'].filters()['zlib'])
+            np.testing.assert_array_equal(nc.variables['co'][:],
+                                          self.source_data('co'))
+
+    def test_custom_profile(self):
+        driver = self.make_driver(compression_vars={'co': dict(complevel=2)})
+        driver.write_dataset('co', self.fns, self.fn_out)
+        with Dataset(self.fn_out) as nc:
+            filters = nc.variables['co'].filters()
+            self.assertEqual(filters['complevel'], 2)
+            self.assertTrue(filters['fletcher32'])
+
+    def test_unknown_profile(self):
+        self.assertRaises(ValueError, self.make_driver, compression='lzma')
+        self.assertRaises(ValueError, self.make_driver,
+                          compression=dict(level=3))
+
+
+class TestChunking(NCTestCase):
+
+    def test_chunk_shapes(self):
+        shape = (0, 60, 451, 900)
+        self.assertEqual(chunk_shape('hsec', shape), [1, 1, 451, 900])
+        self.assertEqual(chunk_shape('vsec', shape), [1, 60, 16, 16])
+        self.assertEqual(chunk_shape('balanced', shape), [1, 8, 181, 181])
+        self.assertEqual(chunk_shape('vsec', (0, 451, 900)), [1, 16, 16])
+        self.assertIsNone(chunk_shape('vsec', (0, 60)))
+        self.assertRaises(ValueError, chunk_shape, 'tiles', shape)
+
+    def test_chunked_output(self):
+        driver = self.make_driver(chunking='vsec')
+        driver.write_dataset('co', self.fns, self.fn_out)
+        with Dataset(self.fn_out) as nc:
+            v = nc.variables['co']
+            self.assertEqual(v.chunking(), [1, 3, 4, 5])
+            # room for the chunks along both horizontal dimensions
+            self.assertEqual(v.chunk_cache_size, 2 * 3 * 4 * 5 * 4)
+            self.assertNotIn('chunk_cache_size',
+                             nc.variables['time'].ncattrs())
+            np.testing.assert_array_equal(v[:], self.source_data('co'))
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, self.make_driver, chunking='tiles')
+
+
+class TestPacking(NCTestCase):
+
+    def test_packed_output(self):
+        driver = self.make_driver(packing=True, copy_buffer=1e-3)
+        driver.write_dataset('co', self.fns, self.fn_out)
+        data = self.source_data('co')
+        with Dataset(self.fn_out) as nc:
+            v = nc.variables['co']
+            self.assertEqual(v.dtype, np.int16)
+            self.assertEqual(v.scale_factor.dtype, np.float32)
+            self.assertLessEqual(v.packing_max_error,
+                                 (data.max() - data.min()) / 65532. / 2 * 1.01)
+            np.testing.assert_allclose(v[:], data, rtol=0,
+                                       atol=v.packing_max_error * 1.01)
+            v.set_auto_scale(False)
+            self.assertLessEqual(np.abs(v[:]).max(), 32767)
+            # coordinates are not packed
+            self.assertNotEqual(nc.variables['time'].dtype, np.int16)
+
+    def test_missing_values(self):
+        with Dataset(self.fns[1], 'a') as nc:
+            nc.variables['co'][0, 0, 0, :] = np.nan
+        driver = self.make_driver(packing=True)
+        with warnings.catch_warnings():
+            # NaN must not reach the cast to int16
+            warnings.simplefilter('error', RuntimeWarning)
+            driver.write_dataset('co', self.fns, self.fn_out)
+        with Dataset(self.fn_out) as nc:
+            data = nc.variables['co'][:]
+            self.assertTrue(data.mask[4, 0, 0].all())
+            self.assertEqual(data.mask.sum(), 5)
+            nc.set_auto_maskandscale(False)
+            self.assertTrue((nc.variables['co'][4, 0, 0] == -32768).all())
+
+
+class TestPrecisionTrimming(NCTestCase):
+
+    def write(self, **cfg):
+        driver = self.make_driver(**cfg)
+        fcinit = datetime.datetime(2017, 7, 1)
+        driver.postprocess('CO', fcinit, self.fns)
+        return driver.output_filename('CO', fcinit)
+
+    def test_least_significant_digit(self):
+        fn = self.write(least_significant_digit={'CO': 9})
+        with Dataset(fn) as nc:
+            v = nc.variables['co']
+            self.assertEqual(v.least_significant_digit, 9)
+            np.testing.assert_allclose(v[:], self.source_data('co'),
+                                       rtol=0, atol=1e-9)
+
+    def test_surface_pressure(self):
+        for i, fn in enumerate(self.fns):
+            make_source(fn, 4 * i, 4, nz=None)
+        driver = self.make_driver(cls=CAMSGlobDriver,
+                                  least_significant_digit=1)
+        fcinit = datetime.datetime(2017, 7, 1)
+        driver.postprocess('AIR_PRESSURE', fcinit, self.fns)
+        with Dataset(driver.output_filename('AIR_PRESSURE', fcinit)) as nc:
+            for name in ['lnsp', 'P']:
+                self.assertNotIn('least_significant_digit',
+                                 nc.variables[name].ncattrs())
+            np.testing.assert_array_equal(nc.variables['lnsp'][:],
+                                          self.source_data('lnsp'))
+        driver.cfg['least_significant_digit'] = {'AIR_PRESSURE': 1}
+        self.assertEqual(driver.precision_kwargs('AIR_PRESSURE'),
+                         dict(least_significant_digit=1))
+
+    def test_copied_pressure(self):
+        # like SILAM, the air pressure is copied from the source files
+        driver_cls = type('PressureDriver', (NCDriver, ), dict(
+                species={'AIR_PRESSURE': dict(varname='pressure',
+                                              urlname='pressure')}))
+        for i, fn in enumerate(self.fns):
+            make_source(fn, 4 * i, 4, varname='pressure')
+        fcinit = datetime.datetime(2017, 7, 1)
+        for value, expected in [(1, None), ({'AIR_PRESSURE': 1}, 1)]:
+            driver = self.make_driver(cls=driver_cls,
+                                      least_significant_digit=value)
+            driver.postprocess('AIR_PRESSURE', fcinit, self.fns)
+            fn = driver.output_filename('AIR_PRESSURE', fcinit)
+            with Dataset(fn) as nc:
+                v = nc.variables['pressure']
+                self.assertEqual(getattr(v, 'least_significant_digit', None),
+                                 expected)
+            os.remove(fn)
+
+    @unittest.skipUnless(
+            getattr(netCDF4, '__has_quantization_support__', False),
+            'netCDF library without quantization support')
+    def test_significant_digits(self):
+        fn_full = self.write()
+        os.rename(fn_full, self.fn_out)
+        fn = self.write(significant_digits=2)
+        with Dataset(fn) as nc:
+            v = nc.variables['co']
+            self.assertEqual(v.quantization(), (2, 'GranularBitRound'))
+            # two significant digits
+            np.testing.assert_allclose(v[:], self.source_data('co'),
+                                       rtol=5e-2)
+        self.assertLess(os.path.getsize(fn), os.path.getsize(self.fn_out))
+
+
+@unittest.skipIf(zarr is None, 'zarr is not installed')
+class TestZarrOutput(NCTestCase):
+
+    fcinit = datetime.datetime(2017, 7, 1)
+
+    def test_both_formats(self):
+        driver = self.make_driver(output_format=['netcdf', 'zarr'],
+                                  packing=True)
+        driver.postprocess('CO', self.fcinit, self.fns)
+        fn_nc = driver.output_filename('CO', self.fcinit, 'netcdf')
+        fn_zarr = driver.output_filename('CO', self.fcinit, 'zarr')
+        self.assertEqual(fn_zarr, fn_nc[:-3] + '.zarr')
+        store = zarr.open_consolidated(fn_zarr, mode='r')
+        with Dataset(fn_nc) as nc:
+            for name in ['co', 'time', 'level']:
+                v_nc, v_zarr = nc.variables[name], store[name]
+                v_nc.set_auto_maskandscale(False)
+                np.testing.assert_array_equal(v_zarr[:], v_nc[:])
+                self.assertEqual(v_zarr.attrs['_ARRAY_DIMENSIONS'],
+                                 list(v_nc.dimensions))
+            self.assertEqual(store['time'].attrs['units'],
+                             nc.variables['time'].units)
+            self.assertEqual(store['co'].attrs['scale_factor'],
+                             nc.variables['co'].scale_factor)
+            self.assertEqual(store.attrs['title'], nc.title)
+
+    def test_parallel_writes(self):
+        for i, fn in enumerate(self.fns):
+            make_source(fn, 4 * i, 4, nz=None)
+        driver = self.make_driver(cls=CAMSGlobDriver, output_format='zarr',
+                                  output_workers=2, copy_buffer=1e-3,
+                                  chunking='hsec')
+        driver.postprocess('AIR_PRESSURE', self.fcinit, self.fns)
+        store = zarr.open_consolidated(
+                driver.output_filename('AIR_PRESSURE', self.fcinit),
+                mode='r')
+        self.assertEqual(store['P'].shape, (12, 60, 4, 5))
+        self.assertEqual(store['P'].chunks, (1, 1, 4, 5))
+        hyn, hyam, hybm = load_vert_coord(CAMS_LEVELDEV_STR)
+        ps = np.exp(self.source_data('lnsp').astype(np.float64))
+        np.testing.assert_allclose(store['P'][:, -1], hyam[-1] +
+                                   hybm[-1] * ps, rtol=1e-5)
+        np.testing.assert_array_equal(store['lnsp'][:],
+                                      self.source_data('lnsp'))
+        np.testing.assert_array_equal(store['level'][:], np.arange(1, 61))
+
+    def test_fix_dataset_unsupported(self):
+        driver_cls = type('LegacyDriver', (NCDriver, ),
+                          dict(fix_dataset=lambda self, *args: None))
+        self.assertRaises(ValueError, self.make_driver, cls=driver_cls,
+                          output_format='zarr')
+
+
+@unittest.skipIf(h5py is None, 'h5py is not installed')
+class TestParallelCompression(NCTestCase):
+
+    fcinit = datetime.datetime(2017, 7, 1)
+
+    def test_same_data(self):
+        driver = self.make_driver(compression_workers=2, copy_buffer=1e-3,
+                                  packing=True)
+        driver.postprocess('CO', self.fcinit, self.fns)
+        os.rename(driver.output_filename('CO', self.fcinit), self.fn_out)
+        driver = self.make_driver(packing=True)
+        driver.postprocess('CO', self.fcinit, self.fns)
+        with Dataset(self.fn_out) as nc, \
+                Dataset(driver.output_filename('CO', self.fcinit)) as ref:
+            v, v_ref = nc.variables['co'], ref.variables['co']
+            self.assertEqual(v.filters(), v_ref.filters())
+            self.assertEqual(v.shape, v_ref.shape)
+            v.set_auto_maskandscale(False)
+            v_ref.set_auto_maskandscale(False)
+            np.testing.assert_array_equal(v[:], v_ref[:])
+            np.testing.assert_array_equal(nc.variables['time'][:],
+                                          ref.variables['time'][:])
+
+    def test_partial_chunks(self):
+        # chunks spanning two slabs, and edge chunks
+        pool = multiprocessing.Pool(2)
+        self.addCleanup(pool.join)
+        self.addCleanup(pool.close)
+        writer = DirectChunkWriter(2, pool=pool, tempdir=self.tempdir)
+        data = np.arange(5 * 3 * 5, dtype=np.float32).reshape(5, 3, 5)
+        try:
+            with Dataset(self.fn_out, 'w', format='NETCDF4_CLASSIC') as nc:
+                nc.createDimension('time', None)
+                nc.createDimension('y', 3)
+                nc.createDimension('x', 5)
+                kwargs = dict(zlib=True, shuffle=True, fletcher32=True,
+                              chunksizes=(2, 2, 3))
+                v = nc.createVariable('co', np.float32, ('time', 'y', 'x'),
+                                      **kwargs)
+                nc.createVariable('time', np.float64, ('time', ))[:] = \
+                    np.arange(5)
+                self.assertTrue(writer.register(v, kwargs))
+                for i in range(5):
+                    writer.write(v, slice(i, i + 1), data[i:i + 1])
+            writer.finish(self.fn_out)
+        finally:
+            writer.close()
+        with Dataset(self.fn_out) as nc:
+            np.testing.assert_array_equal(nc.variables['co'][:], data)
+
+    def test_checksums(self):
+        rs = np.random.RandomState(0)
+        for dtype in [np.float64, np.int8, np.int16]:
+            data = (rs.rand(3, 5, 7) * 100).astype(dtype)
+            data[0] = -1
+            # the chunk written by HDF5 itself
+            with h5py.File(self.fn_out, 'w') as h5:
+                ds = h5.create_dataset('co', data=data, chunks=data.shape,
+                                       shuffle=True, fletcher32=True)
+                plist = ds.id.get_create_plist()
+                pipeline = [(plist.get_filter(i)[0], None)
+                            for i in range(plist.get_nfilters())]
+                ref = ds.id.read_direct_chunk((0, 0, 0))[1]
+            self.assertEqual(compress_chunk(((0, 0, 0), data, pipeline)),
+                             ((0, 0, 0), ref, 0))
+            # netCDF applies fletcher32 before shuffle; the chunks are
+            # compressed in this process without a pool
+            writer = DirectChunkWriter(1, tempdir=self.tempdir)
+            try:
+                with Dataset(self.fn_out, 'w',
+                             format='NETCDF4_CLASSIC') as nc:
+                    for dim, n in zip(['time', 'y', 'x'], data.shape):
+                        nc.createDimension(dim, n)
+                    kwargs = dict(zlib=True, shuffle=True, fletcher32=True,
+                                  chunksizes=(2, 5, 7))
+                    v = nc.createVariable('co', dtype, ('time', 'y', 'x'),
+                                          **kwargs)
+                    self.assertTrue(writer.register(v, kwargs))
+                    writer.write(v, slice(0, 3), data)
+                writer.finish(self.fn_out)
+            finally:
+                writer.close()
+            with Dataset(self.fn_out) as nc:
+                v = nc.variables['co']
+                v.set_auto_maskandscale(False)
+                np.testing.assert_array_equal(v[:], data)
+
+    def test_unsupported_filters(self):
+        writer = DirectChunkWriter(1, tempdir=self.tempdir)
+        try:
+            with Dataset(self.fn_out, 'w', format='NETCDF4_CLASSIC') as nc:
+                for dim in ['time', 'y', 'x']:
+                    nc.createDimension(dim, 2)
+                kwargs = dict(zlib=True, least_significant_digit=2)
+                v = nc.createVariable('co', np.float32, ('time', 'y', 'x'),
+                                      **kwargs)
+                self.assertFalse(writer.register(v, kwargs))
+        finally:
+            writer.close()
+
+    def test_filter_mismatch(self):
+        # the variable has another filter pipeline than ``kwargs`` describe,
+        # so it is written by the netCDF library
+        writer = DirectChunkWriter(1, tempdir=self.tempdir)
+        data = np.arange(8, dtype=np.float32).reshape(2, 2, 2)
+        try:
+            with Dataset(self.fn_out, 'w', format='NETCDF4_CLASSIC') as nc:
+                for dim in ['time', 'y', 'x']:
+                    nc.createDimension(dim, 2)
+                v = nc.createVariable('co', np.float32, ('time', 'y', 'x'),
+                                      zlib=True, fletcher32=True)
+                self.assertFalse(writer.register(v, dict(zlib=True)))
+                self.assertFalse(writer.handles(v))
+                v[:] = data
+            writer.finish(self.fn_out)
+        finally:
+            writer.close()
+        with Dataset(self.fn_out) as nc:
+            np.testing.assert_array_equal(nc.variables['co'][:], data)
+
+
+class TestDomainSubset(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def make_driver(self):
+        domain = dict(lat=(45., 55.), lon=(0., 15.), stride=2, vert_stride=3)
+        driver = SilamDriver(dict(dldriver=SilamDownload(),
+                                  basepath=self.tempdir, name='SILAM',
+                                  species=['NO2'], domain=domain))
+        self.assertEqual(driver.cfg['dldriver'].domain, domain)
+        return driver
+
+    def write_subset(self, lat, lon, nz=4):
+        """Write a file like an NCSS response for the given coordinates"""
+        fn = os.path.join(self.tempdir, 'silam.nc')
+        with Dataset(fn, 'w', format='NETCDF4') as nc:
+            for dim, coords in [('time', np.arange(2.)),
+                                ('height', np.arange(nz)),
+                                ('lat', lat), ('lon', lon)]:
+                nc.createDimension(dim, len(coords))
+                nc.createVariable(dim, np.float32, (dim, ))[:] = coords
+            nc.createVariable('cnc_NO2_gas', np.float32,
+                              ('time', 'height', 'lat', 'lon'))
+        return [fn]
+
+    def check(self, driver, fns):
+        fcinit = datetime.datetime(2017, 7, 1)
+        driver.check_download(fns, 'NO2', fcinit,
+                              fcinit + datetime.timedelta(hours=1),
+                              fcinit + datetime.timedelta(hours=2))
+
+    def test_silam_subset(self):
+        driver = self.make_driver()
+        # the bounding box includes its edges, strides start at the first
+        # point: 51 latitudes and 76 longitudes
+        fns = self.write_subset(np.arange(45., 55.05, .2),
+                                np.arange(0., 15.05, .2))
+        self.check(driver, fns)
+        with Dataset(fns[0]) as nc:
+            dims = driver.subset_dims(driver.get_dims('NO2'), nc,
+                                      nc.variables['cnc_NO2_gas'])
+        self.assertEqual(list(dims.items()),
+                         [('t', None), ('z', 4), ('y', 51), ('x', 76)])
+
+    def test_silam_subset_edges(self):
+        # servers which exclude the edges, or include the cells around them
+        driver = self.make_driver()
+        self.check(driver, self.write_subset(np.arange(45.1, 55., .2),
+                                             np.arange(-.1, 15.15, .2)))
+
+    def test_silam_subset_mismatch(self):
+        driver = self.make_driver()
+        # the whole domain, e.g. if the server ignored the bounding box
+        fns = self.write_subset(30. + .2 * np.arange(210),
+                                np.arange(0., 15.05, .2))
+        self.assertRaises(ValueError, self.check, driver, fns)
+        # the bounding box without stride
+        fns = self.write_subset(np.arange(45., 55.05, .1),
+                                np.arange(0., 15.05, .2))
+        self.assertRaises(ValueError, self.check, driver, fns)
+        # wrong number of levels
+        fns = self.write_subset(np.arange(45., 55.05, .2),
+                                np.arange(0., 15.05, .2), nz=10)
+        self.assertRaises(ValueError, self.check, driver, fns)
+
+    def test_unsupported(self):
+        self.assertRaises(ValueError, FakeDriver, dict(
+                dldriver=FakeDownload(), basepath=self.tempdir, name='FAKE',
+                species=['CO'], domain=dict(lat=(45., 55.), lon=(0., 15.))))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,90 @@
+import errno
+import ftplib
+import socket
+import unittest
+
+try:  # Py2
+    from urllib2 import HTTPError
+except ImportError:  # Py3
+    from urllib.error import HTTPError
+
+from msschem import DataNotAvailable
+from msschem.retry import RetryPolicy, is_transient
+
+
+def http_error(code):
+    return HTTPError('http://example.com/', code, 'error', {}, None)
+
+
+class TestClassification(unittest.TestCase):
+
+    def test_transient(self):
+        for err in [http_error(503), http_error(429),
+                    ftplib.error_temp('421 Service not available'),
+                    socket.timeout(), EOFError(),
+                    IOError(errno.ECONNRESET, 'Connection reset')]:
+            self.assertTrue(is_transient(err), err)
+
+    def test_permanent(self):
+        for err in [http_error(404), http_error(401),
+                    ftplib.error_perm('550 No such file'),
+                    IOError(errno.ENOENT, 'No such file'),
+                    DataNotAvailable(), ValueError()]:
+            self.assertFalse(is_transient(err), err)
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def make_policy(self, **kwargs):
+        policy = RetryPolicy(**kwargs)
+        policy.sleep = self.delays.append
+        return policy
+
+    def setUp(self):
+        self.delays = []
+        self.calls = 0
+
+    def failing(self, n_failures, err):
+        def func():
+            self.calls += 1
+            if self.calls <= n_failures:
+                raise err
+            return 'ok'
+        return func
+
+    def test_backoff(self):
+        policy = self.make_policy(n_tries=4, delay=1., jitter=0.)
+        func = self.failing(3, EOFError())
+        self.assertEqual(policy.call(func), 'ok')
+        self.assertEqual(self.delays, [1., 2., 4.])
+
+    def test_jitter(self):
+        policy = RetryPolicy(delay=10., jitter=0.5, max_delay=30.)
+        for n_failed in range(1, 6):
+            delay = policy.get_delay(n_failed)
+            nominal = min(10. * 2 ** (n_failed - 1), 30.)
+            self.assertTrue(0.5 * nominal <= delay <= nominal)
+
+    def test_give_up(self):
+        policy = self.make_policy(n_tries=2)
+        self.assertRaises(EOFError, policy.call, self.failing(2, EOFError()))
+        self.assertEqual(self.calls, 2)
+
+    def test_permanent_error(self):
+        policy = self.make_policy(n_tries=5)
+        self.assertRaises(ftplib.error_perm, policy.call,
+                          self.failing(1, ftplib.error_perm('550')))
+        self.assertEqual(self.delays, [])
+
+    def test_budget(self):
+        policy = self.make_policy(n_tries=3, budget=1)
+        self.assertEqual(policy.call(self.failing(1, EOFError())), 'ok')
+        self.calls = 0
+        self.assertRaises(EOFError, policy.call, self.failing(1, EOFError()))
+        policy.reset()
+        self.calls = 0
+        self.assertEqual(policy.call(self.failing(1, EOFError())), 'ok')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,273 @@
+import datetime
+import logging
+import os.path
+import shutil
+import tempfile
+import textwrap
+import unittest
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+from msschem import runner, transfer
+
+from .test_model import make_source
+
+
+CONFIG = textwrap.dedent('''
+    class FakeDriver(object):
+        def __init__(self, result):
+            self.result = result
+        def run(self, day):
+            if self.result is None:
+                raise RuntimeError('broken driver')
+            return self.result
+        def prune(self, n_days):
+            pass
+
+    datasources = {'A': FakeDriver(True),
+                   'B': FakeDriver(False),
+                   'C': FakeDriver(None)}
+''')
+
+
+HOST_CONFIG = textwrap.dedent('''
+    import os.path
+    import time
+
+    class FakeDownload(object):
+        def __init__(self, host):
+            self.host = host
+        def hostname(self):
+            return self.host
+        def close(self):
+            pass
+
+    class FakeDriver(object):
+        def __init__(self, host):
+            self.cfg = dict(dldriver=FakeDownload(host))
+        def run(self, day):
+            t0 = time.time()
+            time.sleep(0.2)
+            with open(os.path.join(LOGDIR, self.cfg['dldriver'].host), 'a') \\
+                    as fd:
+                fd.write('{} {} {:%Y%m%d}\\n'.format(t0, time.time(), day))
+            return True
+
+    datasources = {'A': FakeDriver('a.example.com'),
+                   'B': FakeDriver('a.example.com'),
+                   'C': FakeDriver('c.example.com')}
+''')
+
+
+ZARR_CONFIG = textwrap.dedent('''
+    from tests.test_model import FakeDownload, NCDriver
+
+    class SourceDriver(NCDriver):
+        def download(self, species, fcinit, fcend=None, fcstart=None):
+            return SOURCES
+
+    datasources = {'NC': SourceDriver(dict(
+            dldriver=FakeDownload(), basepath=BASEPATH, name='NC',
+            species=['CO'], output_format='zarr', output_workers=2))}
+''')
+
+
+WORKER_FAILS_CONFIG = textwrap.dedent('''
+    import multiprocessing
+
+    class FakeDriver(object):
+        def run(self, day):
+            raise SystemExit(1)
+
+    if BROKEN and multiprocessing.current_process().daemon:
+        raise RuntimeError('broken in worker process')
+    datasources = {'A': FakeDriver(), 'B': FakeDriver()}
+''')
+
+
+TRANSFER_CONFIG = textwrap.dedent('''
+    import os.path
+    import time
+
+    from msschem.transfer import configure_transfers, get_scheduler
+
+    configure_transfers(hosts={'a.example.com': dict(connections=1)})
+
+    class FakeDriver(object):
+        def run(self, day):
+            with get_scheduler().transfer('a.example.com'):
+                t0 = time.time()
+                time.sleep(0.2)
+                with open(os.path.join(LOGDIR, 'transfers'), 'a') as fd:
+                    fd.write('{} {}\\n'.format(t0, time.time()))
+            return True
+
+    datasources = {'A': FakeDriver(), 'B': FakeDriver(), 'C': FakeDriver()}
+''')
+
+
+class ConnectionDriver(object):
+    """Records whether connections are kept open after the run"""
+
+    def __init__(self):
+        self.cfg = dict()
+        self.kept = []
+
+    def run(self, day):
+        self.kept.append(self.cfg.get('keep_connections', False))
+        return True
+
+
+class TestRunModels(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.configfile = os.path.join(self.tempdir, 'settings.py')
+        with open(self.configfile, 'w') as fd:
+            fd.write(CONFIG)
+        self.datasources = runner.read_config(self.configfile)
+        self.fcinit = datetime.datetime(2017, 7, 1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def check_results(self, results):
+        self.assertEqual([(n, s) for n, s, _ in results],
+                         [('A', 'done'), ('B', 'incomplete'),
+                          ('C', 'failed')])
+
+    def test_sequential(self):
+        self.check_results(runner.run_models(
+                self.datasources, ['A', 'B', 'C'], self.fcinit))
+
+    def test_parallel(self):
+        self.check_results(runner.run_models(
+                self.datasources, ['A', 'B', 'C'], self.fcinit, jobs=3,
+                configfile=self.configfile))
+
+    def test_backfill_tasks(self):
+        tasks = runner.backfill_tasks(['A', 'B'], datetime.date(2017, 6, 29),
+                                      datetime.date(2017, 7, 1))
+        self.assertEqual(tasks[:3], [('A', self.fcinit), ('B', self.fcinit),
+                                     ('A', datetime.datetime(2017, 6, 30))])
+        self.assertEqual(len(tasks), 6)
+
+    def test_jobs_per_host(self):
+        configfile = os.path.join(self.tempdir, 'hosts.py')
+        with open(configfile, 'w') as fd:
+            fd.write('LOGDIR = {!r}\n'.format(self.tempdir) + HOST_CONFIG)
+        tasks = runner.backfill_tasks(['A', 'B', 'C'],
+                                      datetime.date(2017, 6, 30),
+                                      datetime.date(2017, 7, 1))
+        results = runner.run_tasks(runner.read_config(configfile), tasks,
+                                   jobs=3, jobs_per_host=1,
+                                   configfile=configfile)
+        self.assertEqual([r[:3] for r in results],
+                         [t + ('done', ) for t in tasks])
+        with open(os.path.join(self.tempdir, 'a.example.com')) as fd:
+            runs = sorted([float(v) for v in line.split()[:2]]
+                          for line in fd)
+        self.assertEqual(len(runs), 4)
+        # no two runs for the same host at the same time
+        for (_, end), (start, _) in zip(runs[:-1], runs[1:]):
+            self.assertLessEqual(end, start)
+
+    @unittest.skipIf(zarr is None, 'zarr is not installed')
+    def test_parallel_output_workers(self):
+        # the workers of run_tasks can't start a pool for writing output
+        fns = [os.path.join(self.tempdir, 'src_{}.nc'.format(i))
+               for i in range(2)]
+        for i, fn in enumerate(fns):
+            make_source(fn, 4 * i, 4)
+        configfile = os.path.join(self.tempdir, 'zarr.py')
+        with open(configfile, 'w') as fd:
+            fd.write('BASEPATH = {!r}\nSOURCES = {!r}\n'.format(
+                    self.tempdir, fns) + ZARR_CONFIG)
+        datasources = runner.read_config(configfile)
+        tasks = runner.backfill_tasks(['NC'], datetime.date(2017, 6, 30),
+                                      datetime.date(2017, 7, 1))
+        results = runner.run_tasks(datasources, tasks, jobs=2,
+                                   configfile=configfile)
+        self.assertEqual([r[:3] for r in results],
+                         [t + ('done', ) for t in tasks])
+        for _, fcinit in tasks:
+            fn = datasources['NC'].output_filename('CO', fcinit)
+            store = zarr.open_consolidated(fn, mode='r')
+            self.assertEqual(store['co'].shape, (8, 3, 4, 5))
+
+    def test_worker_fails(self):
+        configfile = os.path.join(self.tempdir, 'broken.py')
+        with open(configfile, 'w') as fd:
+            fd.write('BROKEN = True\n' + WORKER_FAILS_CONFIG)
+        datasources = runner.read_config(configfile)
+        tasks = [('A', self.fcinit), ('B', self.fcinit)]
+        # the configuration can't be read in the worker processes
+        results = runner.run_tasks(datasources, tasks, jobs=2,
+                                   configfile=configfile,
+                                   loglevel=logging.CRITICAL)
+        self.assertEqual([r[:3] for r in results],
+                         [t + ('failed', ) for t in tasks])
+
+
+    def test_worker_exits(self):
+        configfile = os.path.join(self.tempdir, 'exits.py')
+        with open(configfile, 'w') as fd:
+            fd.write('BROKEN = False\n' + WORKER_FAILS_CONFIG)
+        tasks = [('A', self.fcinit), ('B', self.fcinit)]
+        # the driver raises SystemExit in the worker processes
+        results = runner.run_tasks(runner.read_config(configfile), tasks,
+                                   jobs=2, configfile=configfile,
+                                   loglevel=logging.CRITICAL)
+        self.assertEqual([r[:3] for r in results],
+                         [t + ('failed', ) for t in tasks])
+
+    def test_keep_connections(self):
+        datasources = dict((name, ConnectionDriver()) for name in 'AB')
+        runner.run_tasks(datasources, [('A', self.fcinit),
+                                       ('B', self.fcinit)])
+        # one init time, but the models share the connections
+        for driver in datasources.values():
+            self.assertEqual(driver.kept, [True])
+
+    def test_shared_transfer_limits(self):
+        configfile = os.path.join(self.tempdir, 'transfers.py')
+        with open(configfile, 'w') as fd:
+            fd.write('LOGDIR = {!r}\n'.format(self.tempdir) + TRANSFER_CONFIG)
+        tasks = [(name, self.fcinit) for name in 'ABC']
+        try:
+            results = runner.run_tasks(runner.read_config(configfile), tasks,
+                                       jobs=3, configfile=configfile)
+        finally:
+            transfer.configure_transfers()
+        self.assertEqual([r[2] for r in results], ['done'] * 3)
+        with open(os.path.join(self.tempdir, 'transfers')) as fd:
+            runs = sorted([float(v) for v in line.split()] for line in fd)
+        self.assertEqual(len(runs), 3)
+        # one connection to the host for all worker processes together
+        for (_, end), (start, _) in zip(runs[:-1], runs[1:]):
+            self.assertLessEqual(end, start)
+
+    def test_setup_logging_once(self):
+        log = logging.getLogger('msschem')
+        handlers = list(log.handlers)
+        level = log.level
+        try:
+            runner._setup_logging(logging.INFO)
+            runner._setup_logging(logging.DEBUG)
+            self.assertEqual(len(log.handlers), max(len(handlers), 1))
+            self.assertEqual(log.level, logging.DEBUG)
+        finally:
+            log.handlers = handlers
+            log.setLevel(level)
+
+    def test_summary(self):
+        summary = runner.format_summary([('CAMSGlob', 'done', 3723.2)])
+        self.assertIn('CAMSGlob', summary)
+        self.assertIn('1:02:03', summary)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import os.path
+import threading
+import time
+import unittest
+
+from msschem import transfer
+from msschem.download import _AIOHTTP
+from msschem.retry import RetryPolicy
+from msschem.transfer import RateLimiter, TransferScheduler
+
+from .test_download import LocalHTTPServerTestCase, StaticDownload
+
+
+class TestTransferScheduler(unittest.TestCase):
+
+    def test_connections_per_host(self):
+        scheduler = TransferScheduler(max_connections=2,
+                                      hosts={'b': dict(connections=1)})
+        active = dict(a=0, b=0)
+        peak = dict(a=0, b=0)
+        lock = threading.Lock()
+
+        def job(host):
+            with scheduler.transfer(host):
+                with lock:
+                    active[host] += 1
+                    peak[host] = max(peak[host], active[host])
+                time.sleep(0.05)
+                with lock:
+                    active[host] -= 1
+
+        threads = [threading.Thread(target=job, args=(host, ))
+                   for host in 'aaaabbb']
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(peak, dict(a=2, b=1))
+        stats = scheduler.stats('b')
+        self.assertEqual(stats['transfers'], 3)
+        # the last transfer from b had to wait for the other two
+        self.assertGreater(stats['wait'], 0.1)
+        self.assertLess(stats['transfer'], stats['wait'] + 0.3)
+
+    def test_priority(self):
+        scheduler = TransferScheduler(max_connections=1)
+        order = []
+        first = scheduler.acquire('a')
+
+        def job(name, priority):
+            with scheduler.transfer('a', priority):
+                order.append(name)
+
+        threads = []
+        for name, priority in [('low', 0), ('high', 5), ('medium', 1)]:
+            threads.append(threading.Thread(target=job,
+                                            args=(name, priority)))
+            threads[-1].start()
+            time.sleep(0.05)
+        scheduler.release(first)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, ['high', 'medium', 'low'])
+
+    def test_rate_limit(self):
+        limiter = RateLimiter(1000.)
+        self.assertAlmostEqual(limiter.reserve(500), 0.5, places=2)
+        self.assertAlmostEqual(limiter.reserve(500), 1., places=2)
+
+    def test_host_and_global_rate(self):
+        scheduler = TransferScheduler(rate=1e6, hosts={'a': dict(rate=1e3)})
+        self.assertEqual(len(scheduler.limiters('a')), 2)
+        self.assertEqual(len(scheduler.limiters('b')), 1)
+        self.assertEqual(len(scheduler.limiters(None)), 1)
+
+
+class TestScheduledDownload(LocalHTTPServerTestCase):
+
+    def setUp(self):
+        super(TestScheduledDownload, self).setUp()
+        self.scheduler = transfer.configure_transfers()
+
+    def tearDown(self):
+        transfer.configure_transfers()
+        super(TestScheduledDownload, self).tearDown()
+
+    def test_http(self):
+        self.make_file('f0', 1000)
+        self.make_file('f1', 2000)
+        dl = StaticDownload(urlbase=self.urlbase, names=['f0', 'f1'])
+        dl.get('co', None, None, None, os.path.join(self.outdir, 'co.nc'))
+        stats = self.scheduler.stats('127.0.0.1')
+        self.assertEqual(stats['transfers'], 2)
+        self.assertEqual(stats['bytes'], 3000)
+
+    def test_retry_frees_slot(self):
+        self.make_file('f0', 1000)
+        self.server.truncate_once.add('f0')
+        retry = RetryPolicy(2, delay=0.)
+        waiting = []
+        # the first try is recorded when its slot is returned
+        retry.sleep = lambda seconds: waiting.append(
+                self.scheduler.stats('127.0.0.1'))
+        dl = StaticDownload(urlbase=self.urlbase, names=['f0'], retry=retry)
+        dl.get('co', None, None, None, os.path.join(self.outdir, 'co.nc'))
+        self.assertEqual([stats['transfers'] for stats in waiting], [1])
+        self.assertEqual(self.scheduler.stats('127.0.0.1')['transfers'], 2)
+
+    @unittest.skipUnless(_AIOHTTP, 'aiohttp is not available')
+    def test_async_retry_takes_slot_per_try(self):
+        self.make_file('f0', 1000)
+        self.server.truncate_once.add('f0')
+        dl = StaticDownload(engine='async', urlbase=self.urlbase,
+                            names=['f0'], retry=RetryPolicy(2, delay=0.))
+        try:
+            dl.get('co', None, None, None,
+                   os.path.join(self.outdir, 'co.nc'))
+        finally:
+            dl.close()
+        self.assertEqual(self.scheduler.stats('127.0.0.1')['transfers'], 2)